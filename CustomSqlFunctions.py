@@ -1,15 +1,428 @@
 '''Create Functions that can be called from SQLite'''
 import os
+import logging
+import datetime
+import ntpath
+import struct
+import sqlite3
+import threading
 
-def RegisterFunctions(dbh):
-	'''Register your created functions here'''
-	dbh.create_function('basename',1,Basename)
+#Microseconds from the FILETIME epoch to the unix epoch#
+FILETIME_EPOCH_OFFSET = -11644473600000000
+UNIX_EPOCH = datetime.datetime(1970,1,1)
+
+#The resolved SruDbIdMapTable built after conversion#
+ID_MAP_TABLE = 'SrumIdMap'
+#The column telling the hosts of a merged fleet db apart#
+MERGE_KEY_COLUMN = 'host'
+#Number of resolved ids kept in memory per db#
+DEFAULT_ID_CACHE_ENTRIES = 65536
+#Number of results kept in memory per memoized function#
+DEFAULT_FUNCTION_CACHE_ENTRIES = 16384
+
+#Names of the well known SIDs#
+WELL_KNOWN_SIDS = {
+	'S-1-0-0':'NULL',
+	'S-1-1-0':'Everyone',
+	'S-1-2-0':'LOCAL',
+	'S-1-3-0':'CREATOR OWNER',
+	'S-1-5-7':'ANONYMOUS LOGON',
+	'S-1-5-18':'SYSTEM',
+	'S-1-5-19':'LOCAL SERVICE',
+	'S-1-5-20':'NETWORK SERVICE',
+	'S-1-5-32-544':'Administrators',
+	'S-1-5-32-545':'Users',
+	'S-1-5-32-546':'Guests'
+}
+#Names of the well known relative ids of domain and machine SIDs#
+WELL_KNOWN_RIDS = {
+	500:'Administrator',
+	501:'Guest',
+	502:'krbtgt',
+	503:'DefaultAccount',
+	504:'WDAGUtilityAccount'
+}
+#Upper bounds and labels of the byte size buckets#
+SIZE_BUCKETS = [
+	(1,'0 B'),
+	(1024,'1 B - 1 KB'),
+	(1024 ** 2,'1 KB - 1 MB'),
+	(1024 ** 3,'1 MB - 1 GB'),
+	(1024 ** 4,'1 GB - 1 TB')
+]
+
+#SQL functions as (name, number of arguments, function, deterministic)#
+SQL_FUNCTIONS = []
+
+class LruCache(object):
+	'''A bounded dictionary that drops its least recently used entries.
+	Entries are links [previous, next, key, value] of a circular list in
+	use order, so a hit costs a few list assignments. It is shared by
+	threads, so every access is locked.'''
+	def __init__(self,max_entries):
+		self.max_entries = max(1,max_entries)
+		self.entries = {}
+		self.lock = threading.Lock()
+		
+		#The root link sits between the newest and the oldest entry#
+		self.root = []
+		self.root[:] = [self.root,self.root,None,None]
+		
+	def Get(self,key,default=None):
+		'''Get a value, marking it as the most recently used'''
+		with self.lock:
+			link = self.entries.get(key,None)
+			if link is None:
+				return default
+			
+			#Unlink it and link it back in as the newest#
+			previous_link,next_link,key,value = link
+			previous_link[1] = next_link
+			next_link[0] = previous_link
+			
+			root = self.root
+			newest = root[0]
+			newest[1] = root[0] = link
+			link[0] = newest
+			link[1] = root
+			
+		return value
+	
+	def Set(self,key,value):
+		'''Set a value, dropping the least recently used one when full'''
+		with self.lock:
+			if key in self.entries:
+				self.entries[key][3] = value
+				return
+			
+			root = self.root
+			newest = root[0]
+			link = [newest,root,key,value]
+			newest[1] = root[0] = self.entries[key] = link
+			
+			if len(self.entries) > self.max_entries:
+				oldest = root[1]
+				root[1] = oldest[1]
+				oldest[1][0] = root
+				del self.entries[oldest[2]]
+				
+	def Clear(self):
+		'''Drop every value'''
+		with self.lock:
+			self.entries.clear()
+			self.root[:] = [self.root,self.root,None,None]
+
+def Memoize(function,max_entries=DEFAULT_FUNCTION_CACHE_ENTRIES):
+	'''Wrap a function of hashable arguments in a LruCache'''
+	cache = LruCache(max_entries)
+	missing = object()
+	
+	def Memoized(*args):
+		key = args
+		try:
+			value = cache.Get(key,missing)
+		except TypeError:
+			#BLOBs are passed as writable buffers, which are not hashable#
+			key = tuple([str(arg) if isinstance(arg,buffer) else arg for arg in args])
+			value = cache.Get(key,missing)
+			
+		if value is missing:
+			value = function(*args)
+			cache.Set(key,value)
+			
+		return value
+	
+	return Memoized
+
+def SqlFunction(name,num_args,memoize=False):
+	'''Decorator that adds a deterministic function to SQL_FUNCTIONS.
+	Functions called with the same few values on every row of a join are
+	memoized.'''
+	def Register(function):
+		sql_function = function
+		if memoize:
+			sql_function = Memoize(function)
+			
+		SQL_FUNCTIONS.append(
+			(name,num_args,sql_function,True)
+		)
+		
+		return function
+	
+	return Register
+
+def RegisterFunctions(dbh,db_name=None):
+	'''Register your created functions here
 	
+	Args:
+		dbh: The sqlite3 connection
+		db_name: The output db the id functions resolve ids in, which is not
+			always the db of the connection'''
+	for name,num_args,function,deterministic in SQL_FUNCTIONS:
+		CreateFunction(dbh,name,num_args,function,deterministic)
+	
+	if db_name is not None:
+		#Not deterministic, the id map can be rebuilt. The two argument#
+		#forms take the host of the id in a merged fleet db#
+		idResolver = GetIdResolver(db_name)
+		#sqlite3 keeps functions alive in a dictionary keyed by the#
+		#function, so both forms must get the same bound method. Equal#
+		#bound methods from separate lookups are freed while in use.#
+		get_value = idResolver.GetValue
+		get_name = idResolver.GetName
+		for num_args in [1,2]:
+			CreateFunction(dbh,'id_value',num_args,get_value,False)
+			CreateFunction(dbh,'id_name',num_args,get_name,False)
+
+def CreateFunction(dbh,name,num_args,function,deterministic):
+	'''Create a SQL function. Deterministic functions can be optimized by
+	SQLite, which sqlite3 supports from Python 3.8 and SQLite 3.8.3.'''
+	if deterministic:
+		try:
+			dbh.create_function(name,num_args,function,deterministic=True)
+			return
+		except (TypeError,sqlite3.NotSupportedError):
+			pass
+		
+	dbh.create_function(name,num_args,function)
+	
+@SqlFunction('basename',1,memoize=True)
 def Basename(filename):
-	'''Get the base name of a fullname string'''
+	'''Get the base name of a Windows or POSIX path'''
+	if not isinstance(filename,basestring):
+		return filename
+	
+	return ntpath.basename(filename)
+
+@SqlFunction('epoch_to_datetime',1)
+def EpochToDatetime(microseconds):
+	'''Format epoch microseconds (--timestamp_format epoch) like a stored datetime'''
+	try:
+		value = str(UNIX_EPOCH + datetime.timedelta(microseconds=microseconds))
+	except:
+		value = None
+	
+	return value
+
+@SqlFunction('filetime_to_datetime',1)
+def FiletimeToDatetime(filetime):
+	'''Format a FILETIME (--timestamp_format filetime) like a stored datetime'''
+	try:
+		value = EpochToDatetime(filetime // 10 + FILETIME_EPOCH_OFFSET)
+	except:
+		value = None
+	
+	return value
+
+@SqlFunction('datetime_to_epoch',1)
+def DatetimeToEpoch(text):
+	'''Get the epoch microseconds of a 'YYYY-MM-DD[ HH:MM:SS[.ffffff]]' string,
+	to compare with epoch timestamp columns'''
+	value = None
+	for strptime_format in ['%Y-%m-%d %H:%M:%S.%f','%Y-%m-%d %H:%M:%S','%Y-%m-%d']:
+		try:
+			delta = datetime.datetime.strptime(text,strptime_format) - UNIX_EPOCH
+		except:
+			continue
+		
+		value = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+		break
+	
+	return value
+
+@SqlFunction('datetime_to_filetime',1)
+def DatetimeToFiletime(text):
+	'''Get the FILETIME of a 'YYYY-MM-DD[ HH:MM:SS[.ffffff]]' string, to
+	compare with filetime timestamp columns'''
+	value = DatetimeToEpoch(text)
+	if value is not None:
+		value = (value - FILETIME_EPOCH_OFFSET) * 10
+	
+	return value
+
+@SqlFunction('sid_to_string',1,memoize=True)
+def SidToString(data):
+	'''Format a binary SID as S-R-I-S-S..., None if it is not a SID'''
+	try:
+		data = str(data)
+		revision,sub_authority_count = struct.unpack('<BB',data[0:2])
+		if len(data) != 8 + 4 * sub_authority_count:
+			return None
+		
+		authority = struct.unpack('>Q','\x00\x00' + data[2:8])[0]
+		sub_authorities = struct.unpack(
+			'<{}I'.format(sub_authority_count),
+			data[8:]
+		)
+	except:
+		return None
+	
+	return 'S-{}-{}'.format(revision,authority) + ''.join(
+		['-{}'.format(sub_authority) for sub_authority in sub_authorities]
+	)
+
+@SqlFunction('sid_to_username',1,memoize=True)
+def SidToUsername(sid):
+	'''Get the name of a well known SID, or of a well known account of a
+	domain or machine SID. Other SIDs are returned as they are.'''
+	if sid is None:
+		return None
+	elif not isinstance(sid,basestring):
+		sid = SidToString(sid)
+		if sid is None:
+			return None
+		
+	if sid in WELL_KNOWN_SIDS:
+		return WELL_KNOWN_SIDS[sid]
+	
+	if sid.startswith('S-1-5-21-'):
+		try:
+			rid = int(sid.rsplit('-',1)[1])
+		except ValueError:
+			return sid
+		
+		if rid in WELL_KNOWN_RIDS:
+			return WELL_KNOWN_RIDS[rid]
+		
+	return sid
+
+@SqlFunction('format_filetime',2)
+def FormatFiletime(filetime,strftime_format):
+	'''Format a FILETIME (--timestamp_format filetime) with a strftime format'''
 	try:
-		value = os.path.basename(filename)
+		value = (UNIX_EPOCH + datetime.timedelta(microseconds=filetime // 10 + FILETIME_EPOCH_OFFSET)).strftime(
+			str(strftime_format)
+		)
 	except:
-		value = filename
+		value = None
+	
+	return value
+
+@SqlFunction('size_bucket',1)
+def SizeBucket(size):
+	'''Get the order of magnitude label of a byte count, to group by'''
+	if size is None:
+		return None
+	
+	for upper_bound,label in SIZE_BUCKETS:
+		if size < upper_bound:
+			return label
+		
+	return '1 TB or more'
+
+class IdResolver(object):
+	'''Resolve IdIndex values through the ID_MAP_TABLE of a db. Lookups are
+	memoized, misses included, so joins that resolve the same ids over and
+	over only query the table once per id.
+	
+	The ids of the hosts of a merged fleet db collide, so there they are
+	looked up by IdIndex and MERGE_KEY_COLUMN.'''
+	def __init__(self,db_name,max_entries=DEFAULT_ID_CACHE_ENTRIES):
+		self.db_name = db_name
+		self.cache = LruCache(max_entries)
+		self.lock = threading.Lock()
+		self.dbh = None
+		self.merged = False
+		
+	def Resolve(self,id_index,host=None):
+		'''Get the (IdType, IdValue, IdName) of an IdIndex, None if unknown
+		
+		Args:
+			id_index: The IdIndex
+			host: The host of the IdIndex, needed in a merged fleet db'''
+		key = (id_index,host)
+		row = self.cache.Get(key,self)
+		if row is not self:
+			return row
+		
+		with self.lock:
+			try:
+				if self.dbh is None:
+					#Used by the query threads of every report#
+					self.dbh = sqlite3.connect(
+						self.db_name,
+						check_same_thread=False
+					)
+					self.merged = MERGE_KEY_COLUMN in [
+						column_info[1] for column_info in self.dbh.execute(
+							"PRAGMA table_info('{}')".format(ID_MAP_TABLE)
+						)
+					]
+					
+				if not self.merged:
+					row = self.dbh.execute(
+						"SELECT IdType, IdValue, IdName FROM '{}' WHERE IdIndex = ?".format(ID_MAP_TABLE),
+						(id_index,)
+					).fetchone()
+				elif host is not None:
+					row = self.dbh.execute(
+						"SELECT IdType, IdValue, IdName FROM '{}' WHERE IdIndex = ? AND \"{}\" = ?".format(
+							ID_MAP_TABLE,
+							MERGE_KEY_COLUMN
+						),
+						(id_index,host)
+					).fetchone()
+				else:
+					msg = 'The ids of {} are per {}, use id_value(IdIndex, {}) and id_name(IdIndex, {})'.format(
+						self.db_name,
+						MERGE_KEY_COLUMN,
+						MERGE_KEY_COLUMN,
+						MERGE_KEY_COLUMN
+					)
+					logging.error(msg)
+					raise Exception(msg)
+			except sqlite3.Error:
+				#No id map yet. The misses are remembered until the id map#
+				#is built, which closes the resolver.#
+				row = None
+			
+		self.cache.Set(key,row)
+		
+		return row
+	
+	def GetValue(self,id_index,host=None):
+		'''Get the decoded app path, service name or SID of an IdIndex'''
+		row = self.Resolve(id_index,host)
+		if row is None:
+			return None
+		
+		return row[1]
+	
+	def GetName(self,id_index,host=None):
+		'''Get the base name of the app path of an IdIndex'''
+		row = self.Resolve(id_index,host)
+		if row is None:
+			return None
+		
+		return row[2]
+	
+	def Close(self):
+		'''Close the lookup handle and drop the cache'''
+		with self.lock:
+			if self.dbh is not None:
+				self.dbh.close()
+				self.dbh = None
+				
+		self.cache.Clear()
+
+#IdResolvers by (db name, process id)#
+_ID_RESOLVERS = {}
+_ID_RESOLVERS_LOCK = threading.Lock()
+
+def GetIdResolver(db_name):
+	'''Get the IdResolver of a db for this process'''
+	key = (db_name,os.getpid())
+	with _ID_RESOLVERS_LOCK:
+		if key not in _ID_RESOLVERS:
+			_ID_RESOLVERS[key] = IdResolver(db_name)
+			
+		return _ID_RESOLVERS[key]
 	
-	return value
\ No newline at end of file
+def CloseIdResolvers(db_name=None):
+	'''Close the IdResolvers of this process, of every db or of db_name.
+	This must be done when the id map of a db is rebuilt.'''
+	pid = os.getpid()
+	with _ID_RESOLVERS_LOCK:
+		for key in _ID_RESOLVERS.keys():
+			if key[1] == pid and db_name in (None,key[0]):
+				_ID_RESOLVERS.pop(key).Close()
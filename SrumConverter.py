@@ -0,0 +1,1372 @@
+'''Convert the tables of the SRU ESE database'''
+import sqlite3
+import struct
+import logging
+import datetime
+import os
+import re
+import time
+import uuid
+import threading
+import multiprocessing
+import Queue
+import traceback
+import copy_reg
+import json
+import collections
+
+#Requires Metz' libesedb
+#https://github.com/libyal/libesedb
+#or you can find compiled python bindings for MacOSX and Window versions at
+#https://github.com/log2timeline/l2tbinaries
+from pyesedb import column_types as DBTYPES
+import pyesedb
+
+from SrumDb import DbConfig,DbHandler,BatchWriter,ShardedBatchWriter,GetBatches,GetPeakMemory
+from SrumDb import HIGH_WATER_TABLE,DEFAULT_PROGRESS_INTERVAL
+from SrumTimestamps import GetOleTimeStamp,GetWinTimeStamp,DecodeTimestamp,DecodeTimestampColumns
+
+#Bytes a converted value is estimated to take in the output db, with its#
+#share of the indexes#
+ESTIMATED_VALUE_SIZE = 16
+
+class SrumHandler():
+    '''A Handler for converting SRU to SQLite'''
+    GUID_TABLES = {
+        '{DD6636C4-8929-4683-974E-22C046A43763}':'NetworkConnectivityData',
+        '{D10CA2FE-6FCF-4F6D-848E-B2E99266FA89}':'ApplicationResourceUsageData',
+        '{973F5D5C-1D90-4944-BE8E-24B94231A174}':'NetworkUsageData',
+        '{D10CA2FE-6FCF-4F6D-848E-B2E99266FA86}':'EnergyUsageData',
+        '{FEE4E14F-02A9-4550-B5CE-5FA2DA202E37}':'WindowsPushNotificationData',
+        '{FEE4E14F-02A9-4550-B5CE-5FA2DA202E37}LT':'WindowsPushNotificationDataLT',
+    }
+    SQLITE_TYPE = {
+        'DATETIME':[
+            pyesedb.column_types.DATE_TIME
+        ],
+        'REAL':[
+            pyesedb.column_types.DOUBLE_64BIT,
+            pyesedb.column_types.FLOAT_32BIT
+        ],
+        'INTEGER':[
+            pyesedb.column_types.BOOLEAN,
+            pyesedb.column_types.INTEGER_16BIT_SIGNED,
+            pyesedb.column_types.INTEGER_16BIT_UNSIGNED,
+            pyesedb.column_types.INTEGER_32BIT_SIGNED,
+            pyesedb.column_types.INTEGER_32BIT_UNSIGNED,
+            pyesedb.column_types.INTEGER_64BIT_SIGNED,
+            pyesedb.column_types.INTEGER_8BIT_UNSIGNED
+        ],
+        'BLOB':[
+            pyesedb.column_types.BINARY_DATA,
+            pyesedb.column_types.LARGE_BINARY_DATA
+        ],
+        'TEXT':[
+            pyesedb.column_types.GUID,
+            pyesedb.column_types.LARGE_TEXT,
+            pyesedb.column_types.SUPER_LARGE_VALUE,
+            pyesedb.column_types.TEXT
+        ]
+    }
+    
+    #Output type of custom decoded columns#
+    CUSTOM_TYPE_MAPPING = {
+        'utf-16le':'TEXT',
+        'IdBlob':'TEXT'
+    }
+    
+    #Timestamp kind of the custom timestamp columns#
+    CUSTOM_TIMESTAMP_KINDS = {
+        'OleDatetime':'ole',
+        'WinDatetime':'filetime'
+    }
+    #Output type of timestamp columns for each --timestamp_format#
+    TIMESTAMP_FIELD_TYPES = {
+        'datetime':'DATETIME',
+        'iso':'TEXT',
+        'epoch':'INTEGER',
+        'filetime':'INTEGER'
+    }
+    
+    #Columns that only grow, in order of preference. In --incremental mode#
+    #only records above the last stored value are converted#
+    HIGH_WATER_COLUMNS = [
+        'AutoIncId',
+        'TimeStamp'
+    ]
+    HIGH_WATER_TABLE = HIGH_WATER_TABLE
+    
+    #Shards decoded or waiting to be written per worker. Shards finished#
+    #ahead of an unfinished earlier one are held in memory until it is done#
+    SHARDS_IN_FLIGHT_PER_WORKER = 2
+    
+    #struct formats of the fixed size column types#
+    STRUCT_FORMATS = {
+        pyesedb.column_types.DOUBLE_64BIT:'<d',
+        pyesedb.column_types.FLOAT_32BIT:'<f',
+        pyesedb.column_types.BOOLEAN:'<?',
+        pyesedb.column_types.INTEGER_8BIT_UNSIGNED:'<B',
+        pyesedb.column_types.INTEGER_16BIT_SIGNED:'<h',
+        pyesedb.column_types.INTEGER_16BIT_UNSIGNED:'<H',
+        pyesedb.column_types.INTEGER_32BIT_SIGNED:'<i',
+        pyesedb.column_types.INTEGER_32BIT_UNSIGNED:'<I',
+        pyesedb.column_types.INTEGER_64BIT_SIGNED:'<q'
+    }
+    
+    #If Columns have same name but need to be treated differently#
+    CUSTOM_TABLES = {
+        
+    }
+    #How to decode a special column#
+    CUSTOM_COLUMNS = {
+        'EventTimestamp':{
+            'type':'WinDatetime'
+        },
+        'ConnectStartTime':{
+            'type':'WinDatetime'
+        },
+        'LocaleName':{
+            'type':'utf-16le'
+        },
+        'Key':{
+            'type':'utf-16le'
+        },
+        'IdBlob':{
+            'type':'IdBlob'
+        }
+    }
+
+    def __init__(self,options):
+        '''Create a SrumHandler
+        
+        Args:
+            options: Options'''
+        self.options = options
+        self.srum_db = options.srum_db
+        self.output_db = options.output_db
+        self.batch_size = options.batch_size
+        self.workers = options.workers
+        self.shard_size = max(1,options.shard_size)
+        self.incremental = options.incremental_flag
+        self.pipeline_depth = options.pipeline_depth
+        self.timestamp_format = options.timestamp_format
+        self.write_sqlite = options.output_format in ['sqlite','both']
+        self.write_parquet = options.output_format in ['parquet','both']
+        self.parquet_path = os.path.join(options.outpath,'parquet')
+        
+        #Statistics are only collected with --stats#
+        self.stats = None
+        if options.stats_file is not None:
+            self.stats = ConversionStats(
+                options.progress_interval
+            )
+        
+        #Tables and decoder plans already resolved, by table index#
+        self.decode_cache = {}
+        
+        #Records written by ConvertDb#
+        self.record_count = 0
+        
+        self.esedb_file = pyesedb.file()
+        self.esedb_file.open(self.srum_db)
+        
+        self.outputDbConfig = DbConfig(
+            dbname=self.output_db
+        )
+        
+        self.outputDbHandler = DbHandler(
+            self.outputDbConfig
+        )
+        
+    def EstimateOutputSize(self):
+        '''Estimate the bytes of the SQLite output from the record and
+        column counts of the tables'''
+        size = 0
+        for table in self.esedb_file.tables:
+            size += table.get_number_of_records() * table.get_number_of_columns() * ESTIMATED_VALUE_SIZE
+            
+        return size
+        
+    def _CreateTableNameFromGuid(self,guid):
+        '''If you wanted to change the table name of a guid table'''
+        new_table_name = guid
+        
+        #new_table_name = new_table_name.replace('{','')
+        #new_table_name = new_table_name.replace('}','')
+        #new_table_name = new_table_name.replace('-','')
+        
+        return new_table_name
+        
+    def ConvertDb(self):
+        '''Convert SRU Database to a SQLite Database and/or Parquet files'''
+        if self.write_sqlite:
+            self._CheckTimestampFormat()
+            self.outputDbHandler.SetProfile('bulk_load')
+        try:
+            if self.workers > 1:
+                self._ConvertTablesParallel()
+            else:
+                for table in self.esedb_file.tables:
+                    self._ConvertTable(table)
+                    
+            if self.write_sqlite:
+                self._UpdateHighWaterMarks()
+                #Reports read the integer forms back in this format#
+                self.outputDbHandler.SetSetting(
+                    'timestamp_format',
+                    self.timestamp_format
+                )
+        finally:
+            if self.write_sqlite:
+                self.outputDbHandler.SetProfile('safe')
+                
+        if self.stats is not None:
+            self.stats.Write(
+                os.path.join(self.options.outpath,self.options.stats_file)
+            )
+            
+    def _CheckTimestampFormat(self):
+        '''Refuse to add to a db converted with another --timestamp_format.
+        Its timestamp columns would mix two forms and the high water marks
+        would not compare.'''
+        if not self.incremental:
+            return
+        
+        timestamp_format = self.outputDbHandler.GetSetting(
+            'timestamp_format'
+        )
+        if timestamp_format is not None and timestamp_format != self.timestamp_format:
+            msg = '{} was converted with --timestamp_format {}, --incremental runs must use the same format'.format(
+                self.output_db,
+                timestamp_format
+            )
+            logging.error(msg)
+            raise Exception(msg)
+        
+    def _GetTableName(self,table):
+        '''Get the output table name of a pyesedb table
+        
+        Args:
+            table: A pyesedb table object
+        Returns:
+            table_name: The name to use in the output db'''
+        #Enumerate if GUID Table#
+        table_name = table.name
+        if table_name in SrumHandler.GUID_TABLES:
+            table_name = SrumHandler.GUID_TABLES[table_name]
+            
+        ###Check if Table Name is GUID###
+        regexp = re.compile(r'^\{[0-9a-zA-Z]{8}\-[0-9a-zA-Z]{4}\-[0-9a-zA-Z]{4}\-[0-9a-zA-Z]{4}\-[0-9a-zA-Z]{12}\}')
+        if regexp.search(table_name) is not None:
+            table_name = self._CreateTableNameFromGuid(
+                table_name
+            )
+            
+        return table_name
+            
+    def _ConvertTable(self,table):
+        '''Convert a single table into the output db
+        
+        Args:
+            table: A pyesedb table object'''
+        self.table_name = self._GetTableName(table)
+        
+        print 'Converting Table {} as {}'.format(table.name,self.table_name)
+        
+        batchWriter = self._CreateBatchWriter(
+            table
+        )
+        
+        decoder_plan = self._CompileDecoderPlan(
+            table
+        )
+        timestamp_columns = self._GetTimestampColumns(
+            table
+        )
+        
+        table_stats = self._GetTableStats(
+            table
+        )
+        
+        high_water = self._GetHighWater(
+            table
+        )
+        
+        records = self._EnumerateRecords(table,decoder_plan,high_water,timestamp_columns,table_stats)
+        batches = (
+            self._DecodeTimestampColumns(batch,timestamp_columns,table_stats)
+            for batch in GetBatches(records,self.batch_size)
+        )
+        
+        #Decode on a reader thread while this thread writes#
+        pipeline = None
+        if self.pipeline_depth > 0:
+            pipeline = BatchPipeline(
+                batches,
+                self.pipeline_depth
+            )
+            batches = pipeline
+        
+        for batch in batches:
+            batchWriter.AddBatch(
+                batch
+            )
+            
+        batchWriter.Close()
+        self.record_count += batchWriter.record_count
+        
+        if pipeline is not None:
+            pipeline.PrintSummary()
+            if table_stats is not None:
+                table_stats['reader_seconds'] += pipeline.reader_seconds
+                table_stats['reader_wait_seconds'] += pipeline.reader_wait_seconds
+                table_stats['writer_wait_seconds'] += pipeline.writer_wait_seconds
+            
+    def _ConvertTablesParallel(self):
+        '''Convert the tables using self.workers worker processes. Every
+        worker opens its own pyesedb handle and decodes record ranges
+        (shards) of self.shard_size records, so a single large table is
+        spread over all workers. This process is the only writer of the
+        output db and writes the shards of a table in order, so the output
+        matches a sequential run. Shards are handed out in a window that
+        starts at the oldest unfinished shard, so a slow shard holds back
+        at most the window of shards after it.'''
+        batch_writers = {}
+        tables = []
+        for table_index in range(self.esedb_file.get_number_of_tables()):
+            table = self.esedb_file.get_table(table_index)
+            self.table_name = self._GetTableName(table)
+            
+            print 'Converting Table {} as {}'.format(table.name,self.table_name)
+            
+            record_count = table.get_number_of_records()
+            shards = []
+            for start in range(0,record_count,self.shard_size):
+                shards.append(
+                    (start,min(start + self.shard_size,record_count))
+                )
+            if not shards:
+                shards.append((0,0))
+            
+            batch_writers[table_index] = self._CreateBatchWriter(
+                table,
+                shard_count=len(shards)
+            )
+            
+            high_water = self._GetHighWater(
+                table
+            )
+            
+            tables.append(
+                (record_count,table_index,shards,high_water)
+            )
+        
+        #Start with the largest tables so they do not finish last#
+        tables.sort(reverse=True)
+        
+        #Bounded so decoding can not run far ahead of the writer#
+        result_queue = multiprocessing.Queue(self.workers * 4)
+        pool = multiprocessing.Pool(
+            self.workers,
+            _InitConvertWorker,
+            (self.options,result_queue)
+        )
+        
+        tasks = []
+        for record_count,table_index,shards,high_water in tables:
+            for shard_index,(start,stop) in enumerate(shards):
+                tasks.append(
+                    (table_index,shard_index,start,stop,high_water)
+                )
+        task_numbers = dict([
+            ((task[0],task[1]),task_number) for task_number,task in enumerate(tasks)
+        ])
+        window = self.workers * SrumHandler.SHARDS_IN_FLIGHT_PER_WORKER
+        
+        try:
+            async_results = []
+            finished_tasks = set()
+            oldest_task = 0
+            remaining = len(tables)
+            while True:
+                #Hand out the shards of the window#
+                while len(async_results) < min(len(tasks),oldest_task + window):
+                    async_results.append(
+                        pool.apply_async(
+                            _ConvertWorkerTask,
+                            tasks[len(async_results)]
+                        )
+                    )
+                    
+                if remaining <= 0:
+                    break
+                
+                try:
+                    kind,(table_index,shard_index),payload = result_queue.get(timeout=1)
+                except Queue.Empty:
+                    #A worker that died takes its task with it#
+                    if all([result.ready() for result in async_results]):
+                        raise Exception('Conversion workers exited with {} tables left'.format(remaining))
+                    continue
+                
+                if kind == 'batch':
+                    batch_writers[table_index].AddShardBatch(
+                        shard_index,
+                        payload
+                    )
+                elif kind == 'done':
+                    if payload is not None:
+                        #The decode statistics of the shard#
+                        self.stats.MergeTable(
+                            batch_writers[table_index].table_name,
+                            payload
+                        )
+                    if batch_writers[table_index].ShardDone(shard_index):
+                        remaining -= 1
+                        
+                    finished_tasks.add(task_numbers[(table_index,shard_index)])
+                    while oldest_task in finished_tasks:
+                        finished_tasks.remove(oldest_task)
+                        oldest_task += 1
+                else:
+                    msg = 'Worker failed to convert {} shard {}:\n{}'.format(
+                        batch_writers[table_index].table_name,
+                        shard_index,
+                        payload
+                    )
+                    logging.error(msg)
+                    raise Exception(msg)
+                    
+            pool.close()
+            pool.join()
+        except:
+            pool.terminate()
+            raise
+        
+        for batchWriter in batch_writers.values():
+            self.record_count += batchWriter.record_count
+        
+    def DecodeTableBatches(self,table_index,start=0,stop=None,high_water=None):
+        '''Generator that yields the decoded records of a table in batches
+        
+        Args:
+            table_index: The index of the table in the ESE file
+            start: The index of the first record to decode
+            stop: The index after the last record to decode [default: all]
+            high_water: Only decode records above this, see _GetHighWater
+        Yields:
+            batch: A list of up to self.batch_size records'''
+        if table_index not in self.decode_cache:
+            table = self.esedb_file.get_table(table_index)
+            self.table_name = self._GetTableName(table)
+            self.decode_cache[table_index] = (
+                table,
+                self.table_name,
+                self._CompileDecoderPlan(table),
+                self._GetTimestampColumns(table)
+            )
+        
+        table,self.table_name,decoder_plan,timestamp_columns = self.decode_cache[table_index]
+        table_stats = self._GetTableStats(
+            table
+        )
+        
+        if stop is None:
+            stop = table.get_number_of_records()
+        
+        records = (table.get_record(index) for index in xrange(start,stop))
+        records = self._EnumerateRecordList(records,decoder_plan,high_water,timestamp_columns,table_stats)
+        for batch in GetBatches(records,self.batch_size):
+            yield self._DecodeTimestampColumns(batch,timestamp_columns,table_stats)
+            
+    def _DecodeTimestampColumns(self,records,timestamp_columns,table_stats=None):
+        '''DecodeTimestampColumns in self.timestamp_format, timed into
+        table_stats when given'''
+        if table_stats is None:
+            return DecodeTimestampColumns(records,timestamp_columns,self.timestamp_format)
+        
+        start = time.time()
+        records = DecodeTimestampColumns(records,timestamp_columns,self.timestamp_format)
+        table_stats['timestamp_seconds'] += time.time() - start
+        return records
+        
+    def _GetTableStats(self,table):
+        '''Get the statistics a table's records are counted into
+        
+        Args:
+            table: A pyesedb table object
+        Returns:
+            table_stats: A dictionary from ConversionStats.GetTable, or None
+                without --stats'''
+        if self.stats is None:
+            return None
+        
+        timestamp_kinds = dict(self._GetTimestampColumns(table))
+        columns = []
+        for index,column in enumerate(table.columns):
+            if index in timestamp_kinds:
+                decoder = 'timestamp'
+            elif self._GetCustomInfo(column.name) is not None:
+                decoder = 'custom'
+            else:
+                decoder = 'type'
+            columns.append(
+                (column.name,decoder)
+            )
+            
+        return self.stats.GetTable(
+            self._GetTableName(table),
+            columns
+        )
+            
+    def _GetHighWater(self,table):
+        '''Get what selects the new records of a table in --incremental mode.
+        Tables without a high water column are emptied and converted again.
+        
+        Args:
+            table: A pyesedb table object
+        Returns:
+            high_water: A (column index, mark) tuple, or None to convert every
+                record'''
+        if not self.incremental:
+            return None
+        
+        table_name = self._GetTableName(table)
+        column_names = [column.name for column in table.columns]
+        for column_name in SrumHandler.HIGH_WATER_COLUMNS:
+            if column_name in column_names:
+                mark = self._GetHighWaterMark(
+                    table_name,
+                    column_name
+                )
+                if mark is None:
+                    return None
+                
+                print '  Converting {} records with {} above {}'.format(
+                    table_name,
+                    column_name,
+                    mark
+                )
+                return (column_names.index(column_name),mark)
+            
+        self.outputDbHandler.DeleteRecords(
+            table_name
+        )
+        
+        return None
+    
+    def _GetHighWaterMark(self,table_name,column_name):
+        '''Get the stored high water mark of a table. Falls back to the
+        highest value in the table for dbs converted without one.
+        
+        Returns:
+            mark: The high water key, or None if the table has no records'''
+        dbh = self.outputDbHandler.GetDbHandle()
+        self.outputDbHandler.CreateHighWaterTable()
+        
+        row = dbh.execute(
+            "SELECT HighWaterMark FROM '{}' WHERE TableName = ? AND ColumnName = ?".format(
+                SrumHandler.HIGH_WATER_TABLE
+            ),
+            (table_name,column_name)
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        
+        row = dbh.execute(
+            "SELECT MAX(\"{}\") FROM '{}'".format(column_name,table_name)
+        ).fetchone()
+        return GetHighWaterKey(row[0])
+    
+    def _UpdateHighWaterMarks(self):
+        '''Store the highest value of the high water column of every table'''
+        self.outputDbHandler.CreateHighWaterTable()
+        
+        rows = []
+        dbh = self.outputDbHandler.GetDbHandle()
+        for table in self.esedb_file.tables:
+            table_name = self._GetTableName(table)
+            column_names = [column.name for column in table.columns]
+            for column_name in SrumHandler.HIGH_WATER_COLUMNS:
+                if column_name in column_names:
+                    row = dbh.execute(
+                        "SELECT MAX(\"{}\") FROM '{}'".format(column_name,table_name)
+                    ).fetchone()
+                    if row[0] is not None:
+                        rows.append((
+                            table_name,
+                            column_name,
+                            GetHighWaterKey(row[0]),
+                            datetime.datetime.utcnow()
+                        ))
+                    break
+        
+        errors = self.outputDbHandler.BulkInsert(
+            SrumHandler.HIGH_WATER_TABLE,
+            rows,
+            ['TableName','ColumnName','HighWaterMark','LastUpdated'],
+            INSERT_STR='INSERT OR REPLACE'
+        )
+        self.outputDbHandler.LogInsertErrors(
+            SrumHandler.HIGH_WATER_TABLE,
+            errors
+        )
+    
+    def _EnumerateRecords(self,table,decoder_plan,high_water=None,timestamp_columns=[],table_stats=None):
+        '''Generator that yields the enumerated records of a table
+        
+        Args:
+            table: A pyesedb table object
+            decoder_plan: The table's plan from _CompileDecoderPlan
+            high_water: Only yield records above this, see _GetHighWater
+            timestamp_columns: The table's columns from _GetTimestampColumns
+            table_stats: The table's statistics from _GetTableStats
+        Yields:
+            values: the record as a tuple in column order, with raw
+                timestamp columns'''
+        return self._EnumerateRecordList(
+            table.records,
+            decoder_plan,
+            high_water,
+            timestamp_columns,
+            table_stats
+        )
+    
+    def _EnumerateRecordList(self,records,decoder_plan,high_water=None,timestamp_columns=[],table_stats=None):
+        '''Generator that yields the enumerated records of an iterable of
+        pyesedb records
+        
+        Args:
+            records: An iterable of pyesedb record objects
+            decoder_plan: The table's plan from _CompileDecoderPlan
+            high_water: Only yield records above this, see _GetHighWater
+            timestamp_columns: The table's columns from _GetTimestampColumns
+            table_stats: The table's statistics from _GetTableStats, or
+                None to not count anything
+        Yields:
+            values: the record as a tuple in column order, with raw
+                timestamp columns'''
+        if table_stats is None:
+            enumerate_record = self._EnumerateRecord
+        else:
+            enumerate_record = lambda decoder_plan,record: self._EnumerateRecordCounted(
+                decoder_plan,
+                record,
+                table_stats
+            )
+            
+        if high_water is None:
+            for record in records:
+                yield enumerate_record(
+                    decoder_plan,
+                    record
+                )
+            return
+        
+        #Only the key column is decoded for records that are skipped#
+        key_index,mark = high_water
+        key_decoder = decoder_plan[key_index][1]
+        timestamp_kinds = dict(timestamp_columns)
+        if key_index in timestamp_kinds:
+            #Compared in the form the marks were stored in#
+            key_decoder = lambda data,values: DecodeTimestamp(
+                data,
+                timestamp_kinds[key_index],
+                self.timestamp_format
+            )
+        for record in records:
+            data = record.get_value_data(key_index)
+            if data is not None and GetHighWaterKey(key_decoder(data,[])) <= mark:
+                continue
+            
+            yield enumerate_record(
+                decoder_plan,
+                record
+            )
+            
+    def _CreateBatchWriter(self,table,shard_count=None):
+        '''Create the outputs of a table and the BatchWriter that fills them
+        
+        Args:
+            table: A pyesedb table object
+            shard_count: The number of shards when decoded by workers
+        Returns:
+            batchWriter: A BatchWriter, or ShardedBatchWriter with shard_count'''
+        column_names = []
+        for column in table.columns:
+            column_names.append(column.name)
+            
+        dbHandler = None
+        if self.write_sqlite:
+            self._CreateTable(
+                table
+            )
+            dbHandler = self.outputDbHandler
+            
+        parquetWriter = None
+        if self.write_parquet:
+            parquetWriter = self._CreateParquetWriter(
+                table
+            )
+            
+        if shard_count is None:
+            return BatchWriter(
+                dbHandler,
+                self.table_name,
+                column_names,
+                batch_size=self.batch_size,
+                parquetWriter=parquetWriter,
+                stats=self.stats
+            )
+        
+        return ShardedBatchWriter(
+            dbHandler,
+            self.table_name,
+            column_names,
+            shard_count,
+            batch_size=self.batch_size,
+            parquetWriter=parquetWriter,
+            stats=self.stats
+        )
+    
+    def _CreateParquetWriter(self,table):
+        '''Create the Parquet file of a table. Every table is a directory
+        of part files, so --incremental runs add a part.
+        
+        Args:
+            table: A pyesedb table object
+        Returns:
+            parquetWriter: A ParquetTableWriter'''
+        column_names = []
+        field_mapping = self._CreateFieldMapping(
+            table
+        )
+        for column in table.columns:
+            column_names.append(column.name)
+            custom_info = self._GetCustomInfo(column.name)
+            if custom_info is not None and 'type' in custom_info:
+                if custom_info['type'] in SrumHandler.CUSTOM_TYPE_MAPPING:
+                    field_mapping[column.name] = SrumHandler.CUSTOM_TYPE_MAPPING[custom_info['type']]
+        
+        from SrumParquet import ParquetTableWriter,GetParquetPartName
+        
+        filename = GetParquetPartName(
+            self.parquet_path,
+            self.table_name,
+            clear_parts=not self.incremental
+        )
+        
+        return ParquetTableWriter(
+            filename,
+            column_names,
+            field_mapping
+        )
+    
+    def _GetCustomInfo(self,name):
+        '''Get the custom decoding info of a column of the current table
+        
+        Args:
+            name: The column name
+        Returns:
+            custom_info: The info from CUSTOM_TABLES or CUSTOM_COLUMNS, or None'''
+        ###CHECK FOR CUSTOM DEFINED TABLE COLUMNS TYPES###
+        if self.table_name in SrumHandler.CUSTOM_TABLES:
+            if name in SrumHandler.CUSTOM_TABLES[self.table_name]:
+                return SrumHandler.CUSTOM_TABLES[self.table_name][name]
+            
+        ###CHECK FOR CUSTOM DEFINED TABLE COLUMNS TYPES###
+        if name in SrumHandler.CUSTOM_COLUMNS:
+            return SrumHandler.CUSTOM_COLUMNS[name]
+        
+        return None
+    
+    def _CreateTable(self,table):
+        '''Create a table
+        
+        Args:
+            table: A pyesedb table object'''
+        column_names = []
+        for column in table.columns:
+            column_names.append(column.name)
+        
+        field_mapping = self._CreateFieldMapping(
+            table
+        )
+        
+        self.outputDbHandler.CreateTableFromMapping(
+            self.table_name,
+            field_mapping,
+            None,
+            column_names
+        )
+        
+        #An existing table may come from a different version of Windows#
+        self.outputDbHandler.AddMissingColumns(
+            self.table_name,
+            field_mapping,
+            column_names
+        )
+        
+    def _CreateFieldMapping(self,table):
+        '''Create a field mapping (table schema) for the SQLite table
+        
+        Args:
+            table: A pyesedb table object
+            
+        Return:
+            field_mapping: A dictionary of column to type mappings'''
+        field_mapping = {}
+        for column in table.columns:
+            key = column.name
+            
+            if column.type in SrumHandler.SQLITE_TYPE['TEXT']:
+                field_mapping[key] = 'TEXT'
+            elif column.type in SrumHandler.SQLITE_TYPE['BLOB']:
+                field_mapping[key] = 'BLOB'
+            elif column.type in SrumHandler.SQLITE_TYPE['INTEGER']:
+                field_mapping[key] = 'INTEGER'
+            elif column.type in SrumHandler.SQLITE_TYPE['REAL']:
+                field_mapping[key] = 'REAL'
+            elif column.type in SrumHandler.SQLITE_TYPE['DATETIME']:
+                field_mapping[key] = 'DATETIME'
+            else:
+                msg = 'Type not accounted for in table mapping creation: {}'.format(column.type)
+                logging.error(msg)
+                raise Exception(msg)
+                
+        column_names = [column.name for column in table.columns]
+        for index,kind in self._GetTimestampColumns(table):
+            field_mapping[column_names[index]] = SrumHandler.TIMESTAMP_FIELD_TYPES[self.timestamp_format]
+        
+        return field_mapping
+    
+    def _GetTimestampColumns(self,table):
+        '''Get the timestamp columns of a table. These are left raw by the
+        decoder plan and decoded a batch at a time by DecodeTimestampColumns.
+        
+        Args:
+            table: A pyesedb table object
+        Returns:
+            timestamp_columns: A list of (column index, kind) tuples where
+                kind is ole or filetime'''
+        timestamp_columns = []
+        for index,column in enumerate(table.columns):
+            custom_info = self._GetCustomInfo(column.name)
+            if custom_info is not None:
+                kind = SrumHandler.CUSTOM_TIMESTAMP_KINDS.get(custom_info.get('type',None),None)
+            elif column.type == DBTYPES.DATE_TIME:
+                kind = 'ole'
+            else:
+                kind = None
+                
+            if kind is not None:
+                timestamp_columns.append(
+                    (index,kind)
+                )
+                
+        return timestamp_columns
+    
+    def _CompileDecoderPlan(self,table):
+        '''Resolve how every column of a table is decoded. This is done once
+        per table so that decoding a record does no name, type or custom
+        column lookups.
+        
+        Args:
+            table: A pyesedb table object
+        Returns:
+            decoder_plan: A list of (index, decoder) tuples in column order.
+                A decoder is called as decoder(data, values) where values
+                is the list of the record's already decoded columns.'''
+        column_names = [column.name for column in table.columns]
+        timestamp_kinds = dict(self._GetTimestampColumns(table))
+        
+        decoder_plan = []
+        for index,column in enumerate(table.columns):
+            decoder = None
+            
+            if index in timestamp_kinds:
+                #Decoded a batch at a time by DecodeTimestampColumns#
+                decoder = lambda data,values: data
+            
+            custom_info = self._GetCustomInfo(column.name)
+            if decoder is None and custom_info is not None:
+                decoder = self._GetCustomDecoder(
+                    custom_info,
+                    column_names[:index]
+                )
+            
+            if decoder is None:
+                decoder = self._GetTypeDecoder(
+                    column.type
+                )
+            
+            decoder_plan.append(
+                (index,decoder)
+            )
+            
+        return decoder_plan
+    
+    def _GetTypeDecoder(self,dtype):
+        '''Get the decoder for a column type
+        
+        Args:
+            dtype: A pyesedb column type
+        Returns:
+            decoder: A decoder(data, values) callable'''
+        if dtype in SrumHandler.STRUCT_FORMATS:
+            unpack = struct.Struct(
+                SrumHandler.STRUCT_FORMATS[dtype]
+            ).unpack
+            return lambda data,values: unpack(data)[0]
+        elif dtype == DBTYPES.GUID:
+            return lambda data,values: str(uuid.UUID(bytes_le=data))
+        elif dtype in SrumHandler.SQLITE_TYPE['BLOB']:
+            return lambda data,values: sqlite3.Binary(data)
+        elif dtype in SrumHandler.SQLITE_TYPE['TEXT']:
+            return lambda data,values: data
+        elif dtype == DBTYPES.DATE_TIME:
+            return lambda data,values: GetOleTimeStamp(data)
+        
+        msg = 'UNKNOWN TYPE {}'.format(dtype)
+        logging.error(msg)
+        raise Exception(msg)
+    
+    def _GetCustomDecoder(self,custom_info,previous_columns):
+        '''Get a decoder for a column based off of defined criteria.
+        
+        Used to parse binary data within columns such as timestamps.
+        
+        Args:
+            custom_info: A columns info from SrumHandler.CUSTOM_COLUMNS
+            previous_columns: The names of the columns before this column
+        Returns:
+            decoder: A decoder(data, values) callable'''
+        decoder = lambda data,values: data
+        if 'type' in custom_info:
+            if custom_info['type'] == 'utf-16le':
+                decoder = lambda data,values: data.decode('utf-16le')
+            elif custom_info['type'] == 'OleDatetime':
+                decoder = lambda data,values: GetOleTimeStamp(data)
+            elif custom_info['type'] == 'WinDatetime':
+                decoder = lambda data,values: GetWinTimeStamp(data)
+            elif custom_info['type'] == 'IdBlob':
+                #IdTypes 0, 1 and 2 are strings, anything else (SIDs) is binary#
+                if 'IdType' in previous_columns:
+                    id_type_index = previous_columns.index('IdType')
+                    decoder = lambda data,values: (
+                        data.decode('utf-16le') if values[id_type_index] in (0,1,2)
+                        else sqlite3.Binary(data)
+                    )
+                else:
+                    decoder = lambda data,values: sqlite3.Binary(data)
+                
+        return decoder
+    
+    def _EnumerateRecord(self,decoder_plan,record):
+        '''Enumerate vales for a record
+        
+        Args:
+            decoder_plan: The table's plan from _CompileDecoderPlan
+            record: a pyesedb record object
+            
+        Returns:
+            values: the record as a tuple in column order'''
+        values = []
+        append = values.append
+        get_value_data = record.get_value_data
+        try:
+            for index,decoder in decoder_plan:
+                data = get_value_data(index)
+                if data is None:
+                    append(None)
+                else:
+                    append(decoder(data,values))
+        except Exception as error:
+            logging.error('Error decoding {}.{}: {}'.format(
+                self.table_name,
+                record.get_column_name(len(values)),
+                error
+            ))
+            raise
+            
+        return tuple(values)
+    
+    def _EnumerateRecordCounted(self,decoder_plan,record,table_stats):
+        '''_EnumerateRecord that also counts the values, bytes and read and
+        decode time of every column into table_stats'''
+        values = []
+        append = values.append
+        get_value_data = record.get_value_data
+        column_stats = table_stats['columns']
+        timer = time.time
+        record_start = timer()
+        try:
+            for index,decoder in decoder_plan:
+                start = timer()
+                data = get_value_data(index)
+                read = timer()
+                stats = column_stats[index]
+                stats['read_seconds'] += read - start
+                if data is None:
+                    append(None)
+                else:
+                    append(decoder(data,values))
+                    stats['decode_seconds'] += timer() - read
+                    stats['values'] += 1
+                    stats['bytes'] += len(data)
+        except Exception as error:
+            logging.error('Error decoding {}.{}: {}'.format(
+                self.table_name,
+                record.get_column_name(len(values)),
+                error
+            ))
+            raise
+        
+        table_stats['records'] += 1
+        table_stats['decode_seconds'] += timer() - record_start
+        return tuple(values)
+
+#Per process state of a conversion worker#
+_WORKER_HANDLER = None
+
+_WORKER_QUEUE = None
+
+def _InitConvertWorker(options,result_queue):
+    '''Open a pyesedb handle for this conversion worker process'''
+    global _WORKER_HANDLER,_WORKER_QUEUE
+    _WORKER_HANDLER = SrumHandler(
+        options
+    )
+    _WORKER_QUEUE = result_queue
+
+def _ConvertWorkerTask(table_index,shard_index,start,stop,high_water):
+    '''Decode a record range of a table and send its batches to the writer
+    process. Messages are (kind, (table_index, shard_index), payload) tuples.'''
+    shard = (table_index,shard_index)
+    try:
+        for batch in _WORKER_HANDLER.DecodeTableBatches(table_index,start,stop,high_water):
+            _WORKER_QUEUE.put(('batch',shard,batch))
+            
+        #The writer merges the decode statistics of every shard#
+        table_stats = None
+        if _WORKER_HANDLER.stats is not None:
+            table_stats = _WORKER_HANDLER.stats.PopTable(
+                _WORKER_HANDLER.table_name
+            )
+        _WORKER_QUEUE.put(('done',shard,table_stats))
+    except Exception:
+        _WORKER_QUEUE.put(('error',shard,traceback.format_exc()))
+
+def _ReduceBinary(blob):
+    '''Let sqlite3.Binary values be sent between processes'''
+    return (sqlite3.Binary,(str(blob),))
+
+copy_reg.pickle(type(sqlite3.Binary('')),_ReduceBinary)
+
+def GetHighWaterKey(value):
+    '''Return the comparable form of a high water column value. Datetimes
+    are compared in the text form SQLite stores them in.'''
+    if isinstance(value,datetime.datetime):
+        return str(value)
+    
+    return value
+
+class BatchPipeline():
+    '''Produce batches on a reader thread and hand them to the iterating
+    thread over a bounded queue, so decoding overlaps the writes of the
+    iterating thread. At most depth batches wait in the queue. The
+    iterating thread stays the only one that touches the output db.'''
+    def __init__(self,batches,depth):
+        '''Create a BatchPipeline
+        
+        Args:
+            batches: An iterable of batches, iterated on the reader thread
+            depth: The max number of batches waiting for the writer'''
+        self.batches = batches
+        self.queue = Queue.Queue(max(1,depth))
+        self.stopped = threading.Event()
+        
+        #Seconds the reader spent producing batches and waiting on a full#
+        #queue, and the writer spent waiting on an empty queue#
+        self.reader_seconds = 0.0
+        self.reader_wait_seconds = 0.0
+        self.writer_wait_seconds = 0.0
+        
+    def __iter__(self):
+        reader = threading.Thread(
+            target=self._Read,
+            name='SrumReader'
+        )
+        reader.daemon = True
+        reader.start()
+        
+        try:
+            while True:
+                start = time.time()
+                kind,payload = self.queue.get()
+                self.writer_wait_seconds += time.time() - start
+                
+                if kind == 'batch':
+                    yield payload
+                elif kind == 'done':
+                    break
+                else:
+                    msg = 'Reader thread failed:\n{}'.format(payload)
+                    logging.error(msg)
+                    raise Exception(msg)
+        finally:
+            #Let a reader blocked on a full queue see that it is stopped#
+            self.stopped.set()
+            reader.join()
+            
+    def _Read(self):
+        '''Put the batches on the queue, then a done or error message'''
+        try:
+            iterator = iter(self.batches)
+            while True:
+                start = time.time()
+                batch = next(iterator,None)
+                self.reader_seconds += time.time() - start
+                if batch is None:
+                    break
+                
+                if not self._Put(('batch',batch)):
+                    return
+                
+            self._Put(('done',None))
+        except Exception:
+            self._Put(('error',traceback.format_exc()))
+            
+    def _Put(self,message):
+        '''Put a message on the queue, waiting while it is full
+        
+        Returns:
+            False if the pipeline was stopped while waiting'''
+        start = time.time()
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(message,timeout=0.1)
+            except Queue.Full:
+                continue
+            
+            self.reader_wait_seconds += time.time() - start
+            return True
+        
+        return False
+    
+    def PrintSummary(self):
+        '''Print how long each stage waited on the other. The stage that
+        waited less is the bottleneck.'''
+        print '  decoded in {:.2f}s, decoding waited {:.2f}s on writes, writes waited {:.2f}s on decoding ({} bound)'.format(
+            self.reader_seconds,
+            self.reader_wait_seconds,
+            self.writer_wait_seconds,
+            'write' if self.reader_wait_seconds > self.writer_wait_seconds else 'decode'
+        )
+        
+class ConversionStats():
+    '''Counters of a conversion, kept per table and per column when --stats
+    is given. Tables are plain dictionaries so conversion workers can send
+    theirs to the writer process to be merged.'''
+    #Prometheus metrics as (name, type, help, table key or column key)#
+    TABLE_METRICS = [
+        ('srum_records_decoded_total','counter','Records decoded','records'),
+        ('srum_decode_seconds_total','counter','Seconds spent reading and decoding records','decode_seconds'),
+        ('srum_timestamp_decode_seconds_total','counter','Seconds spent decoding timestamp columns a batch at a time','timestamp_seconds'),
+        ('srum_custom_decode_seconds_total','counter','Seconds spent in custom column decoders','custom_seconds'),
+        ('srum_records_inserted_total','counter','Records written','inserted'),
+        ('srum_insert_batches_total','counter','Batches written','insert_batches'),
+        ('srum_insert_seconds_total','counter','Seconds spent writing batches','insert_seconds'),
+        ('srum_insert_max_batch_seconds','gauge','Seconds of the slowest batch write','insert_max_seconds'),
+        ('srum_pipeline_reader_seconds_total','counter','Seconds the reader thread spent producing batches','reader_seconds'),
+        ('srum_pipeline_reader_wait_seconds_total','counter','Seconds the reader thread waited for the writer','reader_wait_seconds'),
+        ('srum_pipeline_writer_wait_seconds_total','counter','Seconds the writer waited for the reader thread','writer_wait_seconds')
+    ]
+    COLUMN_METRICS = [
+        ('srum_column_values_decoded_total','counter','Non NULL values decoded','values'),
+        ('srum_column_bytes_read_total','counter','Bytes of value data read','bytes'),
+        ('srum_column_read_seconds_total','counter','Seconds spent reading value data','read_seconds'),
+        ('srum_column_decode_seconds_total','counter','Seconds spent in the column decoder','decode_seconds')
+    ]
+    
+    COLUMN_KEYS = ['name','decoder','values','bytes','read_seconds','decode_seconds']
+    
+    def __init__(self,progress_interval=DEFAULT_PROGRESS_INTERVAL):
+        '''Create ConversionStats
+        
+        Args:
+            progress_interval: The seconds between progress lines'''
+        self.progress_interval = progress_interval
+        self.tables = collections.OrderedDict()
+        self.start_time = time.time()
+        self.last_progress = self.start_time
+        
+    def GetTable(self,table_name,columns):
+        '''Get the statistics of a table, creating them on first use
+        
+        Args:
+            table_name: The output table name
+            columns: A list of (column name, decoder kind) tuples in column
+                order, the kind is type, custom or timestamp
+        Returns:
+            table_stats: A dictionary of the table counters, its columns
+                key is a list of column counter dictionaries in column
+                order'''
+        if table_name not in self.tables:
+            self.tables[table_name] = {
+                'records':0,
+                'decode_seconds':0.0,
+                'timestamp_seconds':0.0,
+                'inserted':0,
+                'insert_batches':0,
+                'insert_seconds':0.0,
+                'insert_max_seconds':0.0,
+                'reader_seconds':0.0,
+                'reader_wait_seconds':0.0,
+                'writer_wait_seconds':0.0,
+                'columns':[]
+            }
+            
+        table_stats = self.tables[table_name]
+        if columns and not table_stats['columns']:
+            #Writes can be counted before the columns are known#
+            table_stats['columns'] = [
+                {
+                    'name':name,
+                    'decoder':decoder,
+                    'values':0,
+                    'bytes':0,
+                    'read_seconds':0.0,
+                    'decode_seconds':0.0
+                } for name,decoder in columns
+            ]
+            
+        return table_stats
+    
+    def PopTable(self,table_name):
+        '''Remove and return the statistics of a table, or None'''
+        return self.tables.pop(table_name,None)
+    
+    def MergeTable(self,table_name,other):
+        '''Add the statistics of a table collected elsewhere
+        
+        Args:
+            table_name: The output table name
+            other: A table dictionary from another ConversionStats'''
+        table_stats = self.GetTable(
+            table_name,
+            [(column['name'],column['decoder']) for column in other['columns']]
+        )
+        for key,value in other.items():
+            if key == 'columns':
+                for column_stats,other_column in zip(table_stats['columns'],value):
+                    for column_key in ConversionStats.COLUMN_KEYS[2:]:
+                        column_stats[column_key] += other_column[column_key]
+            elif key == 'insert_max_seconds':
+                table_stats[key] = max(table_stats[key],value)
+            else:
+                table_stats[key] += value
+                
+    def AddInsert(self,table_name,record_count,elapsed):
+        '''Count a batch write of a table and print a progress line if one
+        is due'''
+        table_stats = self.GetTable(table_name,[])
+        table_stats['inserted'] += record_count
+        table_stats['insert_batches'] += 1
+        table_stats['insert_seconds'] += elapsed
+        table_stats['insert_max_seconds'] = max(table_stats['insert_max_seconds'],elapsed)
+        
+        now = time.time()
+        if now - self.last_progress >= self.progress_interval:
+            self.last_progress = now
+            self.PrintProgress(table_name)
+            
+    def PrintProgress(self,table_name):
+        '''Print the totals so far'''
+        decoded = sum([table['records'] for table in self.tables.values()])
+        inserted = sum([table['inserted'] for table in self.tables.values()])
+        elapsed = time.time() - self.start_time
+        logging.info('progress: {} {} decoded {} written ({:.0f} rows/sec) decode {:.2f}s insert {:.2f}s'.format(
+            table_name,
+            decoded,
+            inserted,
+            inserted / elapsed if elapsed > 0 else 0.0,
+            sum([table['decode_seconds'] for table in self.tables.values()]),
+            sum([table['insert_seconds'] for table in self.tables.values()])
+        ))
+        
+    def GetSummary(self):
+        '''Return the statistics as a dictionary with a tables list'''
+        tables = []
+        for table_name,table_stats in self.tables.items():
+            summary = collections.OrderedDict()
+            summary['table'] = table_name
+            for metric_name,metric_type,metric_help,key in ConversionStats.TABLE_METRICS:
+                summary[key] = self._GetTableValue(table_stats,key)
+            summary['columns'] = [
+                collections.OrderedDict(
+                    [(key,column[key]) for key in ConversionStats.COLUMN_KEYS]
+                ) for column in table_stats['columns']
+            ]
+            tables.append(summary)
+            
+        return collections.OrderedDict([
+            ('seconds',time.time() - self.start_time),
+            ('peak_memory',GetPeakMemory()),
+            ('tables',tables)
+        ])
+    
+    def _GetTableValue(self,table_stats,key):
+        '''Return a table counter, custom_seconds is summed from its
+        columns'''
+        if key == 'custom_seconds':
+            return sum([
+                column['decode_seconds'] for column in table_stats['columns']
+                if column['decoder'] == 'custom'
+            ])
+        return table_stats[key]
+    
+    def Write(self,filename):
+        '''Write the statistics to a JSON file, or to a Prometheus textfile
+        if filename ends in .prom. The file is replaced in one step so a
+        collector never reads it half written.'''
+        temp_filename = filename + '.tmp'
+        with open(temp_filename,'wb') as statsfh:
+            if filename.endswith('.prom'):
+                self._WritePrometheus(statsfh)
+            else:
+                json.dump(self.GetSummary(),statsfh,indent=2)
+                
+        if os.path.isfile(filename):
+            #rename does not replace files on Windows#
+            os.remove(filename)
+        os.rename(temp_filename,filename)
+        
+        logging.info('wrote conversion statistics to {}'.format(filename))
+        
+    def _WritePrometheus(self,statsfh):
+        '''Write the statistics in the Prometheus text format'''
+        for metric_name,metric_type,metric_help,key in ConversionStats.TABLE_METRICS:
+            statsfh.write('# HELP {} {}\n# TYPE {} {}\n'.format(metric_name,metric_help,metric_name,metric_type))
+            for table_name,table_stats in self.tables.items():
+                statsfh.write('{}{{table="{}"}} {}\n'.format(
+                    metric_name,
+                    GetPrometheusLabel(table_name),
+                    self._GetTableValue(table_stats,key)
+                ))
+                
+        for metric_name,metric_type,metric_help,key in ConversionStats.COLUMN_METRICS:
+            statsfh.write('# HELP {} {}\n# TYPE {} {}\n'.format(metric_name,metric_help,metric_name,metric_type))
+            for table_name,table_stats in self.tables.items():
+                for column in table_stats['columns']:
+                    statsfh.write('{}{{table="{}",column="{}",decoder="{}"}} {}\n'.format(
+                        metric_name,
+                        GetPrometheusLabel(table_name),
+                        GetPrometheusLabel(column['name']),
+                        column['decoder'],
+                        column[key]
+                    ))
+
+def GetPrometheusLabel(value):
+    '''Escape a Prometheus label value'''
+    return value.replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
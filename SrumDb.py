@@ -0,0 +1,1083 @@
+'''The output db, its id map and indexes, and the batched writes to it'''
+import sqlite3
+import logging
+import sys
+import os
+import time
+import itertools
+import threading
+import ntpath
+import shutil
+
+#resource is not available on Windows#
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from CustomSqlFunctions import ID_MAP_TABLE,RegisterFunctions,CloseIdResolvers,SidToString
+
+#Number of records held in memory before they are written to the output db#
+DEFAULT_BATCH_SIZE = 10000
+#Number of records of a table decoded by one worker task#
+DEFAULT_SHARD_SIZE = 50000
+#Number of batches decoded ahead of the writer by the reader thread#
+DEFAULT_PIPELINE_DEPTH = 4
+#Number of materialized query results kept between runs#
+DEFAULT_QUERY_CACHE_ENTRIES = 16
+#Seconds between --stats progress lines#
+DEFAULT_PROGRESS_INTERVAL = 10
+#Where the high water mark of each table is kept in the output db#
+HIGH_WATER_TABLE = 'SrumMonkeyHighWaterMarks'
+#Where db wide settings, such as the --timestamp_format, are kept#
+SETTINGS_TABLE = 'SrumMonkeySettings'
+#Older dbs kept their settings in HIGH_WATER_TABLE under this TableName#
+LEGACY_SETTINGS_TABLE_NAME = 'SrumMonkey'
+#Megabytes an output db staged with --stage_db is estimated to fit in#
+DEFAULT_STAGE_MEMORY_LIMIT = 2048
+
+class IdMapHandler():
+    '''Resolve SruDbIdMapTable once into the ID_MAP_TABLE lookup table, so
+    reports do not decode and basename the id blobs of every joined row.
+    The id_value() and id_name() SQL functions look ids up in it.'''
+    ID_MAP_COLUMN_MAPPING = {
+        'IdIndex':'INTEGER',
+        'IdType':'INTEGER',
+        'IdValue':'TEXT',
+        'IdName':'TEXT'
+    }
+    ID_MAP_COLUMN_ORDER = ['IdIndex','IdType','IdValue','IdName']
+    
+    def __init__(self,options):
+        self.options = options
+        
+        self.outputDbConfig = DbConfig(
+            dbname=self.options.output_db
+        )
+        
+        self.outputDbHandler = DbHandler(
+            self.outputDbConfig
+        )
+        
+    def HasIdMap(self):
+        '''Return True if the output db has a resolved id map'''
+        return ID_MAP_TABLE in self.outputDbHandler.GetTableNames()
+    
+    def BuildIdMap(self):
+        '''Create or rebuild the ID_MAP_TABLE from SruDbIdMapTable'''
+        if 'SruDbIdMapTable' not in self.outputDbHandler.GetTableNames():
+            logging.info('not resolving ids, there is no SruDbIdMapTable')
+            return
+        
+        rows = []
+        dbh = self.outputDbHandler.GetDbHandle()
+        for id_type,id_index,id_blob in dbh.execute("SELECT IdType, IdIndex, IdBlob FROM 'SruDbIdMapTable'"):
+            id_value,id_name = ResolveIdBlob(id_type,id_blob)
+            rows.append(
+                (id_index,id_type,id_value,id_name)
+            )
+            
+        self.outputDbHandler.CreateTableFromMapping(
+            ID_MAP_TABLE,
+            IdMapHandler.ID_MAP_COLUMN_MAPPING,
+            'PRIMARY KEY (IdIndex)',
+            IdMapHandler.ID_MAP_COLUMN_ORDER
+        )
+        
+        self.outputDbHandler.DeleteRecords(
+            ID_MAP_TABLE
+        )
+        
+        errors = self.outputDbHandler.BulkInsert(
+            ID_MAP_TABLE,
+            rows,
+            IdMapHandler.ID_MAP_COLUMN_ORDER,
+            INSERT_STR='INSERT OR REPLACE'
+        )
+        self.outputDbHandler.LogInsertErrors(
+            ID_MAP_TABLE,
+            errors
+        )
+        
+        #Lookups memoized before the rebuild are stale#
+        CloseIdResolvers(self.options.output_db)
+        
+        logging.info('resolved {} ids into {}'.format(len(rows),ID_MAP_TABLE))
+
+def ResolveIdBlob(id_type,id_blob):
+    '''Decode an IdBlob of SruDbIdMapTable
+    
+    Args:
+        id_type: The IdType. 0, 1 and 2 are strings (converted to text),
+            3 is a SID
+        id_blob: The converted IdBlob
+    Returns:
+        id_value: The app path, service name or SID string, or hex for
+            anything else
+        id_name: The base name of an app path, otherwise id_value'''
+    if id_blob is None:
+        return None,None
+    
+    if isinstance(id_blob,basestring):
+        id_value = id_blob.rstrip(u'\x00')
+        return id_value,ntpath.basename(id_value)
+    
+    id_value = None
+    if id_type == 3:
+        id_value = SidToString(id_blob)
+    if id_value is None:
+        id_value = str(id_blob).encode('hex')
+        
+    return id_value,id_value
+
+class IndexHandler():
+    '''Index the converted tables on the SRUM join keys and gather
+    statistics for the query planner. The ids of the hosts of a merged
+    fleet db collide, so there the indexes lead with the merge key.'''
+    #Columns the reports join and filter on. Every table that has one of#
+    #these gets an index on it, unless its primary key or another index#
+    #serves it already#
+    INDEX_COLUMNS = [
+        'AppId',
+        'UserId',
+        'IdIndex',
+        'TimeStamp',
+        'L2ProfileId',
+        'ProfileIndex'
+    ]
+    
+    def __init__(self,options):
+        self.options = options
+        
+        self.outputDbConfig = DbConfig(
+            dbname=self.options.output_db
+        )
+        
+        self.outputDbHandler = DbHandler(
+            self.outputDbConfig
+        )
+        
+    def BuildIndexes(self,template_indexes=[],analyze=True):
+        '''Create the join key indexes and the template indexes
+        
+        Args:
+            template_indexes: A list of {'table':name,'columns':[names]}
+            analyze: Run ANALYZE even if no index was created'''
+        merge_key = self.outputDbHandler.GetSetting('merge_key')
+        
+        created = 0
+        for table_name in self.outputDbHandler.GetTableNames():
+            columns = self.outputDbHandler.GetTableColumns(table_name)
+            key_columns = self._GetKeyColumns(merge_key,columns)
+            for column in IndexHandler.INDEX_COLUMNS:
+                if column in columns:
+                    #e.g. IdIndex, the INTEGER PRIMARY KEY of ID_MAP_TABLE#
+                    if self.outputDbHandler.IsIndexed(table_name,key_columns + [column]):
+                        continue
+                    
+                    if self.outputDbHandler.CreateIndex(table_name,key_columns + [column]):
+                        created += 1
+        
+        for index in template_indexes:
+            columns = self.outputDbHandler.GetTableColumns(index['table'])
+            missing = [column for column in index['columns'] if column not in columns]
+            if missing:
+                logging.warning('Not indexing {} on {}, no such columns: {}'.format(
+                    index['table'],
+                    index['columns'],
+                    missing
+                ))
+                continue
+            
+            key_columns = self._GetKeyColumns(merge_key,columns)
+            if self.outputDbHandler.IsIndexed(index['table'],key_columns + index['columns']):
+                continue
+            
+            if self.outputDbHandler.CreateIndex(index['table'],key_columns + index['columns']):
+                created += 1
+                
+        logging.info('created {} indexes'.format(created))
+        
+        if analyze or created > 0:
+            self.outputDbHandler.Analyze()
+            
+    def _GetKeyColumns(self,merge_key,columns):
+        '''Get the columns the indexes of a table lead with
+        
+        Args:
+            merge_key: The merge_key setting of the output db, or None
+            columns: The columns of the table
+        Returns:
+            key_columns: [merge_key] if the table has it, otherwise []'''
+        if merge_key is not None and merge_key in columns:
+            return [merge_key]
+        
+        return []
+
+def GetPeakMemory():
+    '''Return the peak resident memory of this process in bytes, or None
+    where it can not be measured'''
+    if resource is None:
+        return None
+    
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is in bytes on Mac OS X and in kilobytes elsewhere#
+    if sys.platform != 'darwin':
+        peak = peak * 1024
+        
+    return peak
+
+def FormatByteSize(size):
+    '''Return a human readable byte size'''
+    if size is None:
+        return 'unknown'
+    
+    for unit in ['B','KB','MB','GB']:
+        if size < 1024:
+            return '{:.1f}{}'.format(size,unit)
+        size = size / 1024.0
+        
+    return '{:.1f}TB'.format(size)
+
+def GetBatches(iterable,batch_size):
+    '''Generator that yields lists of up to batch_size items of iterable'''
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator,max(1,batch_size)))
+        if not batch:
+            return
+        yield batch
+
+class BatchWriter():
+    '''Buffer records for a table and write them to a DbHandler and/or a
+    ParquetTableWriter in fixed-size batches. Records are sequences in
+    column order.'''
+    #Seconds between progress lines#
+    PROGRESS_INTERVAL = 5
+    
+    def __init__(self,dbHandler,table_name,column_order,batch_size=DEFAULT_BATCH_SIZE,parquetWriter=None,stats=None):
+        '''Create a BatchWriter
+        
+        Args:
+            dbHandler: The DbHandler to write to, or None
+            table_name: The table to insert into
+            column_order: The column names in insert order
+            batch_size: The max number of records held before a write
+            parquetWriter: The ParquetTableWriter to write to, or None
+            stats: The ConversionStats to count writes in, or None'''
+        self.dbHandler = dbHandler
+        self.parquetWriter = parquetWriter
+        self.stats = stats
+        self.table_name = table_name
+        self.column_order = column_order
+        self.batch_size = max(1,batch_size)
+        
+        self.batch = []
+        self.record_count = 0
+        self.start_time = time.time()
+        self.last_progress = self.start_time
+        
+    def Add(self,record):
+        '''Add a record, writing the batch once it is full'''
+        self.batch.append(record)
+        if len(self.batch) >= self.batch_size:
+            self.Flush()
+            
+    def AddBatch(self,records):
+        '''Add a list of records, writing the batch once it is full'''
+        self.batch.extend(records)
+        if len(self.batch) >= self.batch_size:
+            self.Flush()
+            
+    def Flush(self):
+        '''Write the buffered records to the db'''
+        if not self.batch:
+            return
+        
+        start = time.time()
+        if self.dbHandler is not None:
+            errors = self.dbHandler.BulkInsert(
+                self.table_name,
+                self.batch,
+                self.column_order,
+                chunk_size=self.batch_size
+            )
+            self.dbHandler.LogInsertErrors(
+                self.table_name,
+                errors
+            )
+            
+        if self.parquetWriter is not None:
+            self.parquetWriter.Write(
+                self.batch
+            )
+        
+        now = time.time()
+        if self.stats is not None:
+            self.stats.AddInsert(
+                self.table_name,
+                len(self.batch),
+                now - start
+            )
+        
+        self.record_count += len(self.batch)
+        self.batch = []
+        
+        if now - self.last_progress >= BatchWriter.PROGRESS_INTERVAL:
+            self.last_progress = now
+            print '  {} records written to {} ({:.0f} rows/sec)'.format(
+                self.record_count,
+                self.table_name,
+                self.GetRate()
+            )
+            
+    def Close(self):
+        '''Write any remaining records and report the table throughput'''
+        self.Flush()
+        if self.parquetWriter is not None:
+            self.parquetWriter.Close()
+            
+        elapsed = time.time() - self.start_time
+        print '  {} records written to {} in {:.2f}s ({:.0f} rows/sec)'.format(
+            self.record_count,
+            self.table_name,
+            elapsed,
+            self.GetRate()
+        )
+        
+    def GetRate(self):
+        '''Return the records written per second so far'''
+        elapsed = time.time() - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return self.record_count / elapsed
+
+class ShardedBatchWriter(BatchWriter):
+    '''A BatchWriter for a table that is decoded in record ranges (shards)
+    by several workers. Batches of a shard are held back until every
+    earlier shard has been written, so rows are inserted in record order.'''
+    def __init__(self,dbHandler,table_name,column_order,shard_count,batch_size=DEFAULT_BATCH_SIZE,parquetWriter=None,stats=None):
+        '''Create a ShardedBatchWriter
+        
+        Args:
+            dbHandler: The DbHandler to write to, or None
+            table_name: The table to insert into
+            column_order: The column names in insert order
+            shard_count: The number of shards of the table
+            batch_size: The max number of records held before a write
+            parquetWriter: The ParquetTableWriter to write to, or None
+            stats: The ConversionStats to count writes in, or None'''
+        BatchWriter.__init__(
+            self,
+            dbHandler,
+            table_name,
+            column_order,
+            batch_size=batch_size,
+            parquetWriter=parquetWriter,
+            stats=stats
+        )
+        self.shard_count = shard_count
+        self.next_shard = 0
+        self.pending = {}
+        self.finished = set()
+        
+    def AddShardBatch(self,shard_index,records):
+        '''Add the records of a shard'''
+        if shard_index == self.next_shard:
+            self.AddBatch(records)
+        else:
+            self.pending.setdefault(shard_index,[]).append(records)
+            
+    def ShardDone(self,shard_index):
+        '''Mark a shard as fully decoded
+        
+        Returns:
+            True once every shard has been written and the writer closed'''
+        self.finished.add(shard_index)
+        while self.next_shard in self.finished:
+            self.next_shard += 1
+            for records in self.pending.pop(self.next_shard,[]):
+                self.AddBatch(records)
+                
+        if self.next_shard >= self.shard_count:
+            self.Close()
+            return True
+        
+        return False
+
+def ReplaceFile(source,target):
+    '''Rename source to target, replacing target. Windows can not rename
+    over an existing file, so there target is removed first.'''
+    if os.name == 'nt' and os.path.isfile(target):
+        os.remove(target)
+        
+    os.rename(source,target)
+
+class DbConfig():
+    '''This tells the DbHandler what to connect too'''
+    #Open handles keyed by (dbname, process id, thread id)#
+    CONNECTIONS = {}
+    CONNECTIONS_LOCK = threading.Lock()
+    #Dbs built somewhere else until DbHandler.PersistDb, by dbname. A#
+    #:memory: db only exists in the handle of the thread that staged it#
+    STAGED = {}
+    #Staged dbs that are copies of the db, swapped in for it when persisted#
+    STAGED_COPIES = set()
+    
+    def __init__(self,dbname=None,id_db=None):
+        '''Create a DbConfig
+        
+        Args:
+            dbname: The db file
+            id_db: The output db whose id map the id_value() and id_name()
+                functions of this db read [default: dbname]'''
+        self.db = dbname
+        self.id_db = id_db
+        if self.id_db is None:
+            self.id_db = dbname
+        
+    def GetConnection(self):
+        '''Get the handle for this db owned by the current process and thread.
+        The handle is created on first use and reused afterwards, so every
+        DbConfig pointing at the same db shares it.'''
+        key = (
+            self.db,
+            os.getpid(),
+            threading.current_thread().ident
+        )
+        
+        with DbConfig.CONNECTIONS_LOCK:
+            dbh = DbConfig.CONNECTIONS.get(key,None)
+            if dbh is None:
+                #check_same_thread is off only so CloseConnections can close#
+                #handles of other threads. A handle is never shared.#
+                dbh = sqlite3.connect(
+                    DbConfig.STAGED.get(self.db,self.db),
+                    timeout=10000,
+                    detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES,
+                    check_same_thread=False
+                )
+                
+                #Register User Functions#
+                RegisterFunctions(dbh,self.id_db)
+                
+                DbConfig.CONNECTIONS[key] = dbh
+                
+        return dbh
+    
+    def CloseConnection(self):
+        '''Close the handle of the current thread for this db'''
+        key = (
+            self.db,
+            os.getpid(),
+            threading.current_thread().ident
+        )
+        
+        with DbConfig.CONNECTIONS_LOCK:
+            dbh = DbConfig.CONNECTIONS.pop(key,None)
+            
+        if dbh is not None:
+            dbh.commit()
+            dbh.close()
+    
+    @staticmethod
+    def CloseConnections():
+        '''Close every handle opened by the current process'''
+        pid = os.getpid()
+        with DbConfig.CONNECTIONS_LOCK:
+            for key in DbConfig.CONNECTIONS.keys():
+                if key[1] != pid:
+                    continue
+                dbh = DbConfig.CONNECTIONS.pop(key)
+                dbh.commit()
+                dbh.close()
+                
+        CloseIdResolvers()
+
+class DbHandler():
+    #PRAGMAs applied by SetProfile, in order#
+    PRAGMA_PROFILES = {
+        #Used while converting. The output is rebuilt on every run, or#
+        #an --incremental run converts into a copy of it that is thrown#
+        #away if the run fails, so durability is traded for speed#
+        'bulk_load':[
+            ('locking_mode','EXCLUSIVE'),
+            ('journal_mode','OFF'),
+            ('synchronous','OFF'),
+            ('cache_size','-262144'),
+            ('temp_store','MEMORY')
+        ],
+        #Used for reporting and anything else that reads the output db#
+        'safe':[
+            ('locking_mode','NORMAL'),
+            ('journal_mode','DELETE'),
+            ('synchronous','FULL'),
+            ('cache_size','-2000'),
+            ('temp_store','DEFAULT')
+        ],
+        #Used by report workers, which must never write#
+        'read_only':[
+            ('query_only','ON')
+        ]
+    }
+    
+    def __init__(self,db_config,table=None):
+        #Db Flags#
+        self.db_config = db_config
+        
+    def CreateTableFromMapping(self,tbl_name,field_mapping,primary_key_str,field_order):
+        dbh = self.GetDbHandle()
+        
+        string = "CREATE TABLE IF NOT EXISTS '{0:s}' (\n".format(tbl_name)
+        for field in field_order:
+            string += "'{0:s}' {1:s},\n".format(
+                field,
+                field_mapping[field]
+            )
+        
+        if primary_key_str is not None:
+            string = string + primary_key_str
+        else:
+            string = string[0:-2]
+        
+        string = string + ')'
+        
+        cursor = dbh.cursor()
+        
+        cursor.execute(string)
+        
+    def GetTableColumns(self,tbl_name):
+        '''Get the column names of a table
+        
+        Args:
+            tbl_name: The table name
+        Returns:
+            columns: A list of column names, empty if there is no such table'''
+        dbh = self.GetDbHandle()
+        cursor = dbh.execute(
+            "PRAGMA table_info('{}')".format(tbl_name)
+        )
+        
+        return [row[1] for row in cursor.fetchall()]
+    
+    def AddMissingColumns(self,tbl_name,field_mapping,field_order):
+        '''Add the columns of field_order that an existing table lacks
+        
+        Args:
+            tbl_name: The table name
+            field_mapping: A dictionary of column to type mappings
+            field_order: The column names'''
+        existing = self.GetTableColumns(tbl_name)
+        dbh = self.GetDbHandle()
+        for field in field_order:
+            if field not in existing:
+                dbh.execute(
+                    "ALTER TABLE '{0:s}' ADD COLUMN '{1:s}' {2:s}".format(
+                        tbl_name,
+                        field,
+                        field_mapping[field]
+                    )
+                )
+        
+    def GetTableNames(self):
+        '''Get the names of the tables in the db'''
+        dbh = self.GetDbHandle()
+        cursor = dbh.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        )
+        
+        return [row[0] for row in cursor.fetchall()]
+    
+    def IsIndexed(self,tbl_name,columns):
+        '''Check if lookups on columns of a table are served already, by
+        an INTEGER PRIMARY KEY (the rowid) or by an index that leads with
+        them
+        
+        Args:
+            tbl_name: The table name
+            columns: A list of column names
+        Returns:
+            True if another index on columns would be redundant'''
+        dbh = self.GetDbHandle()
+        
+        primary_key = [
+            (row[1],row[2].upper()) for row in dbh.execute(
+                "PRAGMA table_info('{}')".format(tbl_name)
+            ) if row[5] > 0
+        ]
+        if len(columns) == 1 and primary_key == [(columns[0],'INTEGER')]:
+            return True
+        
+        for index_row in dbh.execute("PRAGMA index_list('{}')".format(tbl_name)).fetchall():
+            #Partial indexes do not hold every row#
+            if len(index_row) > 4 and index_row[4]:
+                continue
+            
+            index_columns = [
+                row[2] for row in sorted(dbh.execute(
+                    "PRAGMA index_info('{}')".format(index_row[1])
+                ))
+            ]
+            if index_columns[0:len(columns)] == columns:
+                return True
+            
+        return False
+    
+    def CreateIndex(self,tbl_name,columns):
+        '''Create an index on columns of a table if it does not exist
+        
+        Args:
+            tbl_name: The table name
+            columns: A list of column names
+        Returns:
+            True if the index was created'''
+        index_name = 'idx_{}_{}'.format(
+            tbl_name,
+            '_'.join(columns)
+        )
+        
+        dbh = self.GetDbHandle()
+        row = dbh.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name = ?",
+            (index_name,)
+        ).fetchone()
+        if row is not None:
+            return False
+        
+        dbh.execute(
+            "CREATE INDEX '{}' ON '{}' ({})".format(
+                index_name,
+                tbl_name,
+                ', '.join(["'{}'".format(column) for column in columns])
+            )
+        )
+        dbh.commit()
+        
+        return True
+    
+    def Analyze(self):
+        '''Gather statistics for the query planner'''
+        dbh = self.GetDbHandle()
+        dbh.execute('ANALYZE')
+        dbh.commit()
+        
+    def DeleteRecords(self,tbl_name):
+        '''Delete every record of a table if it exists
+        
+        Args:
+            tbl_name: The table name'''
+        dbh = self.GetDbHandle()
+        if self.GetTableColumns(tbl_name):
+            dbh.execute(
+                "DELETE FROM '{}'".format(tbl_name)
+            )
+            dbh.commit()
+        
+    def CreateInsertString(self,table,column_order,INSERT_STR=None):
+        '''Create the INSERT statement for a table. This only depends on
+        the column order, so it is built once per table and reused for
+        every row.
+        
+        Args:
+            table: The table to insert into
+            column_order: The column names in insert order
+            INSERT_STR: The insert verb [default: INSERT OR IGNORE]
+        Returns:
+            sql: The parameterized insert statement'''
+        columns = ', '.join(
+            ["'{}'".format(column) for column in column_order]
+        )
+        placeholders = ','.join('?' * len(column_order))
+        
+        if INSERT_STR is None:
+            INSERT_STR = 'INSERT OR IGNORE'
+        
+        sql = '{} INTO \'{}\' ({}) VALUES ({})'.format(INSERT_STR,table,columns,placeholders)
+        
+        return sql
+    
+    def RowsFromDicts(self,rows,column_order):
+        '''Generator that converts dict rows into tuples in column order.
+        Keys missing from a row are inserted as None.
+        
+        Args:
+            rows: An iterable of dictionaries
+            column_order: The column names in insert order'''
+        for row in rows:
+            get = row.get
+            yield tuple([get(key) for key in column_order])
+    
+    def InsertFromListOfDicts(self,table,rows_to_insert,column_order,INSERT_STR=None):
+        '''Insert dictionaries into a table. Errors are printed.
+        
+        Args:
+            table: The table to insert into
+            rows_to_insert: An iterable of dictionaries
+            column_order: The column names in insert order
+            INSERT_STR: The insert verb [default: INSERT OR IGNORE]
+        Returns:
+            errors: The error report from BulkInsert'''
+        errors = self.BulkInsert(
+            table,
+            self.RowsFromDicts(rows_to_insert,column_order),
+            column_order,
+            INSERT_STR=INSERT_STR
+        )
+        
+        self.LogInsertErrors(
+            table,
+            errors
+        )
+            
+        return errors
+    
+    def LogInsertErrors(self,table,errors):
+        '''Print the error report of BulkInsert
+        
+        Args:
+            table: The table that was inserted into
+            errors: The error report'''
+        for error in errors:
+            print "[ERROR] {}\n[TABLE] {}\n[ROW] {}".format(
+                error['error'],
+                table,
+                str(error['values'])
+            )
+    
+    def BulkInsert(self,table,rows,column_order,INSERT_STR=None,chunk_size=DEFAULT_BATCH_SIZE):
+        '''Insert rows with executemany, committing one transaction per chunk.
+        
+        A chunk that fails is rolled back and split in half until the
+        failing rows are isolated, so the good rows of that chunk are
+        still inserted.
+        
+        Args:
+            table: The table to insert into
+            rows: An iterable of sequences in column_order
+            column_order: The column names in insert order
+            INSERT_STR: The insert verb [default: INSERT OR IGNORE]
+            chunk_size: The number of rows per transaction
+        Returns:
+            errors: A list of dictionaries with the keys row (the row
+                number within rows), error and values'''
+        dbh = self.GetDbHandle()
+        sql_c = dbh.cursor()
+        
+        sql = self.CreateInsertString(
+            table,
+            column_order,
+            INSERT_STR=INSERT_STR
+        )
+        
+        errors = []
+        rows = iter(rows)
+        row_number = 0
+        while True:
+            chunk = list(itertools.islice(rows,max(1,chunk_size)))
+            if not chunk:
+                break
+            
+            self._InsertChunk(
+                dbh,
+                sql_c,
+                sql,
+                chunk,
+                row_number,
+                errors
+            )
+            row_number += len(chunk)
+        
+        return errors
+    
+    def _InsertChunk(self,dbh,sql_c,sql,chunk,first_row,errors):
+        '''Insert a chunk of rows in one transaction
+        
+        Args:
+            dbh: The database handle
+            sql_c: A cursor of dbh
+            sql: The insert statement
+            chunk: A list of row sequences
+            first_row: The row number of the first row in chunk
+            errors: The error report to append to'''
+        try:
+            sql_c.executemany(sql,chunk)
+            dbh.commit()
+        except (sqlite3.Error,OverflowError,ValueError) as error:
+            dbh.rollback()
+            if len(chunk) == 1:
+                errors.append({
+                    'row':first_row,
+                    'error':str(error),
+                    'values':chunk[0]
+                })
+                return
+            
+            middle = len(chunk) // 2
+            self._InsertChunk(dbh,sql_c,sql,chunk[:middle],first_row,errors)
+            self._InsertChunk(dbh,sql_c,sql,chunk[middle:],first_row+middle,errors)
+    
+    def MergeDb(self,db_name,key_column,key_value,skip_tables=[]):
+        '''Append the tables of another db to the tables of this one, with
+        a key column telling the rows of each db apart. Tables and columns
+        missing here are created.
+        
+        Args:
+            db_name: The db file to merge
+            key_column: The name of the key column
+            key_value: The key column value of the merged rows
+            skip_tables: Tables not to merge'''
+        dbh = self.GetDbHandle()
+        dbh.commit()
+        dbh.execute(
+            "ATTACH DATABASE ? AS merge_db",
+            (db_name,)
+        )
+        try:
+            tables = dbh.execute(
+                "SELECT name FROM merge_db.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            ).fetchall()
+            
+            for (tbl_name,) in tables:
+                if tbl_name in skip_tables:
+                    continue
+                
+                field_mapping = {key_column:'TEXT'}
+                field_order = [key_column]
+                for column_info in dbh.execute("PRAGMA merge_db.table_info('{}')".format(tbl_name)):
+                    field_mapping[column_info[1]] = column_info[2] or 'BLOB'
+                    field_order.append(column_info[1])
+                    
+                self.CreateTableFromMapping(
+                    tbl_name,
+                    field_mapping,
+                    None,
+                    field_order
+                )
+                self.AddMissingColumns(
+                    tbl_name,
+                    field_mapping,
+                    field_order
+                )
+                
+                column_str = ', '.join(['"{}"'.format(column) for column in field_order[1:]])
+                dbh.execute(
+                    'INSERT INTO main."{0}" ("{1}", {2}) SELECT ?, {2} FROM merge_db."{0}"'.format(
+                        tbl_name,
+                        key_column,
+                        column_str
+                    ),
+                    (key_value,)
+                )
+                
+            dbh.commit()
+        except:
+            dbh.rollback()
+            raise
+        finally:
+            dbh.execute("DETACH DATABASE merge_db")
+        
+    def CreateHighWaterTable(self):
+        '''Create HIGH_WATER_TABLE if it does not exist'''
+        self.CreateTableFromMapping(
+            HIGH_WATER_TABLE,
+            {
+                'TableName':'TEXT',
+                'ColumnName':'TEXT',
+                'HighWaterMark':'',
+                'LastUpdated':'DATETIME'
+            },
+            'PRIMARY KEY (TableName, ColumnName)',
+            ['TableName','ColumnName','HighWaterMark','LastUpdated']
+        )
+        
+    def GetSetting(self,name):
+        '''Get a db wide setting stored with SetSetting. Dbs converted
+        before SETTINGS_TABLE existed are read from HIGH_WATER_TABLE.
+        
+        Args:
+            name: The setting name
+        Returns:
+            value: The setting value, or None if it is not set'''
+        dbh = self.GetDbHandle()
+        if self.GetTableColumns(SETTINGS_TABLE):
+            row = dbh.execute(
+                "SELECT Value FROM '{}' WHERE Name = ?".format(SETTINGS_TABLE),
+                (name,)
+            ).fetchone()
+            if row is not None:
+                return row[0]
+            
+        if self.GetTableColumns(HIGH_WATER_TABLE):
+            row = dbh.execute(
+                "SELECT HighWaterMark FROM '{}' WHERE TableName = ? AND ColumnName = ?".format(
+                    HIGH_WATER_TABLE
+                ),
+                (LEGACY_SETTINGS_TABLE_NAME,name)
+            ).fetchone()
+            if row is not None:
+                return row[0]
+            
+        return None
+    
+    def SetSetting(self,name,value):
+        '''Store a db wide setting, such as the --timestamp_format the db
+        was converted with
+        
+        Args:
+            name: The setting name
+            value: The setting value'''
+        self.CreateTableFromMapping(
+            SETTINGS_TABLE,
+            {
+                'Name':'TEXT',
+                'Value':''
+            },
+            'PRIMARY KEY (Name)',
+            ['Name','Value']
+        )
+        
+        dbh = self.GetDbHandle()
+        dbh.execute(
+            "INSERT OR REPLACE INTO '{}' (Name, Value) VALUES (?,?)".format(
+                SETTINGS_TABLE
+            ),
+            (name,value)
+        )
+        
+        #The setting moves out of HIGH_WATER_TABLE of an older db#
+        if self.GetTableColumns(HIGH_WATER_TABLE):
+            dbh.execute(
+                "DELETE FROM '{}' WHERE TableName = ? AND ColumnName = ?".format(
+                    HIGH_WATER_TABLE
+                ),
+                (LEGACY_SETTINGS_TABLE_NAME,name)
+            )
+        dbh.commit()
+        
+    def CreateView(self,view_str):
+        dbh = self.GetDbHandle()
+        cursor = dbh.cursor()
+        
+        cursor.execute(view_str)
+        dbh.commit()
+    
+    def GetDbHandle(self):
+        '''Get the pooled database handle based off of databaseinfo'''
+        return self.db_config.GetConnection()
+    
+    @staticmethod
+    def CanStage():
+        '''Return True if a staged db can be persisted, which needs
+        VACUUM INTO (SQLite 3.27)'''
+        return sqlite3.sqlite_version_info >= (3,27,0)
+    
+    def StageDb(self,stage_path,copy=False):
+        '''Build this db in stage_path instead of in place until PersistDb.
+        Must be called before the db is first used.
+        
+        Args:
+            stage_path: ':memory:' or a file, e.g. on a tmpfs
+            copy: Start from a copy of the db in stage_path, a file on the
+                same file system, which PersistDb swaps in for the db'''
+        if copy:
+            if os.path.isfile(self.db_config.db):
+                shutil.copyfile(self.db_config.db,stage_path)
+            DbConfig.STAGED_COPIES.add(self.db_config.db)
+            
+        DbConfig.STAGED[self.db_config.db] = stage_path
+        
+    def PersistDb(self):
+        '''Write a staged db to its own name in one pass, and drop the staged
+        copy even if that fails. A copy of the db is swapped in for it with
+        a rename, anything else is written with VACUUM INTO.'''
+        stage_path = DbConfig.STAGED.get(self.db_config.db,None)
+        if stage_path is None:
+            return
+        
+        start = time.time()
+        try:
+            dbh = self.GetDbHandle()
+            dbh.commit()
+            
+            if self.db_config.db in DbConfig.STAGED_COPIES:
+                #The db is replaced in one step, never left half written#
+                self.db_config.CloseConnection()
+                ReplaceFile(
+                    stage_path,
+                    self.db_config.db
+                )
+            else:
+                if os.path.isfile(self.db_config.db):
+                    os.remove(self.db_config.db)
+                
+                dbh.execute(
+                    'VACUUM INTO ?',
+                    (self.db_config.db,)
+                )
+        finally:
+            self.DiscardStagedDb()
+            
+        logging.info('persisted {} from {} in {:.2f}s'.format(
+            self.db_config.db,
+            stage_path,
+            time.time() - start
+        ))
+    
+    def DiscardStagedDb(self):
+        '''Close and delete the staged copy of this db, if it is still
+        staged. A staged file on a tmpfs holds on to memory until then.'''
+        stage_path = DbConfig.STAGED.get(self.db_config.db,None)
+        if stage_path is None:
+            return
+        
+        #Handles opened from here on use the db itself#
+        self.db_config.CloseConnection()
+        del DbConfig.STAGED[self.db_config.db]
+        DbConfig.STAGED_COPIES.discard(self.db_config.db)
+        if stage_path != ':memory:' and os.path.isfile(stage_path):
+            os.remove(stage_path)
+    
+    def SetProfile(self,profile_name):
+        '''Apply a set of PRAGMAs from DbHandler.PRAGMA_PROFILES
+        
+        Args:
+            profile_name: A key of DbHandler.PRAGMA_PROFILES'''
+        dbh = self.GetDbHandle()
+        dbh.commit()
+        
+        for pragma,value in DbHandler.PRAGMA_PROFILES[profile_name]:
+            dbh.execute(
+                'PRAGMA {}={}'.format(pragma,value)
+            ).fetchall()
+            
+        #Leaving exclusive locking mode only releases the lock on the#
+        #next access of the db#
+        dbh.execute('SELECT count(*) FROM sqlite_master').fetchall()
+    
+    def FetchRecords(self,sql_string):
+        dbh = self.GetDbHandle()
+        
+        column_names = []
+        
+        sql_c = dbh.cursor()
+        
+        sql_c.execute(sql_string)
+        
+        for desc in sql_c.description:
+            column_names.append(
+                desc[0]
+            )
+        
+        
+        for record in sql_c:
+            yield column_names,record
+    
+    def GetColumnInfo(self,sql_string):
+        dbh = self.GetDbHandle()
+        
+        sql_c = dbh.cursor()
+        sql_c.row_factory = sqlite3.Row
+        
+        sql_c.execute(sql_string)
+        
+        row = sql_c.fetchone()
@@ -15,34 +15,25 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 import sqlite3
-import struct
 import logging
-import datetime
 import sys
 import os
 import re
 import argparse
 import copy
-import xlsxwriter
-import yaml
+import time
+import multiprocessing
+import traceback
+import csv
+import tempfile
 
-logging.basicConfig(
-    level = logging.DEBUG
-)
-
-#Import our custom SQLite user functions#
-from CustomSqlFunctions import *
-
-#Requires Metz' libesedb
-#https://github.com/libyal/libesedb
-#or you can find compiled python bindings for MacOSX and Window versions at
-#https://github.com/log2timeline/l2tbinaries
-from pyesedb import column_types as DBTYPES
-import pyesedb
-
-#Requires installing python-registry
-#https://github.com/williballenthin/python-registry
-from Registry import *
+#The conversion, registry and report modules are imported when their#
+#stage runs, so a conversion only run never loads the report libraries#
+#and a report only run never loads libesedb#
+from SrumDb import DbConfig,DbHandler,IdMapHandler,IndexHandler,HIGH_WATER_TABLE,SETTINGS_TABLE
+from SrumDb import DEFAULT_BATCH_SIZE,DEFAULT_SHARD_SIZE,DEFAULT_QUERY_CACHE_ENTRIES,DEFAULT_PROGRESS_INTERVAL
+from SrumDb import DEFAULT_STAGE_MEMORY_LIMIT,DEFAULT_PIPELINE_DEPTH
+from CustomSqlFunctions import MERGE_KEY_COLUMN
 
 def GetOptions():
     '''Get needed options for processesing'''
@@ -83,6 +74,33 @@ def GetOptions():
         help='SOFTWARE Hive for Interface Enumeration'
     )
     
+    options.add_argument(
+        '--fleet',
+        dest='fleet',
+        action="store",
+        type=unicode,
+        default=None,
+        help='Convert many hosts. A folder with a folder per host holding SRUDB.dat and SOFTWARE, or a CSV manifest with host,srum_db,software_hive columns'
+    )
+    
+    options.add_argument(
+        '--fleet_workers',
+        dest='fleet_workers',
+        action="store",
+        type=int,
+        default=1,
+        help='With --fleet, the number of hosts converted at the same time [default: 1]'
+    )
+    
+    options.add_argument(
+        '--fleet_output',
+        dest='fleet_output',
+        action="store",
+        choices=['per_host','merged'],
+        default='per_host',
+        help='With --fleet, write a db and reports per host, or merge the hosts into one db with a host column [default: per_host]'
+    )
+    
     options.add_argument(
         '--no_reports',
         dest='report_flag',
@@ -99,6 +117,145 @@ def GetOptions():
         help='Do not run reports'
     )
     
+    options.add_argument(
+        '--batch_size',
+        dest='batch_size',
+        action="store",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help='Number of records to buffer before writing them to the output db [default: {}]'.format(DEFAULT_BATCH_SIZE)
+    )
+    
+    options.add_argument(
+        '--output_format',
+        dest='output_format',
+        action="store",
+        choices=['sqlite','parquet','both'],
+        default='sqlite',
+        help='Convert to SQLite, to a Parquet file per table (requires pyarrow) or to both [default: sqlite]'
+    )
+    
+    options.add_argument(
+        '--timestamp_format',
+        dest='timestamp_format',
+        action="store",
+        choices=['datetime','iso','epoch','filetime'],
+        default='datetime',
+        help='Store timestamps as datetimes, ISO 8601 text, INTEGER epoch microseconds or INTEGER FILETIMEs. The format is stored in the output db, reports read it from there and --incremental runs must use the same one [default: datetime]'
+    )
+    
+    options.add_argument(
+        '--pipeline_depth',
+        dest='pipeline_depth',
+        action="store",
+        type=int,
+        default=DEFAULT_PIPELINE_DEPTH,
+        help='Without --workers, the number of batches a reader thread decodes ahead of the writer, 0 decodes and writes in turn on one thread [default: {}]'.format(DEFAULT_PIPELINE_DEPTH)
+    )
+    
+    options.add_argument(
+        '--workers',
+        dest='workers',
+        action="store",
+        type=int,
+        default=1,
+        help='Number of processes used to decode tables [default: 1]'
+    )
+    
+    options.add_argument(
+        '--shard_size',
+        dest='shard_size',
+        action="store",
+        type=int,
+        default=DEFAULT_SHARD_SIZE,
+        help='With --workers, the number of records of a table decoded per worker task [default: {}]'.format(DEFAULT_SHARD_SIZE)
+    )
+    
+    options.add_argument(
+        '--report_workers',
+        dest='report_workers',
+        action="store",
+        type=int,
+        default=1,
+        help='Number of reports to run at the same time [default: 1]'
+    )
+    
+    options.add_argument(
+        '--no_query_cache',
+        dest='query_cache_flag',
+        action="store_false",
+        default=True,
+        help='Do not cache the results of queries that several templates share'
+    )
+    
+    options.add_argument(
+        '--query_cache_entries',
+        dest='query_cache_entries',
+        action="store",
+        type=int,
+        default=DEFAULT_QUERY_CACHE_ENTRIES,
+        help='Number of query results kept in the query cache [default: {}]'.format(DEFAULT_QUERY_CACHE_ENTRIES)
+    )
+    
+    options.add_argument(
+        '--incremental',
+        dest='incremental_flag',
+        action="store_true",
+        default=False,
+        help='Keep an existing output db and only add records newer than the last conversion'
+    )
+    
+    options.add_argument(
+        '--stage_db',
+        dest='stage_db',
+        action="store",
+        type=unicode,
+        default=None,
+        help='Build the output db in memory (:memory:) or in this folder, e.g. a tmpfs like /dev/shm, and write it to the output path in one pass once it is indexed'
+    )
+    
+    options.add_argument(
+        '--stage_memory_limit',
+        dest='stage_memory_limit',
+        action="store",
+        type=int,
+        default=DEFAULT_STAGE_MEMORY_LIMIT,
+        help='With --stage_db, the megabytes the output db may be estimated to take, larger dbs are built in place [default: {}]'.format(DEFAULT_STAGE_MEMORY_LIMIT)
+    )
+    
+    options.add_argument(
+        '--stats',
+        dest='stats_file',
+        action="store",
+        type=unicode,
+        default=None,
+        help='Count the records, bytes, decode and insert time of every table and column and write them to this file in the output path, as a Prometheus textfile if it ends in .prom and as JSON otherwise'
+    )
+    
+    options.add_argument(
+        '--progress_interval',
+        dest='progress_interval',
+        action="store",
+        type=float,
+        default=DEFAULT_PROGRESS_INTERVAL,
+        help='With --stats, the seconds between progress lines [default: {}]'.format(DEFAULT_PROGRESS_INTERVAL)
+    )
+    
+    options.add_argument(
+        '--log_level',
+        dest='log_level',
+        action="store",
+        choices=['DEBUG','INFO','WARNING','ERROR'],
+        default='INFO',
+        help='Log messages of this level and above [default: INFO]'
+    )
+    
+    #Set by the reports from the output db, the column telling the hosts#
+    #of a merged fleet db apart#
+    options.set_defaults(
+        merge_key=None
+    )
+    
     return options
 
 def Main():
@@ -106,828 +263,483 @@ def Main():
     arguements = GetOptions()
     options = arguements.parse_args()
     
-    if not os.path.isdir(options.outpath):
-        os.makedirs(options.outpath)
-        
-    options.output_db = os.path.join(options.outpath,'SRUM.db')
-    
-    #If Database exists, delete it#
-    if os.path.isfile(options.output_db):
-        os.remove(options.output_db)
+    logging.basicConfig(
+        level = getattr(logging,options.log_level)
+    )
     
-    if not options.reports_only_flag:
-        srumHandler = SrumHandler(
+    if options.fleet is not None:
+        fleetHandler = FleetHandler(
             options
         )
         
-        srumHandler.ConvertDb()
+        results = fleetHandler.RunFleet()
         
-        if options.software_hive is not None:
-            if os.path.isfile(options.software_hive):
-                #Enumerate Registry Here#
-                rhandler = RegistryHandler(
-                    options
-                )
-                
-                rhandler.EnumerateRegistryValues()
-                
-                pass
-            else:
-                logging.error('No such software_hive file: {}'.format(options.software_hive))
-    
-    if options.report_flag is True:
-        reportHandler = ReportHandler(
+        #The fleet finishes when hosts fail, but the run did not succeed#
+        if [result for result in results if result[4] is not None]:
+            sys.exit(1)
+    else:
+        ProcessHost(
             options
         )
-        
-        reportHandler.RunReports()
+
+def ProcessHost(options):
+    '''Convert a SRUM db and its SOFTWARE hive, then index and report
     
-class ReportHandler(object):
-    def __init__(self,options):
-        '''Create ReportHandler to generate reports based off of the xlsx_templates folder'''
-        self.options = options
-        self.output_db = self.options.output_db
-        self.sql_files = []
-        
-        self.dbConfig = DbConfig(
-            dbname=self.output_db
-        )
+    Args:
+        options: Options
+    Returns:
+        record_count: The number of SRUM records converted'''
+    if not os.path.isdir(options.outpath):
+        os.makedirs(options.outpath)
         
-        self.dbHandler = DbHandler(
-            self.dbConfig
-        )
+    options.output_db = os.path.join(options.outpath,'SRUM.db')
     
-    def RunReports(self,sql_folder='xlsx_templates'):
-        '''Launch Report Creation'''
-        #Look in our sql dir for sql files to execute#
-        for subdir, dirs, files in os.walk(sql_folder):
-            #For each file#
-            for file in files:
-                #That ends with .sql#
-                if file.endswith('.yml'):
-                    self.sql_files.append(
-                        os.path.join(subdir, file)
-                    )
+    if options.output_format == 'parquet':
+        if options.incremental_flag:
+            msg = '--incremental keeps its high water marks in the SQLite output, use --output_format both'
+            logging.error(msg)
+            raise Exception(msg)
         
-        for sqlfile in self.sql_files:
-            sqlfile_basename = os.path.basename(sqlfile)
-            print 'Processing File {}'.format(sqlfile_basename)
+        #Indexes and reports need the SQLite output#
+        if options.report_flag:
+            logging.info('not running reports, there is no SQLite output')
+        options.report_flag = False
+    
+    #If Database exists, delete it unless we are adding to it#
+    if not options.reports_only_flag and not options.incremental_flag:
+        if os.path.isfile(options.output_db):
+            os.remove(options.output_db)
+    
+    record_count = 0
+    stagedDbHandler = None
+    reportHandler = None
+    try:
+        if not options.reports_only_flag:
+            from SrumConverter import SrumHandler
             
-            reporter = Reporter(
-                self.options,
-                sqlfile,
-                self.dbHandler
+            srumHandler = SrumHandler(
+                options
             )
             
-            reporter.WriteReport()
-    
-class Reporter():
-    def __init__(self,options,sqlfile,dbHandler):
-        '''Create Reporter using options from .yml template'''
-        self.options = options
-        self.sqlfilename = sqlfile
-        self.dbHandler = dbHandler
-        
-        with open(self.sqlfilename,'r') as sqlfh:
-            data = sqlfh.read()
+            stagedDbHandler = StageOutputDb(
+                options,
+                srumHandler.EstimateOutputSize()
+            )
             
-        sqlfh.close()
-        
-        self.properties = yaml.load(
-            data
-        )
-        
-    def WriteReport(self):
-        '''Write report to xlsx.
-        
-        '''
-        #Open XLSX File#
-        filename = os.path.join(
-            self.options.outpath,
-            self.properties['workbook_name']
-        )
-        logging.debug('creating workbook {}'.format(filename))
-        
-        #Create Workbook#
-        workbook = xlsxwriter.Workbook(
-            filename
-        )
-        
-        #Add Column Formats#
-        column_formats = {}
-        for column_number in self.properties['xlsx_column_formats'].keys():
-            if 'format' in self.properties['xlsx_column_formats'][column_number].keys():
-                column_formats[column_number] = workbook.add_format(
-                    self.properties['xlsx_column_formats'][column_number]['format']
-                )
-        
-        #Create Worksheet#
-        worksheet = workbook.add_worksheet(
-            self.properties['worksheet_name']
-        )
-        
-        #Iterate Records#
-        column_cnt = 0
-        row_start = 1
-        row_num = row_start
-        header_flag = False
-        for column_names,record in self.dbHandler.FetchRecords(self.properties['sql_query']):
-            if not header_flag:
-                column_cnt = len(column_names)
-                worksheet.write_row(0,0,column_names)
-                header_flag = True
-                
-            row = tuple(record)
+            srumHandler.ConvertDb()
+            record_count = srumHandler.record_count
             
-            c_cnt = 0
-            for value in row:
-                formatter = None
-                
-                #Check for special treatment for column#
-                if c_cnt in column_formats.keys():
-                    if 'format' in self.properties['xlsx_column_formats'][c_cnt].keys():
-                        formatter = column_formats[c_cnt]
+            if options.software_hive is not None:
+                if os.path.isfile(options.software_hive):
+                    #Enumerate Registry Here#
+                    from SrumRegistry import RegistryHandler
                     
-                    if 'column_type' in self.properties['xlsx_column_formats'][c_cnt].keys():
-                        '''Supported column_type's ['datetime']'''
-                        if self.properties['xlsx_column_formats'][c_cnt]['column_type'] == 'datetime':
-                            value = datetime.datetime.strptime(
-                                str(value),
-                                self.properties['xlsx_column_formats'][c_cnt]['strptime']
-                            )
+                    rhandler = RegistryHandler(
+                        options
+                    )
                     
-                worksheet.write(
-                    row_num,
-                    c_cnt,
-                    value,
-                    formatter
-                )
-                
-                c_cnt = c_cnt + 1
-            row_num = row_num+1
-        
-        worksheet.autofilter(
-            0,
-            0,
-            row_num - 1,
-            column_cnt - 1
-        )
-        
-        #Freeze Panes#
-        if 'freeze_panes' in self.properties:
-            worksheet.freeze_panes(
-                self.properties['freeze_panes']['row'],
-                self.properties['freeze_panes']['columns'],
-            )
-        
-        workbook.close()
-        logging.info('finished writing records')
-
-class RegistryHandler():
-    '''Registry Operations'''
-    INTERFACE_COLUMN_MAPPING = {
-        'ProfileIndex':'INTEGER',
-        'succeeded':'BLOB',
-        'ProfileGuid':'TEXT',
-        'Flags':'INTEGER',
-        'All User Profile Security Descriptor':'TEXT',
-        'CreatorSid':'BLOB',
-        'InterfaceGuid':'TEXT',
-        'SSID':'TEXT',
-        'Nla':'BLOB',
-        'NameLength':'INTEGER',
-        'Name':'TEXT'
-    }
-    CUSTOM_COLUMNS = {
-        'All User Profile Security Descriptor':{
-            'type':'utf-16le'
-        },
-        'Channel Hints':{
-            'type':'ChannelHints'
-        }
-    }
-    SQLITE_TYPE = {
-        'DATETIME':[
-            
-        ],
-        'REAL':[
-            
-        ],
-        'INTEGER':[
-            Registry.RegDWord
-        ],
-        'BLOB':[
-        ],
-        'TEXT':[
-        ]
-    }
-    
-    def __init__(self,options):
-        self.options = options
-        hive = options.software_hive
-        self.registry = Registry.Registry(
-            hive
-        )
-        
-        self.outputDbConfig = DbConfig(
-            dbname=self.options.output_db
-        )
-        
-        self.outputDbHandler = DbHandler(
-            self.outputDbConfig
-        )
-        
-        self.INTERFACE_COLUMN_LISTING = []
-        
-    def EnumerateRegistryValues(self):
-        reg_key = self.registry.open('Microsoft\\WlanSvc\\Interfaces')
-        profile_list = []
-        for interface_key in reg_key.subkeys():
-            #Get Interface GUID#
-            interface_guid = interface_key.name()
-            #If Interface Key has sub keys, enumerate profiles#
-            if interface_key.subkeys_number() > 0:
-                #Get Profiles Key#
-                profiles_key = interface_key.subkey('Profiles')
-                profile_dict = {
-                    'InterfaceGuid':interface_guid
-                }
-                for profile_key in profiles_key.subkeys():
-                    profile_guid = profile_key.name()
-                    profile_dict['ProfileGuid'] = profile_guid
-                    if profile_key.values_number() > 0:
-                        for value in profile_key.values():
-                            profile_dict[value.name()] = value.value()
-                    if profile_key.subkeys_number() > 0:
-                        metadata_key = profile_key.subkey('MetaData')
-                        if metadata_key.values_number() > 0:
-                            for value in metadata_key.values():
-                                resolved_value = self._GetValue(value)
-                                if isinstance(resolved_value,dict):
-                                    profile_dict.update(resolved_value)
-                                else:
-                                    profile_dict[value.name()] = self._GetValue(value)
+                    rhandler.EnumerateRegistryValues()
                     
-                    for key in profile_dict:
-                        if key not in self.INTERFACE_COLUMN_LISTING:
-                            self.INTERFACE_COLUMN_LISTING.append(key)
-                            
-                    profile_list.append(copy.deepcopy(profile_dict))
-                pass
-            pass
-        
-        self.outputDbHandler.CreateTableFromMapping(
-            'WlanSvcInterfaceProfiles',
-            RegistryHandler.INTERFACE_COLUMN_MAPPING,
-            None,
-            self.INTERFACE_COLUMN_LISTING
-        )
-        
-        self.outputDbHandler.InsertFromListOfDicts(
-            'WlanSvcInterfaceProfiles',
-            profile_list,
-            self.INTERFACE_COLUMN_LISTING
-        )
-    
-    def _GetValue(self,value):
-        new_value = value.value()
-        vname = value.name()
-        vtype = value.value_type()
+                    pass
+                else:
+                    logging.error('No such software_hive file: {}'.format(options.software_hive))
         
-        ###CHECK FOR CUSTOM DEFINED TABLE COLUMNS TYPES###
-        if vname in RegistryHandler.CUSTOM_COLUMNS:
-            new_value = self._GetCustomValue(
-                RegistryHandler.CUSTOM_COLUMNS[vname],
-                new_value
-            )
+        if options.report_flag is True:
+            from SrumReports import ReportHandler
             
-            return new_value
-        
-        return new_value
-    
-    def _GetCustomValue(self,custom_info,data):
-        value = data
-        if 'type' in custom_info:
-            if custom_info['type'] == 'utf-16le':
-                value = data.decode('utf-16le')
-            elif custom_info['type'] == 'ChannelHints':
-                value = ChannelHints(data)
-            elif custom_info['type'] == 'WinDatetime':
-                value = GetWinTimeStamp(data)
-                
-        return value
-    
-class SrumHandler():
-    '''A Handler for converting SRU to SQLite'''
-    CURRENT_LOCATION = {
-        'table':None,
-        'table_enum':None,
-        'column':None
-    }
-    GUID_TABLES = {
-        '{DD6636C4-8929-4683-974E-22C046A43763}':'NetworkConnectivityData',
-        '{D10CA2FE-6FCF-4F6D-848E-B2E99266FA89}':'ApplicationResourceUsageData',
-        '{973F5D5C-1D90-4944-BE8E-24B94231A174}':'NetworkUsageData',
-        '{D10CA2FE-6FCF-4F6D-848E-B2E99266FA86}':'EnergyUsageData',
-        '{FEE4E14F-02A9-4550-B5CE-5FA2DA202E37}':'WindowsPushNotificationData',
-        '{FEE4E14F-02A9-4550-B5CE-5FA2DA202E37}LT':'WindowsPushNotificationDataLT',
-    }
-    SQLITE_TYPE = {
-        'DATETIME':[
-            pyesedb.column_types.DATE_TIME
-        ],
-        'REAL':[
-            pyesedb.column_types.DOUBLE_64BIT,
-            pyesedb.column_types.FLOAT_32BIT
-        ],
-        'INTEGER':[
-            pyesedb.column_types.BOOLEAN,
-            pyesedb.column_types.INTEGER_16BIT_SIGNED,
-            pyesedb.column_types.INTEGER_16BIT_UNSIGNED,
-            pyesedb.column_types.INTEGER_32BIT_SIGNED,
-            pyesedb.column_types.INTEGER_32BIT_UNSIGNED,
-            pyesedb.column_types.INTEGER_64BIT_SIGNED,
-            pyesedb.column_types.INTEGER_8BIT_UNSIGNED
-        ],
-        'BLOB':[
-            pyesedb.column_types.BINARY_DATA,
-            pyesedb.column_types.LARGE_BINARY_DATA
-        ],
-        'TEXT':[
-            pyesedb.column_types.GUID,
-            pyesedb.column_types.LARGE_TEXT,
-            pyesedb.column_types.SUPER_LARGE_VALUE,
-            pyesedb.column_types.TEXT
-        ]
-    }
-    
-    #If Columns have same name but need to be treated differently#
-    CUSTOM_TABLES = {
-        
-    }
-    #How to decode a special column#
-    CUSTOM_COLUMNS = {
-        'EventTimestamp':{
-            'type':'WinDatetime'
-        },
-        'ConnectStartTime':{
-            'type':'WinDatetime'
-        },
-        'LocaleName':{
-            'type':'utf-16le'
-        },
-        'Key':{
-            'type':'utf-16le'
-        },
-        'IdBlob':{
-            'type':'IdBlob'
-        }
-    }
-
-    def __init__(self,options):
-        '''Create a SrumHandler
-        
-        Args:
-            options: Options'''
-        self.srum_db = options.srum_db
-        self.output_db = options.output_db
-        
-        self.esedb_file = pyesedb.file()
-        self.esedb_file.open(self.srum_db)
-        
-        self.outputDbConfig = DbConfig(
-            dbname=self.output_db
-        )
-        
-        self.outputDbHandler = DbHandler(
-            self.outputDbConfig
-        )
-        
-    def _CreateTableNameFromGuid(self,guid):
-        '''If you wanted to change the table name of a guid table'''
-        new_table_name = guid
-        
-        #new_table_name = new_table_name.replace('{','')
-        #new_table_name = new_table_name.replace('}','')
-        #new_table_name = new_table_name.replace('-','')
-        
-        return new_table_name
+            reportHandler = ReportHandler(
+                options
+            )
         
-    def ConvertDb(self):
-        '''Convert SRU Database to a SQLite Database'''
-        for table in self.esedb_file.tables:
-            #Enumerate if GUID Table#
-            self.table_name = table.name
-            if self.table_name in SrumHandler.GUID_TABLES:
-                self.table_name = SrumHandler.GUID_TABLES[self.table_name]
-                
-            ###Check if Table Name is GUID###
-            regexp = re.compile(r'^\{[0-9a-zA-Z]{8}\-[0-9a-zA-Z]{4}\-[0-9a-zA-Z]{4}\-[0-9a-zA-Z]{4}\-[0-9a-zA-Z]{12}\}')
-            if regexp.search(self.table_name) is not None:
-                self.table_name = self._CreateTableNameFromGuid(
-                    self.table_name
-                )
-            
-            SrumHandler.CURRENT_LOCATION['table'] = table.name
-            SrumHandler.CURRENT_LOCATION['table_enum'] = self.table_name
-            
-            print 'Converting Table {} as {}'.format(table.name,self.table_name)
+        #Index the join keys and whatever the templates ask for#
+        if options.output_format != 'parquet':
+            idMapHandler = IdMapHandler(
+                options
+            )
             
-            column_names = []
-            for column in table.columns:
-                column_names.append(column.name)
+            if not options.reports_only_flag or not idMapHandler.HasIdMap():
+                idMapHandler.BuildIdMap()
                 
-            self._CreateTable(
-                table
+            indexHandler = IndexHandler(
+                options
             )
             
-            num_of_columns = table.get_number_of_columns()
-            items_to_insert = []
-            for record in table.records:
-                enum_record = self._EnumerateRecord(
-                    num_of_columns,
-                    record
-                )
-                items_to_insert.append(enum_record)
+            template_indexes = []
+            if reportHandler is not None:
+                template_indexes = reportHandler.GetTemplateIndexes()
                 
-            self.outputDbHandler.InsertFromListOfDicts(
-                self.table_name,
-                items_to_insert,
-                column_names
+            indexHandler.BuildIndexes(
+                template_indexes,
+                analyze=not options.reports_only_flag
             )
             
-    def _CreateTable(self,table):
-        '''Create a table
-        
-        Args:
-            table: A pyesedb table object'''
-        column_names = []
-        for column in table.columns:
-            column_names.append(column.name)
-        
-        field_mapping = self._CreateFieldMapping(
-            table
-        )
-        
-        self.outputDbHandler.CreateTableFromMapping(
-            self.table_name,
-            field_mapping,
-            None,
-            column_names
-        )
-        
-    def _CreateFieldMapping(self,table):
-        '''Create a field mapping (table schema) for the SQLite table
-        
-        Args:
-            table: A pyesedb table object
-            
-        Return:
-            field_mapping: A dictionary of column to type mappings'''
-        field_mapping = {}
-        for column in table.columns:
-            key = column.name
-            
-            if column.type in SrumHandler.SQLITE_TYPE['TEXT']:
-                field_mapping[key] = 'TEXT'
-            elif column.type in SrumHandler.SQLITE_TYPE['BLOB']:
-                field_mapping[key] = 'BLOB'
-            elif column.type in SrumHandler.SQLITE_TYPE['INTEGER']:
-                field_mapping[key] = 'INTEGER'
-            elif column.type in SrumHandler.SQLITE_TYPE['REAL']:
-                field_mapping[key] = 'REAL'
-            elif column.type in SrumHandler.SQLITE_TYPE['DATETIME']:
-                field_mapping[key] = 'DATETIME'
-            else:
-                logging.error('Type not accounted for in table mapping creation: {}'.format(column.type))
-                sys.exit(1)
+        if stagedDbHandler is not None:
+            stagedDbHandler.PersistDb()
+    finally:
+        #A failed run must not leave the staged db behind#
+        if stagedDbHandler is not None:
+            stagedDbHandler.DiscardStagedDb()
+    
+    if reportHandler is not None:
+        reportHandler.RunReports()
         
-        return field_mapping
+    DbConfig.CloseConnections()
     
-    def _EnumerateRecord(self,num_of_columns,record):
-        '''Enumerate vales for a record
-        
-        Args:
-            num_of_columns: The number of columns in the record
-            record: a pyesedb record object
-            
-        Returns:
-            values: the record as a dictionary'''
-        values = {}
-        for index in range(0,num_of_columns):
-            self.CURRENT_VALUES = values
-            data = self._GetColumnValueFromRecord(
-                record,
-                index
-            )
-            
-            values.update(data)
-            
-        return values
-        
-    def _GetColumnValueFromRecord(self,record,index):
-        '''Get enumerated value based off of column and/or type
-        
-        Args:
-            record: a pyesedb record object
-            index: the column index for record
-        Return:
-            value: The value of a column for the record
-        '''
-        item = {}
-        value = None
-        name = record.get_column_name(index)
-        dtype = record.get_column_type(index)
-        data = record.get_value_data(index)
-        
-        SrumHandler.CURRENT_LOCATION['column'] = name
-        
-        if data is None:
-            item = {name:None}
-            return item
-        
-        ###CHECK FOR CUSTOM DEFINED TABLE COLUMNS TYPES###
-        if self.table_name in SrumHandler.CUSTOM_TABLES:
-            if name in SrumHandler.CUSTOM_TABLES[self.table_name]:
-                value = self._GetCustomValue(
-                    SrumHandler.CUSTOM_TABLES[name][self.table_name],
-                    data
-                )
-                item = {name:value}
-                return item
+    return record_count
+
+def StageOutputDb(options,estimated_size):
+    '''Build the output db somewhere else until it is persisted.
+    
+    An --incremental run converts into a copy of the output db next to it,
+    which replaces it once the run is complete, so a failed run leaves the
+    records of earlier runs as they were. Otherwise the output db is built
+    in memory or in the options.stage_db folder, unless there is no
+    options.stage_db or the db is estimated to be larger than
+    options.stage_memory_limit.
+    
+    Args:
+        options: Options
+        estimated_size: The estimated bytes of the output db
+    Returns:
+        stagedDbHandler: The DbHandler to persist the output db with, or
+            None if it is built in place'''
+    if options.output_format == 'parquet':
+        return None
+    
+    if options.incremental_flag:
+        if options.stage_db is not None:
+            logging.info('not staging the output db in {}, --incremental converts into a copy of it'.format(options.stage_db))
             
-        ###CHECK FOR CUSTOM DEFINED TABLE COLUMNS TYPES###
-        if name in SrumHandler.CUSTOM_COLUMNS:
-                value = self._GetCustomValue(
-                    SrumHandler.CUSTOM_COLUMNS[name],
-                    data
-                )
-                item = {name:value}
-                return item
-        
-        if dtype == DBTYPES.DOUBLE_64BIT:
-            value = struct.unpack('d',data)[0]
-        if dtype == DBTYPES.FLOAT_32BIT:
-            value = struct.unpack('f',data)[0]
-        if dtype == DBTYPES.BOOLEAN:
-            value = struct.unpack('?',data)[0]
-        elif dtype == DBTYPES.INTEGER_8BIT_UNSIGNED:
-            value = struct.unpack('B',data)[0]
-        elif dtype == DBTYPES.INTEGER_16BIT_SIGNED:
-            value = struct.unpack('h',data)[0]
-        elif dtype == DBTYPES.INTEGER_16BIT_UNSIGNED:
-            value = struct.unpack('H',data)[0]
-        elif dtype == DBTYPES.INTEGER_32BIT_SIGNED:
-            value = struct.unpack('i',data)[0]
-        elif dtype == DBTYPES.INTEGER_32BIT_UNSIGNED:
-            value = struct.unpack('I',data)[0]
-        elif dtype == DBTYPES.INTEGER_64BIT_SIGNED:
-            value = struct.unpack('q',data)[0]
-        elif dtype == DBTYPES.GUID:
-            value = uuid.UUID(bytes=data)
-        elif dtype == DBTYPES.LARGE_TEXT:
-            value = data
-        elif dtype == DBTYPES.SUPER_LARGE_VALUE:
-            value = data
-        elif dtype == DBTYPES.TEXT:
-            value = data
-        elif dtype == DBTYPES.BINARY_DATA:
-            value = data
-        elif dtype == DBTYPES.LARGE_BINARY_DATA:
-            value = data
-        elif dtype == DBTYPES.DATE_TIME:
-            value = GetOleTimeStamp(data)
-        else:
-            msg = 'UNKNOWN TYPE {}'.format(dtype)
-            logging.error(msg)
-            raise Exception(msg)
-        
-        item = {name:value}
+        handle,stage_path = tempfile.mkstemp(
+            suffix='.db',
+            prefix='SRUM',
+            dir=options.outpath
+        )
+        os.close(handle)
         
-        return item
-    
-    def _GetCustomValue(self,custom_info,data):
-        '''Get a value from a column based off of defined criteria.
+        logging.info('converting into {}, a copy of {}'.format(
+            stage_path,
+            options.output_db
+        ))
         
-        Used to parse binary data within columns such as timestamps.
+        stagedDbHandler = DbHandler(
+            DbConfig(
+                dbname=options.output_db
+            )
+        )
+        stagedDbHandler.StageDb(
+            stage_path,
+            copy=True
+        )
         
-        Args:
-            custom_info: A columns info from SrumHandler.CUSTOM_COLUMNS
-            data: The raw data from a records column
-        Returns:
-            value: The custom value'''
-        value = data
-        if 'type' in custom_info:
-            if custom_info['type'] == 'utf-16le':
-                value = data.decode('utf-16le')
-            elif custom_info['type'] == 'OleDatetime':
-                value = GetOleTimeStamp(data)
-            elif custom_info['type'] == 'WinDatetime':
-                value = GetWinTimeStamp(data)
-            elif custom_info['type'] == 'IdBlob':
-                if self.CURRENT_VALUES['IdType'] == 2 or self.CURRENT_VALUES['IdType'] == 1 or self.CURRENT_VALUES['IdType'] == 0:
-                    value = data.decode('utf-16le')
-                
-        return value
-
-def GetOleTimeStamp(raw_timestamp):
-    '''Return Datetime from raw OleTimestamp'''
-    timestamp = struct.unpack(
-        "d",
-        raw_timestamp
-    )[0]
-    
-    origDateTime = datetime.datetime(
-        1899,
-        12,
-        30,
-        0,
-        0,
-        0
-    )
+        return stagedDbHandler
     
-    timeDelta = datetime.timedelta(days=timestamp)
+    if options.stage_db is None:
+        return None
     
-    new_datetime = origDateTime + timeDelta
-  
-    #new_datetime = new_datetime.strftime("%Y-%m-%d %H:%M:%S.%f")
+    if not DbHandler.CanStage():
+        logging.warning('not staging the output db, SQLite {} has no VACUUM INTO'.format(sqlite3.sqlite_version))
+        return None
     
-    return new_datetime
-
-def GetWinTimeStamp(raw_timestamp):
-    '''Return Datetime from raw Win32Timestamp'''
-    timestamp = struct.unpack(
-        "Q",
-        raw_timestamp
-    )[0]
-    
-    if datetime < 0:
+    if estimated_size > options.stage_memory_limit * 1048576:
+        logging.info('not staging the output db, it is estimated at {:.0f}MB'.format(
+            estimated_size / 1048576.0
+        ))
         return None
     
-    microsecs, _ = divmod(
-        timestamp,
-        10
-    )
+    if options.stage_db == ':memory:':
+        stage_path = ':memory:'
+    else:
+        handle,stage_path = tempfile.mkstemp(
+            suffix='.db',
+            prefix='SRUM',
+            dir=options.stage_db
+        )
+        os.close(handle)
     
-    timeDelta = datetime.timedelta(
-        microseconds=microsecs
-    )
+    logging.info('staging the output db in {}, it is estimated at {:.0f}MB'.format(
+        stage_path,
+        estimated_size / 1048576.0
+    ))
     
-    origDateTime = datetime.datetime(
-        1601,
-        1,
-        1
+    stagedDbHandler = DbHandler(
+        DbConfig(
+            dbname=options.output_db
+        )
+    )
+    stagedDbHandler.StageDb(
+        stage_path
     )
     
-    new_datetime = origDateTime + timeDelta
-    #new_datetime = new_datetime.strftime("%Y-%m-%d %H:%M:%S.%f")
-    
-    return new_datetime
+    return stagedDbHandler
 
-class ChannelHints(dict):
-    def __init__(self,data):
-        self['NameLength'] = struct.unpack("I",data[0:4])[0]
-        self['Name'] = data[4:4+self['NameLength']]
-        self['SSID'] = data[36:36+32].encode('hex')
+class FleetHandler():
+    '''Convert the SRUM dbs of many hosts in a pool of processes. Every
+    worker imports the libraries and loads the templates once for all the
+    hosts it converts.
+    
+    Hosts are written to a folder per host in outpath. With the merged
+    fleet_output they are written to outpath/hosts and merged into one
+    SRUM.db with a host column as they finish, which is then indexed and
+    reported on.'''
+    SRUM_DB_NAME = 'srudb.dat'
+    SOFTWARE_HIVE_NAME = 'software'
+    HOSTS_FOLDER = 'hosts'
+    
+    def __init__(self,options):
+        '''Create a FleetHandler
         
-class DbConfig():
-    '''This tells the DbHandler what to connect too'''
-    def __init__(self,dbname=None):
-        self.db = dbname
-
-class DbHandler():
-    def __init__(self,db_config,table=None):
-        #Db Flags#
-        self.db_config = db_config
+        Args:
+            options: Options'''
+        self.options = options
+        self.fleet_workers = max(1,options.fleet_workers)
+        self.merged = options.fleet_output == 'merged'
         
-    def CreateTableFromMapping(self,tbl_name,field_mapping,primary_key_str,field_order):
-        dbh = self.GetDbHandle()
+        if self.merged and options.output_format == 'parquet':
+            msg = '--fleet_output merged needs the SQLite output'
+            logging.error(msg)
+            raise Exception(msg)
+            
+        #A host is converted by a single process#
+        if options.workers > 1 or options.report_workers > 1:
+            logging.warning('--workers and --report_workers are ignored with --fleet, use --fleet_workers')
         
-        string = "CREATE TABLE IF NOT EXISTS '{0:s}' (\n".format(tbl_name)
-        for field in field_order:
-            string += "'{0:s}' {1:s},\n".format(
-                field,
-                field_mapping[field]
-            )
+    def GetHosts(self):
+        '''Get the hosts of the fleet folder or manifest
         
-        if primary_key_str is not None:
-            string = string + primary_key_str
+        Returns:
+            hosts: A list of (host, srum_db, software_hive) tuples.
+                software_hive is None if the host has none.'''
+        hosts = []
+        if os.path.isdir(self.options.fleet):
+            for host in sorted(os.listdir(self.options.fleet)):
+                host_path = os.path.join(self.options.fleet,host)
+                if not os.path.isdir(host_path):
+                    continue
+                
+                files = {}
+                for filename in os.listdir(host_path):
+                    files[filename.lower()] = os.path.join(host_path,filename)
+                    
+                if FleetHandler.SRUM_DB_NAME not in files:
+                    logging.warning('No SRUDB.dat for host {}'.format(host))
+                    continue
+                
+                hosts.append((
+                    host,
+                    files[FleetHandler.SRUM_DB_NAME],
+                    files.get(FleetHandler.SOFTWARE_HIVE_NAME,None)
+                ))
         else:
-            string = string[0:-2]
-        
-        string = string + ')'
-        
-        cursor = dbh.cursor()
-        
-        cursor.execute(string)
-        
-    def CreateInsertString(self,table,row,column_order,INSERT_STR=None):
-        nco = []
-        for column in column_order:
-            nco.append("'{}'".format(column))
-            
-        columns = ', '.join(nco)
+            #Paths in the manifest are relative to it#
+            manifest_path = os.path.dirname(os.path.abspath(self.options.fleet))
+            with open(self.options.fleet,'rb') as manifest:
+                for row in csv.DictReader(manifest):
+                    software_hive = row.get('software_hive',None) or None
+                    if software_hive is not None:
+                        software_hive = os.path.join(manifest_path,software_hive)
+                        
+                    hosts.append((
+                        row['host'],
+                        os.path.join(manifest_path,row['srum_db']),
+                        software_hive
+                    ))
+                    
+        return hosts
+    
+    def RunFleet(self):
+        '''Convert every host and print the fleet summary
         
-        in_row = []
+        Returns:
+            results: A list of (host, seconds, records, host_db, error)
+                tuples, error is None for the hosts that succeeded'''
+        start = time.time()
+        hosts = self.GetHosts()
         
-        for key in column_order:
-            if key in row.keys():
-                in_row.append("{}".format(row[key]))
-            else:
-                in_row.append(None)
+        if self.merged:
+            hosts_path = os.path.join(self.options.outpath,FleetHandler.HOSTS_FOLDER)
+        else:
+            hosts_path = self.options.outpath
             
-            placeholders = ','.join('?' * len(in_row))
-        
-        if INSERT_STR == None:
-            INSERT_STR = 'INSERT OR IGNORE'
+        tasks = []
+        for host,srum_db,software_hive in hosts:
+            host_options = copy.copy(self.options)
+            host_options.srum_db = srum_db
+            host_options.software_hive = software_hive
+            host_options.outpath = os.path.join(
+                hosts_path,
+                re.sub(r'[^\w.-]','_',host)
+            )
+            host_options.workers = 1
+            host_options.report_workers = 1
+            if self.merged:
+                host_options.report_flag = False
+                
+            tasks.append(
+                (host,host_options)
+            )
         
-        sql = '{} INTO \'{}\' ({}) VALUES ({})'.format(INSERT_STR,table,columns, placeholders)
+        mergeHandler = None
+        if self.merged:
+            mergeHandler = self._CreateMergeHandler()
             
-        return sql
-    
-    def InsertFromListOfDicts(self,table,rows_to_insert,column_order,INSERT_STR=None):
-        dbh = self.GetDbHandle()
-        sql_c = dbh.cursor()
-        
-        for row in rows_to_insert:
-            in_row = []
-            sql = self.CreateInsertString(
-                table,
-                row,
-                column_order,
-                INSERT_STR=None
+        results = []
+        if self.fleet_workers > 1:
+            pool = multiprocessing.Pool(
+                self.fleet_workers
             )
-            
-            for key in column_order:
-                if key in row.keys():
-                    in_row.append(row[key])
-                else:
-                    in_row.append(None)
-            
             try:
-                sql_c.execute(sql,in_row)
-            except MySQLdb.IntegrityError:
-                #MySQL Duplicate on primary key#
-                pass
-            except Exception as e:
-                print "[ERROR] {}\n[SQL] {}\n[ROW] {}".format(str(e),sql,str(row))
+                for result in pool.imap_unordered(_ProcessHostTask,tasks):
+                    #Hosts are merged while the others are converted#
+                    self._FinishHost(result,mergeHandler)
+                    results.append(result)
+                    
+                pool.close()
+                pool.join()
+            except:
+                pool.terminate()
+                raise
+        else:
+            for task in tasks:
+                result = _ProcessHostTask(task)
+                self._FinishHost(result,mergeHandler)
+                results.append(result)
+                
+        if mergeHandler is not None:
+            mergeHandler.SetProfile('safe')
+            self._ReportMerged()
+            
+        self._PrintSummary(
+            results,
+            time.time() - start
+        )
         
-        dbh.commit()
-    
-    def CreateView(self,view_str):
-        dbh = self.GetDbHandle()
-        cursor = dbh.cursor()
+        return results
         
-        cursor.execute(view_str)
-        dbh.commit()
-    
-    def GetDbHandle(self):
-        '''Create database handle based off of databaseinfo'''
-        dbh = None
+    def _CreateMergeHandler(self):
+        '''Create the merged db, replacing an earlier one
         
-        dbh = sqlite3.connect(
-            self.db_config.db,
-            timeout=10000,
-            detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES
+        Returns:
+            mergeHandler: The DbHandler of the merged db'''
+        if not os.path.isdir(self.options.outpath):
+            os.makedirs(self.options.outpath)
+            
+        self.options.output_db = os.path.join(self.options.outpath,'SRUM.db')
+        if os.path.isfile(self.options.output_db):
+            os.remove(self.options.output_db)
+            
+        mergeHandler = DbHandler(
+            DbConfig(dbname=self.options.output_db)
+        )
+        mergeHandler.SetProfile('bulk_load')
+        #Every host is converted with the same options#
+        mergeHandler.SetSetting(
+            'timestamp_format',
+            self.options.timestamp_format
+        )
+        #The ids of the hosts collide, indexes and reports join on the host#
+        mergeHandler.SetSetting(
+            'merge_key',
+            MERGE_KEY_COLUMN
         )
         
-        return dbh
+        return mergeHandler
     
-    def FetchRecords(self,sql_string):
-        dbh = self.GetDbHandle()
-        dbh.row_factory = sqlite3.Row
+    def _FinishHost(self,result,mergeHandler):
+        '''Report a finished host and merge it if needed
         
-        column_names = []
-        
-        #Register User Functions#
-        RegisterFunctions(dbh)
-        
-        sql_c = dbh.cursor()
-        
-        sql_c.execute(sql_string)
+        Args:
+            result: A (host, seconds, records, host_db, error) tuple
+            mergeHandler: The DbHandler of the merged db, or None'''
+        host,elapsed,record_count,host_db,error = result
+        if error is not None:
+            logging.error('Host {} failed:\n{}'.format(host,error))
+            return
+        
+        print 'Finished Host {} ({} records in {:.2f}s)'.format(
+            host,
+            record_count,
+            elapsed
+        )
         
-        for desc in sql_c.description:
-            column_names.append(
-                desc[0]
+        if mergeHandler is not None:
+            mergeHandler.MergeDb(
+                host_db,
+                MERGE_KEY_COLUMN,
+                host,
+                skip_tables=[HIGH_WATER_TABLE,SETTINGS_TABLE]
             )
-        
-        
-        for record in sql_c:
-            yield column_names,record
     
-    def GetColumnInfo(self,sql_string):
-        dbh = self.GetDbHandle()
-        dbh.row_factory = sqlite3.Row
-        
-        #Register User Functions#
-        RegisterFunctions(dbh)
-        
-        sql_c = dbh.cursor()
+    def _ReportMerged(self):
+        '''Index and report on the merged db'''
+        self.options.srum_db = None
+        self.options.software_hive = None
+        self.options.reports_only_flag = True
         
-        sql_c.execute(sql_string)
-        
-        row = sql_c.fetchone()
+        ProcessHost(
+            self.options
+        )
     
+    def _PrintSummary(self,results,elapsed):
+        '''Print the time and record count of every host and the fleet
+        
+        Args:
+            results: A list of (host, seconds, records, host_db, error) tuples
+            elapsed: The seconds the fleet took'''
+        total_records = 0
+        failed = 0
+        print 'Fleet Summary'
+        for host,host_elapsed,record_count,host_db,error in sorted(results):
+            if error is not None:
+                failed += 1
+                status = 'FAILED'
+            else:
+                total_records += record_count
+                status = '{} records'.format(record_count)
+                
+            print '  {:<40} {:>20} {:>10.2f}s'.format(
+                host,
+                status,
+                host_elapsed
+            )
+            
+        print '  {} hosts ({} failed), {} records in {:.2f}s: {:.1f} hosts/min, {:.0f} records/sec'.format(
+            len(results),
+            failed,
+            total_records,
+            elapsed,
+            len(results) * 60.0 / max(elapsed,0.001),
+            total_records / max(elapsed,0.001)
+        )
+
+def _ProcessHostTask(task):
+    '''Convert a host of a fleet, in a fleet worker process
+    
+    Args:
+        task: A (host, options) tuple
+    Returns:
+        result: A (host, seconds, records, host_db, error) tuple'''
+    host,options = task
+    start = time.time()
+    record_count = 0
+    error = None
+    try:
+        record_count = ProcessHost(
+            options
+        )
+    except (Exception,SystemExit):
+        #A SystemExit would end the worker and leave the fleet waiting#
+        #on its result#
+        error = traceback.format_exc()
+        DbConfig.CloseConnections()
+        
+    return (
+        host,
+        time.time() - start,
+        record_count,
+        os.path.join(options.outpath,'SRUM.db'),
+        error
+    )
 
 if __name__ == '__main__':
     Main()
@@ -0,0 +1,143 @@
+'''Write converted tables as Parquet files'''
+import sqlite3
+import logging
+import datetime
+import os
+import uuid
+
+#pyarrow is only needed for Parquet output#
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+class ParquetTableWriter():
+    '''Write batches of records to a Parquet file, typed from a SQLite
+    field mapping'''
+    def __init__(self,filename,column_order,field_mapping):
+        '''Create a ParquetTableWriter
+        
+        Args:
+            filename: The Parquet file to create
+            column_order: The column names in record order
+            field_mapping: A dictionary of column to SQLite type mappings'''
+        if pyarrow is None:
+            msg = 'Parquet output requires pyarrow'
+            logging.error(msg)
+            raise Exception(msg)
+        
+        #Arrow type and fallback value conversion of each SQLite type#
+        arrow_types = {
+            'INTEGER':(pyarrow.int64(),ToParquetInteger),
+            'REAL':(pyarrow.float64(),None),
+            'DATETIME':(pyarrow.timestamp('us'),None),
+            'BLOB':(pyarrow.binary(),ToParquetBinary),
+            'TEXT':(pyarrow.string(),ToParquetText)
+        }
+        
+        self.types = []
+        self.converters = []
+        fields = []
+        for column in column_order:
+            arrow_type,converter = arrow_types[field_mapping[column]]
+            self.types.append(arrow_type)
+            self.converters.append(converter)
+            fields.append(
+                pyarrow.field(column,arrow_type)
+            )
+        
+        self.schema = pyarrow.schema(fields)
+        self.writer = pyarrow.parquet.ParquetWriter(
+            filename,
+            self.schema
+        )
+        
+    def Write(self,records):
+        '''Write a batch of records as a row group
+        
+        Args:
+            records: A list of records in column order'''
+        arrays = []
+        for index,values in enumerate(zip(*records)):
+            try:
+                array = pyarrow.array(values,type=self.types[index])
+            except (pyarrow.ArrowInvalid,pyarrow.ArrowTypeError):
+                #Only columns holding values of another type pay for this#
+                converter = self.converters[index]
+                if converter is None:
+                    raise
+                array = pyarrow.array(
+                    [converter(value) for value in values],
+                    type=self.types[index]
+                )
+            arrays.append(array)
+            
+        self.writer.write_table(
+            pyarrow.Table.from_arrays(
+                arrays,
+                schema=self.schema
+            )
+        )
+        
+    def Close(self):
+        '''Finish the Parquet file'''
+        self.writer.close()
+
+def GetParquetPartName(parquet_path,table_name,clear_parts=True):
+    '''Get the filename of a new part file in the Parquet directory of a table.
+    Names start with the time they were made and end with a random id, so
+    parts added in the same second do not replace each other.
+    
+    Args:
+        parquet_path: The Parquet output folder
+        table_name: The table name
+        clear_parts: Remove the part files of earlier runs
+    Returns:
+        filename: The part filename'''
+    table_path = os.path.join(
+        parquet_path,
+        table_name
+    )
+    if not os.path.isdir(table_path):
+        os.makedirs(table_path)
+    
+    if clear_parts:
+        for filename in os.listdir(table_path):
+            if filename.endswith('.parquet'):
+                os.remove(os.path.join(table_path,filename))
+                
+    return os.path.join(
+        table_path,
+        'part-{}-{}.parquet'.format(
+            datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'),
+            uuid.uuid4().hex
+        )
+    )
+
+def ToParquetInteger(value):
+    '''Convert a value (such as a bool) for an int64 column'''
+    if value is None:
+        return None
+    
+    return int(value)
+
+def ToParquetBinary(value):
+    '''Convert a value for a binary column'''
+    if value is None:
+        return None
+    elif isinstance(value,unicode):
+        return value.encode('utf-8')
+    
+    return str(value)
+
+def ToParquetText(value):
+    '''Convert a value for a string column. Binary data is hex encoded.'''
+    if value is None or isinstance(value,unicode):
+        return value
+    elif isinstance(value,type(sqlite3.Binary(''))):
+        return str(value).encode('hex')
+    elif isinstance(value,str):
+        return value.decode('utf-8','replace')
+    
+    return unicode(value)
@@ -0,0 +1,176 @@
+'''Enumerate the SOFTWARE hive values the SRUM tables refer to'''
+import struct
+import os
+import copy
+
+#Requires installing python-registry
+#https://github.com/williballenthin/python-registry
+from Registry import Registry
+
+from SrumDb import DbConfig,DbHandler
+from SrumTimestamps import GetWinTimeStamp
+
+class ChannelHints(dict):
+    def __init__(self,data):
+        self['NameLength'] = struct.unpack("I",data[0:4])[0]
+        self['Name'] = data[4:4+self['NameLength']]
+        self['SSID'] = data[36:36+32].encode('hex')
+
+class RegistryHandler():
+    '''Registry Operations'''
+    INTERFACE_COLUMN_MAPPING = {
+        'ProfileIndex':'INTEGER',
+        'succeeded':'BLOB',
+        'ProfileGuid':'TEXT',
+        'Flags':'INTEGER',
+        'All User Profile Security Descriptor':'TEXT',
+        'CreatorSid':'BLOB',
+        'InterfaceGuid':'TEXT',
+        'SSID':'TEXT',
+        'Nla':'BLOB',
+        'NameLength':'INTEGER',
+        'Name':'TEXT'
+    }
+    CUSTOM_COLUMNS = {
+        'All User Profile Security Descriptor':{
+            'type':'utf-16le'
+        },
+        'Channel Hints':{
+            'type':'ChannelHints'
+        }
+    }
+    SQLITE_TYPE = {
+        'DATETIME':[
+            
+        ],
+        'REAL':[
+            
+        ],
+        'INTEGER':[
+            Registry.RegDWord
+        ],
+        'BLOB':[
+        ],
+        'TEXT':[
+        ]
+    }
+    
+    def __init__(self,options):
+        self.options = options
+        hive = options.software_hive
+        self.registry = Registry.Registry(
+            hive
+        )
+        
+        self.outputDbConfig = DbConfig(
+            dbname=self.options.output_db
+        )
+        
+        self.outputDbHandler = DbHandler(
+            self.outputDbConfig
+        )
+        
+        self.INTERFACE_COLUMN_LISTING = []
+        
+    def EnumerateRegistryValues(self):
+        reg_key = self.registry.open('Microsoft\\WlanSvc\\Interfaces')
+        profile_list = []
+        for interface_key in reg_key.subkeys():
+            #Get Interface GUID#
+            interface_guid = interface_key.name()
+            #If Interface Key has sub keys, enumerate profiles#
+            if interface_key.subkeys_number() > 0:
+                #Get Profiles Key#
+                profiles_key = interface_key.subkey('Profiles')
+                profile_dict = {
+                    'InterfaceGuid':interface_guid
+                }
+                for profile_key in profiles_key.subkeys():
+                    profile_guid = profile_key.name()
+                    profile_dict['ProfileGuid'] = profile_guid
+                    if profile_key.values_number() > 0:
+                        for value in profile_key.values():
+                            profile_dict[value.name()] = value.value()
+                    if profile_key.subkeys_number() > 0:
+                        metadata_key = profile_key.subkey('MetaData')
+                        if metadata_key.values_number() > 0:
+                            for value in metadata_key.values():
+                                resolved_value = self._GetValue(value)
+                                if isinstance(resolved_value,dict):
+                                    profile_dict.update(resolved_value)
+                                else:
+                                    profile_dict[value.name()] = self._GetValue(value)
+                    
+                    for key in profile_dict:
+                        if key not in self.INTERFACE_COLUMN_LISTING:
+                            self.INTERFACE_COLUMN_LISTING.append(key)
+                            
+                    profile_list.append(copy.deepcopy(profile_dict))
+                pass
+            pass
+        
+        if self.options.output_format in ['sqlite','both']:
+            self.outputDbHandler.CreateTableFromMapping(
+                'WlanSvcInterfaceProfiles',
+                RegistryHandler.INTERFACE_COLUMN_MAPPING,
+                None,
+                self.INTERFACE_COLUMN_LISTING
+            )
+            
+            #Profiles are read again in full on every run#
+            self.outputDbHandler.DeleteRecords(
+                'WlanSvcInterfaceProfiles'
+            )
+            
+            self.outputDbHandler.InsertFromListOfDicts(
+                'WlanSvcInterfaceProfiles',
+                profile_list,
+                self.INTERFACE_COLUMN_LISTING
+            )
+            
+        if self.options.output_format in ['parquet','both'] and profile_list:
+            from SrumParquet import ParquetTableWriter,GetParquetPartName
+            
+            parquetWriter = ParquetTableWriter(
+                GetParquetPartName(
+                    os.path.join(self.options.outpath,'parquet'),
+                    'WlanSvcInterfaceProfiles'
+                ),
+                self.INTERFACE_COLUMN_LISTING,
+                RegistryHandler.INTERFACE_COLUMN_MAPPING
+            )
+            parquetWriter.Write(
+                list(self.outputDbHandler.RowsFromDicts(
+                    profile_list,
+                    self.INTERFACE_COLUMN_LISTING
+                ))
+            )
+            parquetWriter.Close()
+    
+    def _GetValue(self,value):
+        new_value = value.value()
+        vname = value.name()
+        vtype = value.value_type()
+        
+        ###CHECK FOR CUSTOM DEFINED TABLE COLUMNS TYPES###
+        if vname in RegistryHandler.CUSTOM_COLUMNS:
+            new_value = self._GetCustomValue(
+                RegistryHandler.CUSTOM_COLUMNS[vname],
+                new_value
+            )
+            
+            return new_value
+        
+        return new_value
+    
+    def _GetCustomValue(self,custom_info,data):
+        value = data
+        if 'type' in custom_info:
+            if custom_info['type'] == 'utf-16le':
+                value = data.decode('utf-16le')
+            elif custom_info['type'] == 'ChannelHints':
+                value = ChannelHints(data)
+            elif custom_info['type'] == 'WinDatetime':
+                value = GetWinTimeStamp(data)
+                
+        return value
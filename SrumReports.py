@@ -0,0 +1,1168 @@
+'''Create the XLSX, csv and jsonl reports of the YAML templates'''
+import sqlite3
+import logging
+import datetime
+import os
+import time
+import threading
+import multiprocessing
+import Queue
+import traceback
+import hashlib
+import csv
+import json
+import gzip
+import io
+import collections
+import copy
+import xlsxwriter
+import yaml
+
+from SrumDb import DbConfig,DbHandler,GetPeakMemory,FormatByteSize
+from SrumTimestamps import FormatTimestamp,ParseDatetime,FILETIME_EPOCH_OFFSET,STORED_DATETIME_FORMATS
+
+#Bytes buffered by the csv and jsonl report writers#
+DEFAULT_STREAM_BUFFER = 1048576
+
+class ReportHandler(object):
+    def __init__(self,options):
+        '''Create ReportHandler to generate reports based off of the xlsx_templates folder'''
+        self.options = options
+        self.output_db = self.options.output_db
+        self.sql_files = []
+        
+        self.dbConfig = DbConfig(
+            dbname=self.output_db
+        )
+        
+        self.dbHandler = DbHandler(
+            self.dbConfig
+        )
+        
+        #Normalized queries used by more than one template#
+        self.shared_queries = set()
+    
+    def GetTemplateFiles(self,sql_folder='xlsx_templates'):
+        '''Get the .yml templates in sql_folder
+        
+        Args:
+            sql_folder: The template folder
+        Returns:
+            sql_files: A list of template paths'''
+        sql_files = []
+        #Look in our sql dir for sql files to execute#
+        for subdir, dirs, files in os.walk(sql_folder):
+            #For each file#
+            for file in files:
+                #That ends with .yml#
+                if file.endswith('.yml'):
+                    sql_files.append(
+                        os.path.join(subdir, file)
+                    )
+                    
+        return sql_files
+    
+    def GetTemplateIndexes(self,sql_folder='xlsx_templates'):
+        '''Get the indexes declared by the templates with the indexes key
+        
+        Args:
+            sql_folder: The template folder
+        Returns:
+            indexes: A list of {'table':name,'columns':[names]} dictionaries'''
+        indexes = []
+        for sqlfile in self.GetTemplateFiles(sql_folder):
+            properties = LoadTemplate(sqlfile)
+            if 'indexes' in properties:
+                indexes.extend(properties['indexes'])
+                
+        return indexes
+    
+    def RunReports(self,sql_folder='xlsx_templates'):
+        '''Launch Report Creation
+        
+        Returns:
+            results: A list of (sqlfile, seconds, rows, error) tuples'''
+        self.sql_files = self.GetTemplateFiles(sql_folder)
+        
+        #Integer timestamps are read in the format they were stored in#
+        timestamp_format = self.dbHandler.GetSetting('timestamp_format')
+        if timestamp_format is not None and timestamp_format != self.options.timestamp_format:
+            logging.info('reading timestamps as {}, the --timestamp_format of {}'.format(
+                timestamp_format,
+                self.output_db
+            ))
+            self.options = copy.copy(self.options)
+            self.options.timestamp_format = timestamp_format
+            
+        #The hosts of a merged fleet db are joined on the merge key, which#
+        #only templates with a merged_sql_query do#
+        merge_key = self.dbHandler.GetSetting('merge_key')
+        if merge_key != self.options.merge_key:
+            self.options = copy.copy(self.options)
+            self.options.merge_key = merge_key
+            
+        if merge_key is not None:
+            sql_files = []
+            for sqlfile in self.sql_files:
+                if GetTemplateQueries(LoadTemplate(sqlfile),merge_key)[0] is None:
+                    logging.warning('not running {} on {}, it has no merged_sql_query joining on {}'.format(
+                        sqlfile,
+                        self.output_db,
+                        merge_key
+                    ))
+                    continue
+                
+                sql_files.append(sqlfile)
+                
+            self.sql_files = sql_files
+        
+        if self.options.query_cache_flag:
+            self.shared_queries = self.GetSharedQueries()
+            
+        workbooks = self.GroupTemplates()
+        
+        if self.options.report_workers > 1:
+            results = self._RunReportsParallel(workbooks)
+        else:
+            queryCache = QueryCache(
+                self.options,
+                self.shared_queries
+            )
+            
+            results = []
+            for workbook_name,sql_files in workbooks:
+                results.extend(
+                    WriteReportGroup(
+                        self.options,
+                        workbook_name,
+                        sql_files,
+                        queryCache
+                    )
+                )
+                
+        self._PrintSummary(results)
+        
+        return results
+        
+    def GroupTemplates(self):
+        '''Group the xlsx templates by their workbook_name. Templates with
+        another output_format are written on their own.
+        
+        Returns:
+            workbooks: A list of (workbook_name, [sqlfiles]) tuples in the
+                order the workbooks are first used. The workbook_name of
+                csv and jsonl templates is None.'''
+        workbooks = []
+        sql_files_by_name = {}
+        for sqlfile in self.sql_files:
+            properties = LoadTemplate(sqlfile)
+            if properties.get('output_format','xlsx') != 'xlsx':
+                workbooks.append(
+                    (None,[sqlfile])
+                )
+                continue
+            
+            workbook_name = properties['workbook_name']
+            if workbook_name not in sql_files_by_name:
+                sql_files_by_name[workbook_name] = []
+                workbooks.append(
+                    (workbook_name,sql_files_by_name[workbook_name])
+                )
+            sql_files_by_name[workbook_name].append(sqlfile)
+            
+        return workbooks
+        
+    def GetSharedQueries(self):
+        '''Get the queries that more than one template runs. Only these are
+        worth materializing in the query cache.
+        
+        Returns:
+            shared_queries: A set of normalized queries'''
+        query_counts = {}
+        for sqlfile in self.sql_files:
+            sql_query,shared_subqueries = GetTemplateQueries(
+                LoadTemplate(sqlfile),
+                self.options.merge_key
+            )
+            query = QueryCache.NormalizeQuery(
+                sql_query
+            )
+            query_counts[query] = query_counts.get(query,0) + 1
+            
+        return set(
+            [query for query,count in query_counts.items() if count > 1]
+        )
+    
+    def _RunReportsParallel(self,workbooks):
+        '''Run the workbooks in a pool of options.report_workers processes.
+        
+        Args:
+            workbooks: A list of (workbook_name, [sqlfiles]) tuples
+        Returns:
+            results: A list of (sqlfile, seconds, rows, error) tuples'''
+        pool = multiprocessing.Pool(
+            self.options.report_workers
+        )
+        
+        try:
+            async_results = []
+            for workbook_name,sql_files in workbooks:
+                async_results.append(
+                    pool.apply_async(
+                        _RunWorkbookTask,
+                        (self.options,workbook_name,sql_files,self.shared_queries)
+                    )
+                )
+            pool.close()
+            
+            results = []
+            for async_result in async_results:
+                results.extend(async_result.get())
+                
+            pool.join()
+        except:
+            pool.terminate()
+            raise
+            
+        return results
+    
+    def _PrintSummary(self,results):
+        '''Print the time and row count of every report
+        
+        Args:
+            results: A list of (sqlfile, seconds, rows, error) tuples'''
+        print 'Report Summary'
+        for sqlfile,elapsed,row_count,error in results:
+            if error is not None:
+                status = 'FAILED'
+            else:
+                status = '{} rows'.format(row_count)
+                
+            print '  {:<40} {:>16} {:>10.2f}s'.format(
+                os.path.basename(sqlfile),
+                status,
+                elapsed
+            )
+
+def _RunWorkbookTask(options,workbook_name,sql_files,shared_queries):
+    '''Write a workbook in a report worker process
+    
+    Returns:
+        results: A list of (sqlfile, seconds, rows, error) tuples'''
+    return WriteReportGroup(
+        options,
+        workbook_name,
+        sql_files,
+        QueryCache(
+            options,
+            shared_queries
+        )
+    )
+
+def WriteReportGroup(options,workbook_name,sql_files,queryCache):
+    '''Write a group from ReportHandler.GroupTemplates, a workbook or a
+    single csv or jsonl template
+    
+    Args:
+        options: Options
+        workbook_name: The workbook file name, or None
+        sql_files: The templates of the group
+        queryCache: The QueryCache to run the queries through
+    Returns:
+        results: A list of (sqlfile, seconds, rows, error) tuples'''
+    if workbook_name is None:
+        print 'Processing Report {}'.format(os.path.basename(sql_files[0]))
+        
+        streamReporter = StreamReporter(
+            options,
+            sql_files[0],
+            DbHandler(DbConfig(dbname=options.output_db)),
+            queryCache=queryCache
+        )
+        
+        return [streamReporter.WriteReport()]
+    
+    print 'Processing Workbook {}'.format(workbook_name)
+    
+    workbookReporter = WorkbookReporter(
+        options,
+        workbook_name,
+        sql_files,
+        queryCache=queryCache
+    )
+    
+    return workbookReporter.WriteWorkbook()
+
+#Loaded templates by filename, with the mtime they were loaded at#
+_TEMPLATE_CACHE = {}
+
+def LoadTemplate(sqlfilename):
+    '''Load the properties of a .yml report template. Templates are only
+    read again when they change, so the properties must not be modified.'''
+    mtime = os.path.getmtime(sqlfilename)
+    if sqlfilename in _TEMPLATE_CACHE:
+        loaded_mtime,properties = _TEMPLATE_CACHE[sqlfilename]
+        if loaded_mtime == mtime:
+            return properties
+        
+    with open(sqlfilename,'r') as sqlfh:
+        data = sqlfh.read()
+        
+    properties = yaml.load(
+        data
+    )
+    _TEMPLATE_CACHE[sqlfilename] = (mtime,properties)
+    
+    return properties
+
+def GetTemplateQueries(properties,merge_key=None):
+    '''Get the queries of a template. The ids of the hosts of a merged
+    fleet db collide, so on one the template's merged_sql_query and
+    merged_shared_subqueries are run instead, which join on the merge key
+    as well.
+    
+    Args:
+        properties: The template properties
+        merge_key: The merge_key setting of the output db, or None
+    Returns:
+        sql_query: The query, None if the template has none for the db
+        shared_subqueries: A dictionary of name to query, or None'''
+    if merge_key is None:
+        return properties['sql_query'],properties.get('shared_subqueries',None)
+    
+    return (
+        properties.get('merged_sql_query',None),
+        properties.get('merged_shared_subqueries',None)
+    )
+
+def GetDatetimeConverter(strptime_format,timestamp_format='datetime'):
+    '''Get a function that converts a column value to a datetime. There is
+    no converter for the DATETIME type, so datetime and iso columns are
+    read as text. If strptime_format is the form SQLite stores datetimes
+    in, that text is parsed by ParseDatetime, with or without microseconds.
+    Values typed as timestamps (PARSE_COLNAMES) are passed through.
+    Integers are timestamps stored with --timestamp_format epoch or
+    filetime.
+    
+    Args:
+        strptime_format: The format of the value's text form
+        timestamp_format: The --timestamp_format of the output db'''
+    strptime = datetime.datetime.strptime
+    parse_stored = strptime_format in STORED_DATETIME_FORMATS
+    
+    def ConvertDatetime(value):
+        if value is None or isinstance(value,datetime.datetime):
+            return value
+        elif isinstance(value,(int,long)):
+            if timestamp_format == 'filetime':
+                value = value // 10 + FILETIME_EPOCH_OFFSET
+            return FormatTimestamp(value,'datetime')
+        
+        if parse_stored:
+            parsed = ParseDatetime(value)
+            if parsed is not None:
+                return parsed
+        return strptime(str(value),strptime_format)
+    
+    return ConvertDatetime
+
+class QueryCache():
+    '''Materialized report query results, kept as tables of a cache db next
+    to the output db. Entries are keyed by the normalized query and the
+    fingerprint of the output db, and evicted least recently used first.
+    
+    Queries run by more than one template are materialized once and read
+    back by every template. Templates can also declare named queries under
+    shared_subqueries. These are materialized under their name so that
+    sql_query can select from them like a table.'''
+    CACHE_NAME = 'SrumQueryCache.db'
+    ENTRY_TABLE = 'QueryCacheEntries'
+    
+    def __init__(self,options,shared_queries=set()):
+        '''Create a QueryCache
+        
+        Args:
+            options: Options
+            shared_queries: The normalized queries worth materializing'''
+        self.output_db = options.output_db
+        self.max_entries = max(1,options.query_cache_entries)
+        self.shared_queries = shared_queries
+        
+        #The output db is attached to the cache db, ids are resolved in it#
+        self.cacheDbConfig = DbConfig(
+            dbname=os.path.join(options.outpath,QueryCache.CACHE_NAME),
+            id_db=self.output_db
+        )
+        
+        self.cacheDbHandler = DbHandler(
+            self.cacheDbConfig
+        )
+        
+        self.fingerprint = GetDbFingerprint(
+            self.output_db
+        )
+        
+    @staticmethod
+    def NormalizeQuery(sql_string):
+        '''Collapse whitespace and trailing semicolons of a query'''
+        return ' '.join(sql_string.split()).rstrip(';').strip()
+    
+    def FetchRecords(self,dbHandler,sql_string,shared_subqueries=None):
+        '''Fetch the records of a query, materializing it and the shared
+        subqueries it uses as needed
+        
+        Args:
+            dbHandler: The DbHandler of the output db
+            sql_string: The query
+            shared_subqueries: A dictionary of name to query
+        Returns:
+            A generator like DbHandler.FetchRecords'''
+        query = QueryCache.NormalizeQuery(sql_string)
+        if not shared_subqueries and query not in self.shared_queries:
+            return dbHandler.FetchRecords(sql_string)
+        
+        if shared_subqueries:
+            for name,subquery in shared_subqueries.items():
+                self.Materialize(subquery,table_name=name)
+        
+        if query in self.shared_queries:
+            table_name = self.Materialize(sql_string)
+            sql_string = 'SELECT * FROM "{}"'.format(table_name)
+        
+        return self.cacheDbHandler.FetchRecords(sql_string)
+    
+    def Materialize(self,sql_string,table_name=None):
+        '''Store the result of a query in the cache db unless it is there
+        
+        Args:
+            sql_string: The query
+            table_name: The table to store it in [default: from the key]
+        Returns:
+            table_name: The table holding the result'''
+        query = QueryCache.NormalizeQuery(sql_string)
+        if isinstance(query,unicode):
+            query = query.encode('utf-8')
+        
+        key = hashlib.sha1(
+            self.fingerprint + '\n' + query
+        ).hexdigest()
+        if table_name is None:
+            table_name = 'QueryCache_{}'.format(key)
+        
+        dbh = self._GetCacheHandle()
+        #Serializes materialization between report workers#
+        dbh.execute('BEGIN IMMEDIATE')
+        try:
+            row = dbh.execute(
+                "SELECT Key FROM '{}' WHERE TableName = ?".format(QueryCache.ENTRY_TABLE),
+                (table_name,)
+            ).fetchone()
+            
+            if row is not None and row[0] == key:
+                dbh.execute(
+                    "UPDATE '{}' SET LastUsed = ? WHERE Key = ?".format(QueryCache.ENTRY_TABLE),
+                    (time.time(),key)
+                )
+            else:
+                if row is not None:
+                    self._DropEntry(dbh,row[0],table_name)
+                
+                start = time.time()
+                dbh.execute(
+                    'CREATE TABLE main."{}" AS {}'.format(table_name,sql_string)
+                )
+                dbh.execute(
+                    "INSERT INTO '{}' (Key, TableName, Fingerprint, LastUsed) VALUES (?,?,?,?)".format(
+                        QueryCache.ENTRY_TABLE
+                    ),
+                    (key,table_name,self.fingerprint,time.time())
+                )
+                logging.info('materialized {} in {:.2f}s'.format(
+                    table_name,
+                    time.time() - start
+                ))
+                
+                self._Evict(dbh,key)
+                
+            dbh.execute('COMMIT')
+        except:
+            dbh.execute('ROLLBACK')
+            raise
+        
+        return table_name
+    
+    def _Evict(self,dbh,keep_key):
+        '''Drop the entries of other versions of the output db and the least
+        recently used entries above self.max_entries
+        
+        Args:
+            dbh: The cache db handle, in a transaction
+            keep_key: The key of the entry just created'''
+        entries = dbh.execute(
+            "SELECT Key, TableName, Fingerprint FROM '{}' ORDER BY LastUsed DESC".format(
+                QueryCache.ENTRY_TABLE
+            )
+        ).fetchall()
+        
+        kept = 0
+        for key,table_name,fingerprint in entries:
+            if key != keep_key:
+                if fingerprint != self.fingerprint or kept >= self.max_entries:
+                    self._DropEntry(dbh,key,table_name)
+                    continue
+            kept += 1
+    
+    def _DropEntry(self,dbh,key,table_name):
+        '''Drop a cache entry and its table'''
+        dbh.execute(
+            'DROP TABLE IF EXISTS main."{}"'.format(table_name)
+        )
+        dbh.execute(
+            "DELETE FROM '{}' WHERE Key = ?".format(QueryCache.ENTRY_TABLE),
+            (key,)
+        )
+    
+    def _GetCacheHandle(self):
+        '''Get the cache db handle with the output db attached'''
+        dbh = self.cacheDbHandler.GetDbHandle()
+        
+        attached = [row[1] for row in dbh.execute('PRAGMA database_list').fetchall()]
+        if 'srum' not in attached:
+            #Transactions are managed by Materialize#
+            dbh.isolation_level = None
+            dbh.execute('PRAGMA journal_mode=WAL').fetchall()
+            dbh.execute(
+                "CREATE TABLE IF NOT EXISTS '{}' (Key TEXT PRIMARY KEY, TableName TEXT, Fingerprint TEXT, LastUsed REAL)".format(
+                    QueryCache.ENTRY_TABLE
+                )
+            )
+            dbh.execute(
+                "ATTACH DATABASE ? AS srum",
+                (self.output_db,)
+            )
+            
+        return dbh
+
+def GetDbFingerprint(filename):
+    '''Return a fingerprint that changes whenever a db file changes'''
+    stat = os.stat(filename)
+    return hashlib.sha1(
+        '{}|{}|{}'.format(
+            os.path.abspath(filename),
+            stat.st_size,
+            stat.st_mtime
+        )
+    ).hexdigest()
+
+class WorkbookReporter():
+    '''Write every template that shares a workbook_name into one workbook.
+    The queries of the templates run at the same time in query threads
+    that feed this thread, the only one writing to the workbook.'''
+    #Records per message from a query thread#
+    ROWS_PER_MESSAGE = 1000
+    #Seconds a query thread waits on the full queue before checking if#
+    #the writer stopped#
+    PUT_TIMEOUT = 0.5
+    
+    def __init__(self,options,workbook_name,sql_files,queryCache=None):
+        '''Create a WorkbookReporter
+        
+        Args:
+            options: Options
+            workbook_name: The workbook file name
+            sql_files: The templates to write into the workbook
+            queryCache: The QueryCache to run the queries through'''
+        self.options = options
+        self.workbook_name = workbook_name
+        self.sql_files = sql_files
+        self.queryCache = queryCache
+        
+    def WriteWorkbook(self):
+        '''Write the workbook
+        
+        Returns:
+            results: A list of (sqlfile, seconds, rows, error) tuples'''
+        #Open XLSX File#
+        filename = os.path.join(
+            self.options.outpath,
+            self.workbook_name
+        )
+        logging.debug('creating workbook {}'.format(filename))
+        
+        #Create Workbook. Constant memory mode writes rows out as they come#
+        workbook = xlsxwriter.Workbook(
+            filename,
+            {
+                'constant_memory':True,
+                'in_memory':False
+            }
+        )
+        
+        reporters = []
+        for sqlfile in self.sql_files:
+            reporters.append(
+                Reporter(
+                    self.options,
+                    sqlfile,
+                    DbHandler(DbConfig(dbname=self.options.output_db)),
+                    queryCache=self.queryCache
+                )
+            )
+            
+        try:
+            results = self._FillWorksheets(workbook,reporters)
+        finally:
+            workbook.close()
+            
+        logging.info('finished writing {} (peak memory {})'.format(
+            self.workbook_name,
+            FormatByteSize(GetPeakMemory())
+        ))
+        
+        return results
+        
+    def _FillWorksheets(self,workbook,reporters):
+        '''Run a query thread per template and write what they send
+        
+        Args:
+            workbook: The xlsxwriter Workbook
+            reporters: A Reporter per template
+        Returns:
+            results: A list of (sqlfile, seconds, rows, error) tuples'''
+        #Bounded so the queries can not run far ahead of the writer#
+        message_queue = Queue.Queue(len(reporters) * 4)
+        #Set when the writer fails, so the query threads give up#
+        stop_event = threading.Event()
+        
+        #Every first worksheet is added before any query runs, so the#
+        #worksheets are in template order whichever query finishes first#
+        for reporter in reporters:
+            reporter.BeginReport(workbook)
+            
+        threads = []
+        start_times = []
+        for reporter_index,reporter in enumerate(reporters):
+            thread = threading.Thread(
+                target=self._QueryThread,
+                args=(reporter_index,reporter,message_queue,stop_event)
+            )
+            thread.daemon = True
+            start_times.append(time.time())
+            thread.start()
+            threads.append(thread)
+            
+        results = [None] * len(reporters)
+        remaining = len(reporters)
+        reporter_index = None
+        try:
+            while remaining > 0:
+                kind,reporter_index,payload = message_queue.get()
+                reporter = reporters[reporter_index]
+                
+                if kind == 'rows':
+                    column_names,records = payload
+                    reporter.WriteRecords(column_names,records)
+                    continue
+                
+                error = None
+                row_count = reporter.EndReport()
+                if kind == 'error':
+                    error = payload
+                    logging.error('Report {} failed:\n{}'.format(
+                        os.path.basename(reporter.sqlfilename),
+                        error
+                    ))
+                    
+                results[reporter_index] = (
+                    reporter.sqlfilename,
+                    time.time() - start_times[reporter_index],
+                    row_count,
+                    error
+                )
+                remaining -= 1
+        except Exception:
+            error = traceback.format_exc()
+            logging.error('Writing report {} failed:\n{}'.format(
+                os.path.basename(reporters[reporter_index].sqlfilename),
+                error
+            ))
+            
+            #Unblock the query threads so they close their handles#
+            stop_event.set()
+            while [query_thread for query_thread in threads if query_thread.is_alive()]:
+                try:
+                    message_queue.get(timeout=WorkbookReporter.PUT_TIMEOUT)
+                except Queue.Empty:
+                    pass
+                
+            for index,reporter in enumerate(reporters):
+                if results[index] is not None:
+                    continue
+                
+                report_error = error
+                if index != reporter_index:
+                    report_error = 'Not written, writing {} failed'.format(
+                        os.path.basename(reporters[reporter_index].sqlfilename)
+                    )
+                    
+                results[index] = (
+                    reporter.sqlfilename,
+                    time.time() - start_times[index],
+                    reporter.total_rows,
+                    report_error
+                )
+                
+        for thread in threads:
+            thread.join()
+            
+        return results
+    
+    def _QueryThread(self,reporter_index,reporter,message_queue,stop_event):
+        '''Run a template's query and send its records to the writer.
+        Messages are (kind, reporter_index, payload) tuples. Gives up when
+        stop_event is set.'''
+        try:
+            #A new handle for this thread that must never write#
+            reporter.dbHandler.SetProfile('read_only')
+            
+            column_names = None
+            records = []
+            for column_names,record in reporter.FetchRecords():
+                records.append(record)
+                if len(records) >= WorkbookReporter.ROWS_PER_MESSAGE:
+                    if not self._SendMessage(message_queue,stop_event,('rows',reporter_index,(column_names,records))):
+                        return
+                    records = []
+                    
+            if records:
+                if not self._SendMessage(message_queue,stop_event,('rows',reporter_index,(column_names,records))):
+                    return
+            self._SendMessage(message_queue,stop_event,('done',reporter_index,None))
+        except Exception:
+            self._SendMessage(message_queue,stop_event,('error',reporter_index,traceback.format_exc()))
+        finally:
+            reporter.dbHandler.db_config.CloseConnection()
+            if reporter.queryCache is not None:
+                reporter.queryCache.cacheDbConfig.CloseConnection()
+                
+    def _SendMessage(self,message_queue,stop_event,message):
+        '''Put a message on the queue unless the writer stopped
+        
+        Returns:
+            True if the message was put, False if the writer stopped'''
+        while not stop_event.is_set():
+            try:
+                message_queue.put(message,timeout=WorkbookReporter.PUT_TIMEOUT)
+                return True
+            except Queue.Full:
+                pass
+            
+        return False
+
+class Reporter():
+    '''Write the records of a template's query to worksheets of a workbook'''
+    #Rows in an Excel worksheet, including the header row#
+    MAX_XLSX_ROWS = 1048576
+    
+    def __init__(self,options,sqlfile,dbHandler,queryCache=None):
+        '''Create Reporter using options from .yml template'''
+        self.options = options
+        self.sqlfilename = sqlfile
+        self.dbHandler = dbHandler
+        self.queryCache = queryCache
+        
+        self.properties = LoadTemplate(
+            self.sqlfilename
+        )
+        
+    def BeginReport(self,workbook):
+        '''Prepare to write records to workbook.
+        
+        Records are written one row at a time. Results with more rows
+        than a worksheet can hold continue on additional worksheets.
+        
+        Args:
+            workbook: The xlsxwriter Workbook'''
+        self.workbook = workbook
+        
+        #Resolve how every column is converted and formatted#
+        self.converters,self.column_formats = self._CompileColumnPipeline(
+            workbook
+        )
+        
+        self.worksheet = None
+        self.worksheet_cnt = 0
+        self.column_cnt = 0
+        self.row_num = 1
+        self.total_rows = 0
+        
+        #The first worksheet is added now, its header row is written with#
+        #the first records#
+        if workbook is not None:
+            self.worksheet_cnt = 1
+            self.worksheet = self._AddWorksheet(
+                workbook,
+                self.worksheet_cnt,
+                None,
+                self.column_formats
+            )
+        
+    def WriteRecords(self,column_names,records):
+        '''Write records to the worksheet
+        
+        Args:
+            column_names: The header row
+            records: A list of records'''
+        converters = self.converters
+        worksheet = self.worksheet
+        row_num = self.row_num
+        if records and worksheet is not None and self.column_cnt == 0:
+            #The header row of the worksheet added by BeginReport#
+            self.column_cnt = len(column_names)
+            worksheet.write_row(0,0,column_names)
+            
+        for record in records:
+            if worksheet is None or row_num >= Reporter.MAX_XLSX_ROWS:
+                if worksheet is not None:
+                    self._FinishWorksheet(
+                        worksheet,
+                        row_num,
+                        self.column_cnt
+                    )
+                
+                self.column_cnt = len(column_names)
+                self.worksheet_cnt = self.worksheet_cnt + 1
+                worksheet = self._AddWorksheet(
+                    self.workbook,
+                    self.worksheet_cnt,
+                    column_names,
+                    self.column_formats
+                )
+                row_num = 1
+                
+            if converters:
+                row = list(record)
+                for c_cnt,converter in converters:
+                    row[c_cnt] = converter(row[c_cnt])
+            else:
+                row = record
+                
+            #Column formats are applied by the worksheet's column settings#
+            worksheet.write_row(
+                row_num,
+                0,
+                row
+            )
+            
+            row_num = row_num+1
+            
+        self.total_rows = self.total_rows + len(records)
+        self.worksheet = worksheet
+        self.row_num = row_num
+        
+    def EndReport(self):
+        '''Finish the last worksheet
+        
+        Returns:
+            total_rows: The number of records written'''
+        if self.column_cnt > 0:
+            self._FinishWorksheet(
+                self.worksheet,
+                self.row_num,
+                self.column_cnt
+            )
+        elif self.worksheet is None:
+            #No records, keep the empty worksheet#
+            self._AddWorksheet(
+                self.workbook,
+                1,
+                [],
+                {}
+            )
+        
+        logging.info('finished writing {} records over {} worksheets'.format(
+            self.total_rows,
+            self.worksheet_cnt
+        ))
+        
+        return self.total_rows
+        
+    def FetchRecords(self):
+        '''Run the template's query, through the query cache if there is one'''
+        sql_query,shared_subqueries = GetTemplateQueries(
+            self.properties,
+            self.options.merge_key
+        )
+        if self.queryCache is None:
+            return self.dbHandler.FetchRecords(
+                sql_query
+            )
+        
+        return self.queryCache.FetchRecords(
+            self.dbHandler,
+            sql_query,
+            shared_subqueries=shared_subqueries
+        )
+    
+    def _CompileColumnPipeline(self,workbook=None):
+        '''Resolve the converter and format of every column in the template's
+        xlsx_column_formats once, before any record is written.
+        
+        Args:
+            workbook: The xlsxwriter Workbook, or None for converters only
+        Returns:
+            converters: A list of (column number, converter) tuples
+            column_formats: A dictionary of column number to Format'''
+        converters = []
+        column_formats = {}
+        
+        xlsx_column_formats = self.properties.get('xlsx_column_formats',None) or {}
+        for column_number in sorted(xlsx_column_formats.keys()):
+            column_info = xlsx_column_formats[column_number]
+            
+            #Add Column Formats#
+            if 'format' in column_info and workbook is not None:
+                column_formats[column_number] = workbook.add_format(
+                    column_info['format']
+                )
+            
+            '''Supported column_type's ['datetime']'''
+            if column_info.get('column_type',None) == 'datetime':
+                converters.append((
+                    column_number,
+                    GetDatetimeConverter(
+                        column_info['strptime'],
+                        self.options.timestamp_format
+                    )
+                ))
+                
+        return converters,column_formats
+        
+    def _AddWorksheet(self,workbook,worksheet_cnt,column_names,column_formats):
+        '''Add a worksheet with the header row and column formats
+        
+        Args:
+            workbook: The xlsxwriter Workbook
+            worksheet_cnt: The number of this worksheet for the report
+            column_names: The header row, None to write it later
+            column_formats: A dictionary of column number to Format
+        Returns:
+            worksheet: The new worksheet'''
+        base_name = self.properties['worksheet_name']
+        worksheet_name = base_name
+        
+        #Templates sharing a workbook may use the same worksheet_name#
+        suffix_cnt = worksheet_cnt
+        if suffix_cnt == 1 and workbook.get_worksheet_by_name(worksheet_name) is not None:
+            suffix_cnt = 2
+            
+        while suffix_cnt > 1:
+            #Worksheet names are limited to 31 characters#
+            suffix = ' ({})'.format(suffix_cnt)
+            worksheet_name = base_name[0:31 - len(suffix)] + suffix
+            if workbook.get_worksheet_by_name(worksheet_name) is None:
+                break
+            suffix_cnt = suffix_cnt + 1
+        
+        #Create Worksheet#
+        worksheet = workbook.add_worksheet(
+            worksheet_name
+        )
+        
+        for column_number,formatter in column_formats.items():
+            worksheet.set_column(
+                column_number,
+                column_number,
+                None,
+                formatter
+            )
+        
+        if column_names is not None:
+            worksheet.write_row(0,0,column_names)
+        
+        return worksheet
+    
+    def _FinishWorksheet(self,worksheet,row_num,column_cnt):
+        '''Add the autofilter and freeze panes to a filled worksheet
+        
+        Args:
+            worksheet: The worksheet
+            row_num: The row after the last written row
+            column_cnt: The number of columns'''
+        worksheet.autofilter(
+            0,
+            0,
+            row_num - 1,
+            column_cnt - 1
+        )
+        
+        #Freeze Panes#
+        if 'freeze_panes' in self.properties:
+            worksheet.freeze_panes(
+                self.properties['freeze_panes']['row'],
+                self.properties['freeze_panes']['columns'],
+            )
+
+class StreamReporter(Reporter):
+    '''Write the records of a csv or jsonl template to a file as they are
+    fetched. The xlsx_column_formats datetime conversions are applied and
+    the converted datetimes are written in ISO 8601, 'YYYY-MM-DDTHH:MM:SS'.
+    Other columns are written as SQLite returns them, so a DATETIME column
+    without a conversion keeps its stored 'YYYY-MM-DD HH:MM:SS' text.
+    BLOBs are written as hex.'''
+    OUTPUT_FORMATS = ['csv','jsonl']
+    
+    def WriteReport(self):
+        '''Write the report
+        
+        Returns:
+            result: A (sqlfile, seconds, rows, error) tuple'''
+        start = time.time()
+        filename = os.path.join(
+            self.options.outpath,
+            self.GetOutputName()
+        )
+        logging.debug('creating report {}'.format(filename))
+        
+        error = None
+        row_count = 0
+        try:
+            output_format = self.properties['output_format']
+            if output_format not in StreamReporter.OUTPUT_FORMATS:
+                raise Exception('Unknown output_format: {}'.format(output_format))
+            
+            self.dbHandler.SetProfile('read_only')
+            self.converters,column_formats = self._CompileColumnPipeline()
+            
+            with self._OpenOutput(filename) as outfh:
+                if output_format == 'csv':
+                    row_count = self._WriteCsv(outfh)
+                else:
+                    row_count = self._WriteJsonLines(outfh)
+        except Exception:
+            error = traceback.format_exc()
+            logging.error('Report {} failed:\n{}'.format(
+                os.path.basename(self.sqlfilename),
+                error
+            ))
+        finally:
+            self.dbHandler.db_config.CloseConnection()
+            if self.queryCache is not None:
+                self.queryCache.cacheDbConfig.CloseConnection()
+                
+        logging.info('finished writing {} records to {}'.format(
+            row_count,
+            filename
+        ))
+        
+        return (
+            self.sqlfilename,
+            time.time() - start,
+            row_count,
+            error
+        )
+        
+    def GetOutputName(self):
+        '''Get the output file name. This is the template's output_name, or
+        its worksheet_name with the format's extension. Compressed output
+        gets a .gz extension.'''
+        output_name = self.properties.get('output_name',None)
+        if output_name is None:
+            output_name = '{}.{}'.format(
+                self.properties['worksheet_name'],
+                self.properties['output_format']
+            )
+            
+        if self.properties.get('gzip',False) and not output_name.endswith('.gz'):
+            output_name = output_name + '.gz'
+            
+        return output_name
+    
+    def _OpenOutput(self,filename):
+        '''Open the output file for buffered binary writes'''
+        if self.properties.get('gzip',False):
+            return io.BufferedWriter(
+                gzip.GzipFile(filename,'wb'),
+                DEFAULT_STREAM_BUFFER
+            )
+        
+        return io.open(
+            filename,
+            'wb',
+            buffering=DEFAULT_STREAM_BUFFER
+        )
+    
+    def _GetRows(self):
+        '''Generator of the header row followed by the converted records of
+        the query. There is no header row without records.'''
+        converters = self.converters
+        header = True
+        for column_names,record in self.FetchRecords():
+            if header:
+                yield column_names
+                header = False
+                
+            if converters:
+                record = list(record)
+                for c_cnt,converter in converters:
+                    record[c_cnt] = converter(record[c_cnt])
+                    
+            yield record
+            
+    def _WriteCsv(self,outfh):
+        '''Write the records as utf-8 CSV with a header row
+        
+        Returns:
+            row_count: The number of records written'''
+        writer = csv.writer(outfh)
+        row_count = -1
+        for row in self._GetRows():
+            writer.writerow(
+                [ToCsvValue(value) for value in row]
+            )
+            row_count += 1
+            
+        return max(row_count,0)
+    
+    def _WriteJsonLines(self,outfh):
+        '''Write the records as one JSON object per line, keyed by column
+        
+        Returns:
+            row_count: The number of records written'''
+        encoder = json.JSONEncoder(
+            default=ToJsonValue
+        )
+        column_names = None
+        row_count = 0
+        for row in self._GetRows():
+            if column_names is None:
+                column_names = row
+                continue
+            
+            outfh.write(
+                encoder.encode(collections.OrderedDict(zip(column_names,row)))
+            )
+            outfh.write('\n')
+            row_count += 1
+            
+        return row_count
+
+def ToCsvValue(value):
+    '''Convert a value for the csv module, which only writes byte strings'''
+    if isinstance(value,unicode):
+        return value.encode('utf-8')
+    elif isinstance(value,datetime.datetime):
+        return value.isoformat()
+    elif isinstance(value,type(sqlite3.Binary(''))):
+        return str(value).encode('hex')
+    
+    return value
+
+def ToJsonValue(value):
+    '''Convert a value the json module can not encode'''
+    if isinstance(value,datetime.datetime):
+        return value.isoformat()
+    elif isinstance(value,type(sqlite3.Binary(''))):
+        return str(value).encode('hex')
+    
+    raise TypeError('{!r} is not JSON serializable'.format(value))
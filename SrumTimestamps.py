@@ -0,0 +1,256 @@
+'''Decode the OLE and FILETIME timestamps of SRUM'''
+import struct
+import datetime
+import math
+
+#Microseconds from the OLE and FILETIME epochs to the unix epoch#
+OLE_EPOCH_OFFSET = -2209161600000000
+FILETIME_EPOCH_OFFSET = -11644473600000000
+#The epoch microseconds a datetime can hold (years 1 to 9999)#
+MIN_EPOCH_MICROSECONDS = -62135596800000000
+MAX_EPOCH_MICROSECONDS = 253402300799999999
+MAX_FILETIME = (MAX_EPOCH_MICROSECONDS - FILETIME_EPOCH_OFFSET) * 10 + 9
+UNIX_EPOCH = datetime.datetime(1970,1,1)
+ZERO_TIMESTAMP = '\x00' * 8
+#strptime formats of the text form SQLite stores datetimes in#
+STORED_DATETIME_FORMATS = ['%Y-%m-%d %H:%M:%S','%Y-%m-%d %H:%M:%S.%f']
+
+#numpy is only needed to decode timestamps a column at a time. It is#
+#imported on first use, reports only format timestamps and skip it#
+_NUMPY = []
+
+def GetNumpy():
+    '''Return the numpy module, or None if it is not installed'''
+    if not _NUMPY:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _NUMPY.append(numpy)
+        
+    return _NUMPY[0]
+
+def GetOleTimeStamp(raw_timestamp):
+    '''Return Datetime from raw OleTimestamp, None if zero or invalid'''
+    return DecodeTimestamp(
+        raw_timestamp,
+        'ole',
+        'datetime'
+    )
+
+def GetWinTimeStamp(raw_timestamp):
+    '''Return Datetime from raw Win32Timestamp, None if zero or invalid'''
+    return DecodeTimestamp(
+        raw_timestamp,
+        'filetime',
+        'datetime'
+    )
+
+def DecodeTimestamp(raw_timestamp,kind,timestamp_format):
+    '''Decode a raw timestamp. FILETIMEs are kept as they are in the
+    filetime format, everything else goes through epoch microseconds.
+    
+    Args:
+        raw_timestamp: 8 bytes of OLE or FILETIME data
+        kind: 'ole' or 'filetime'
+        timestamp_format: 'datetime', 'iso', 'epoch' or 'filetime'
+    Returns:
+        value: The value as FormatTimestamp returns it'''
+    microseconds = GetTimestampMicroseconds(raw_timestamp,kind)
+    if microseconds is not None and kind == 'filetime' and timestamp_format == 'filetime':
+        return struct.unpack('<Q',raw_timestamp)[0]
+    
+    return FormatTimestamp(
+        microseconds,
+        timestamp_format
+    )
+
+def GetTimestampMicroseconds(raw_timestamp,kind):
+    '''Return the unix epoch microseconds of a raw timestamp. OLE days are
+    rounded to the microsecond like datetime.timedelta does.
+    
+    Args:
+        raw_timestamp: 8 bytes of OLE (double days since 1899-12-30) or
+            FILETIME (100ns intervals since 1601-01-01) data
+        kind: 'ole' or 'filetime'
+    Returns:
+        microseconds: The epoch microseconds, or None if the timestamp is
+            zero, invalid or out of the range of a datetime'''
+    if raw_timestamp is None or len(raw_timestamp) != 8:
+        return None
+    
+    if kind == 'ole':
+        days = struct.unpack('<d',raw_timestamp)[0]
+        if days == 0 or math.isnan(days) or math.isinf(days):
+            return None
+        
+        whole_days = int(days)
+        day_microseconds = (days - whole_days) * 86400000000.0
+        whole_microseconds = int(day_microseconds)
+        leftover = day_microseconds - whole_microseconds
+        if leftover >= 0.5:
+            whole_microseconds += 1
+        elif leftover <= -0.5:
+            whole_microseconds -= 1
+            
+        microseconds = whole_days * 86400000000 + whole_microseconds + OLE_EPOCH_OFFSET
+    else:
+        filetime = struct.unpack('<Q',raw_timestamp)[0]
+        if filetime == 0:
+            return None
+        
+        microseconds = filetime // 10 + FILETIME_EPOCH_OFFSET
+        
+    if microseconds < MIN_EPOCH_MICROSECONDS or microseconds > MAX_EPOCH_MICROSECONDS:
+        return None
+    
+    return microseconds
+
+def FormatTimestamp(microseconds,timestamp_format):
+    '''Return epoch microseconds in a --timestamp_format
+    
+    Args:
+        microseconds: The epoch microseconds, or None
+        timestamp_format: 'datetime', 'iso', 'epoch' or 'filetime'
+    Returns:
+        value: A datetime, its text form, the epoch microseconds, the
+            FILETIME or None'''
+    if microseconds is None or timestamp_format == 'epoch':
+        return microseconds
+    elif timestamp_format == 'filetime':
+        return (microseconds - FILETIME_EPOCH_OFFSET) * 10
+    
+    value = UNIX_EPOCH + datetime.timedelta(microseconds=microseconds)
+    if timestamp_format == 'iso':
+        return str(value)
+    
+    return value
+
+def ParseDatetime(text):
+    '''Parse the text form SQLite stores a datetime in, 'YYYY-MM-DD
+    HH:MM:SS' with or without '.ffffff', without the cost of strptime
+    
+    Args:
+        text: The stored text
+    Returns:
+        value: The datetime, or None if text is not in that form'''
+    length = len(text)
+    if length not in (19,26) or text[4] != '-' or text[7] != '-' or text[10] != ' ' or text[13] != ':' or text[16] != ':':
+        return None
+    if length == 26 and text[19] != '.':
+        return None
+    
+    try:
+        return datetime.datetime(
+            int(text[0:4]),
+            int(text[5:7]),
+            int(text[8:10]),
+            int(text[11:13]),
+            int(text[14:16]),
+            int(text[17:19]),
+            int(text[20:26]) if length == 26 else 0
+        )
+    except ValueError:
+        return None
+
+def DecodeTimestampColumn(raw_timestamps,kind,timestamp_format):
+    '''Decode a column of raw timestamps in one NumPy pass. Without NumPy
+    they are decoded one at a time.
+    
+    Args:
+        raw_timestamps: A sequence of raw timestamps or None
+        kind: 'ole' or 'filetime'
+        timestamp_format: 'datetime', 'iso', 'epoch' or 'filetime'
+    Returns:
+        values: A list of values as DecodeTimestamp returns them'''
+    numpy = GetNumpy()
+    if numpy is None:
+        return [
+            DecodeTimestamp(raw_timestamp,kind,timestamp_format)
+            for raw_timestamp in raw_timestamps
+        ]
+    
+    #Missing and malformed values are decoded as zero, which is invalid#
+    data = ''.join([
+        raw_timestamp if raw_timestamp is not None and len(raw_timestamp) == 8 else ZERO_TIMESTAMP
+        for raw_timestamp in raw_timestamps
+    ])
+    
+    with numpy.errstate(invalid='ignore',over='ignore'):
+        if kind == 'ole':
+            days = numpy.frombuffer(data,dtype='<f8')
+            #Beyond 1e7 days is out of range and would overflow int64#
+            valid = numpy.isfinite(days) & (days != 0) & (numpy.abs(days) < 1e7)
+            days = numpy.where(valid,days,0.0)
+            
+            whole_days = numpy.trunc(days)
+            day_microseconds = (days - whole_days) * 86400000000.0
+            whole_microseconds = numpy.trunc(day_microseconds)
+            leftover = day_microseconds - whole_microseconds
+            whole_microseconds += numpy.where(numpy.abs(leftover) >= 0.5,numpy.sign(leftover),0.0)
+            
+            microseconds = (
+                whole_days.astype(numpy.int64) * 86400000000 +
+                whole_microseconds.astype(numpy.int64) +
+                OLE_EPOCH_OFFSET
+            )
+        else:
+            filetime = numpy.frombuffer(data,dtype='<u8')
+            valid = (filetime != 0) & (filetime <= MAX_FILETIME)
+            microseconds = (
+                (numpy.where(valid,filetime,0) // 10).astype(numpy.int64) +
+                FILETIME_EPOCH_OFFSET
+            )
+            
+    valid &= (microseconds >= MIN_EPOCH_MICROSECONDS) & (microseconds <= MAX_EPOCH_MICROSECONDS)
+    microseconds = numpy.where(valid,microseconds,0)
+    
+    if timestamp_format == 'epoch':
+        values = microseconds.tolist()
+    elif timestamp_format == 'filetime':
+        if kind == 'filetime':
+            values = numpy.where(valid,filetime,0).astype(numpy.int64).tolist()
+        else:
+            values = ((microseconds - FILETIME_EPOCH_OFFSET) * 10).tolist()
+    else:
+        stamps = microseconds.astype('datetime64[us]')
+        if timestamp_format == 'iso':
+            #The text form of str(datetime), which drops zero microseconds#
+            values = numpy.char.replace(
+                numpy.where(
+                    microseconds % 1000000 == 0,
+                    numpy.datetime_as_string(stamps,unit='s'),
+                    numpy.datetime_as_string(stamps,unit='us')
+                ),
+                'T',
+                ' '
+            ).astype(str).tolist()
+        else:
+            values = stamps.astype(object).tolist()
+            
+    return [
+        value if is_valid else None
+        for value,is_valid in zip(values,valid.tolist())
+    ]
+
+def DecodeTimestampColumns(records,timestamp_columns,timestamp_format):
+    '''Decode the raw timestamp columns of a batch of records
+    
+    Args:
+        records: A list of records with raw timestamp columns
+        timestamp_columns: A list of (column index, kind) tuples
+        timestamp_format: 'datetime', 'iso', 'epoch' or 'filetime'
+    Returns:
+        records: A list of decoded records'''
+    if not timestamp_columns or not records:
+        return records
+    
+    columns = zip(*records)
+    for index,kind in timestamp_columns:
+        columns[index] = DecodeTimestampColumn(
+            columns[index],
+            kind,
+            timestamp_format
+        )
+        
+    return zip(*columns)
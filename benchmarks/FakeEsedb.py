@@ -0,0 +1,266 @@
+'''A synthetic stand-in for the pyesedb module used by SrumBenchmark.py
+
+It generates SRUM shaped tables from a JSON spec instead of reading an ESE
+database. Values come from small per column pools so that generating a
+record costs next to nothing next to decoding it.'''
+import struct
+import json
+import random
+import uuid
+
+class column_types(object):
+    '''The pyesedb column type constants'''
+    NULL = 0
+    BOOLEAN = 1
+    INTEGER_8BIT_UNSIGNED = 2
+    INTEGER_16BIT_SIGNED = 3
+    INTEGER_32BIT_SIGNED = 4
+    CURRENCY = 5
+    FLOAT_32BIT = 6
+    DOUBLE_64BIT = 7
+    DATE_TIME = 8
+    BINARY_DATA = 9
+    TEXT = 10
+    LARGE_BINARY_DATA = 11
+    LARGE_TEXT = 12
+    SUPER_LARGE_VALUE = 13
+    INTEGER_32BIT_UNSIGNED = 14
+    INTEGER_64BIT_SIGNED = 15
+    GUID = 16
+    INTEGER_16BIT_UNSIGNED = 17
+
+#Values generated per column, records pick from these#
+POOL_SIZE = 4096
+#Share of the pooled values that are NULL#
+NULL_RATE = 0.02
+
+#Microseconds and 100ns intervals of a day#
+DAY_MICROSECONDS = 86400000000
+#OLE days and FILETIME of 2015-01-01#
+OLE_START = 42005.0
+FILETIME_START = 130645440000000000
+
+#SRUM shaped tables as (name, [(column, type)], records per row count)#
+#A records value of None is the benchmark row count#
+TABLES = [
+    ('SruDbIdMapTable',[
+        ('IdType',column_types.INTEGER_8BIT_UNSIGNED),
+        ('IdIndex',column_types.INTEGER_32BIT_SIGNED),
+        ('IdBlob',column_types.LARGE_BINARY_DATA)
+    ],'ids'),
+    ('{973F5D5C-1D90-4944-BE8E-24B94231A174}',[
+        ('AutoIncId',column_types.INTEGER_32BIT_SIGNED),
+        ('TimeStamp',column_types.DATE_TIME),
+        ('AppId',column_types.INTEGER_32BIT_SIGNED),
+        ('UserId',column_types.INTEGER_32BIT_SIGNED),
+        ('InterfaceLuid',column_types.INTEGER_64BIT_SIGNED),
+        ('L2ProfileId',column_types.INTEGER_32BIT_SIGNED),
+        ('L2ProfileFlags',column_types.INTEGER_32BIT_SIGNED),
+        ('BytesSent',column_types.INTEGER_64BIT_SIGNED),
+        ('BytesRecvd',column_types.INTEGER_64BIT_SIGNED)
+    ],None),
+    ('{D10CA2FE-6FCF-4F6D-848E-B2E99266FA89}',[
+        ('AutoIncId',column_types.INTEGER_32BIT_SIGNED),
+        ('TimeStamp',column_types.DATE_TIME),
+        ('AppId',column_types.INTEGER_32BIT_SIGNED),
+        ('UserId',column_types.INTEGER_32BIT_SIGNED),
+        ('ForegroundCycleTime',column_types.INTEGER_64BIT_SIGNED),
+        ('BackgroundCycleTime',column_types.INTEGER_64BIT_SIGNED),
+        ('FaceTime',column_types.INTEGER_64BIT_SIGNED),
+        ('ForegroundBytesRead',column_types.INTEGER_64BIT_SIGNED),
+        ('BackgroundBytesWritten',column_types.INTEGER_64BIT_SIGNED)
+    ],None),
+    #Every column type SrumHandler.SQLITE_TYPE maps, and the custom columns#
+    ('SrumBenchmarkAllTypes',[
+        ('AutoIncId',column_types.INTEGER_32BIT_SIGNED),
+        ('TimeStamp',column_types.DATE_TIME),
+        ('Boolean',column_types.BOOLEAN),
+        ('UInt8',column_types.INTEGER_8BIT_UNSIGNED),
+        ('Int16',column_types.INTEGER_16BIT_SIGNED),
+        ('UInt16',column_types.INTEGER_16BIT_UNSIGNED),
+        ('UInt32',column_types.INTEGER_32BIT_UNSIGNED),
+        ('Int64',column_types.INTEGER_64BIT_SIGNED),
+        ('Float32',column_types.FLOAT_32BIT),
+        ('Double64',column_types.DOUBLE_64BIT),
+        ('Binary',column_types.BINARY_DATA),
+        ('LargeBinary',column_types.LARGE_BINARY_DATA),
+        ('Text',column_types.TEXT),
+        ('LargeText',column_types.LARGE_TEXT),
+        ('SuperLargeValue',column_types.SUPER_LARGE_VALUE),
+        ('Guid',column_types.GUID),
+        ('EventTimestamp',column_types.INTEGER_64BIT_SIGNED),
+        ('ConnectStartTime',column_types.INTEGER_64BIT_SIGNED),
+        ('LocaleName',column_types.BINARY_DATA)
+    ],None)
+]
+
+def WriteSpec(filename,row_count,id_count,seed=0):
+    '''Write the spec of a synthetic SRUM db, used as the --srum_db
+
+    Args:
+        filename: The spec file
+        row_count: The number of records of the usage tables
+        id_count: The number of records of SruDbIdMapTable
+        seed: The random seed of the values'''
+    tables = []
+    for name,columns,records in TABLES:
+        tables.append({
+            'name':name,
+            'columns':columns,
+            'records':id_count if records == 'ids' else row_count
+        })
+
+    with open(filename,'wb') as specfh:
+        json.dump(
+            {'seed':seed,'id_count':id_count,'tables':tables},
+            specfh,
+            indent=2
+        )
+
+def GetValuePool(name,column_type,pool_size,id_count,rand):
+    '''Generate the raw values records of a column pick from
+
+    Returns:
+        pool: A list of pool_size raw values or None'''
+    pool = []
+    for index in xrange(pool_size):
+        if name not in ('AutoIncId','IdIndex','IdType','IdBlob') and rand.random() < NULL_RATE:
+            pool.append(None)
+        else:
+            pool.append(
+                GetValue(name,column_type,index,id_count,rand)
+            )
+
+    return pool
+
+def GetValue(name,column_type,index,id_count,rand):
+    '''Generate a raw value of a column'''
+    if name == 'IdType':
+        return struct.pack('<B',3 if index % 8 == 7 else 0)
+    elif name == 'IdBlob':
+        if index % 8 == 7:
+            #A S-1-5-21-x-y-z-rid SID#
+            return struct.pack('<BB',1,5) + struct.pack('>Q',5)[2:] + struct.pack(
+                '<5I',21,rand.randint(1,2**31),rand.randint(1,2**31),rand.randint(1,2**31),1000 + index
+            )
+        return u'\\Device\\HarddiskVolume2\\Program Files\\App{0}\\app{0}.exe'.format(index).encode('utf-16le')
+    elif name in ('AppId','UserId'):
+        return struct.pack('<i',rand.randint(1,max(1,id_count)))
+    elif name in ('EventTimestamp','ConnectStartTime'):
+        return struct.pack('<Q',FILETIME_START + rand.randint(0,365 * DAY_MICROSECONDS) * 10)
+    elif name == 'LocaleName':
+        return u'en-US'.encode('utf-16le')
+    elif column_type == column_types.DATE_TIME:
+        return struct.pack('<d',OLE_START + rand.randint(0,365 * 24 * 3600) / 86400.0)
+    elif column_type == column_types.BOOLEAN:
+        return struct.pack('<?',rand.random() < 0.5)
+    elif column_type == column_types.INTEGER_8BIT_UNSIGNED:
+        return struct.pack('<B',rand.randint(0,255))
+    elif column_type == column_types.INTEGER_16BIT_SIGNED:
+        return struct.pack('<h',rand.randint(-32768,32767))
+    elif column_type == column_types.INTEGER_16BIT_UNSIGNED:
+        return struct.pack('<H',rand.randint(0,65535))
+    elif column_type == column_types.INTEGER_32BIT_SIGNED:
+        return struct.pack('<i',rand.randint(-2**31,2**31 - 1))
+    elif column_type == column_types.INTEGER_32BIT_UNSIGNED:
+        return struct.pack('<I',rand.randint(0,2**32 - 1))
+    elif column_type == column_types.INTEGER_64BIT_SIGNED:
+        return struct.pack('<q',rand.randint(0,2**40))
+    elif column_type == column_types.FLOAT_32BIT:
+        return struct.pack('<f',rand.random())
+    elif column_type == column_types.DOUBLE_64BIT:
+        return struct.pack('<d',rand.random() * 1e6)
+    elif column_type in (column_types.BINARY_DATA,column_types.LARGE_BINARY_DATA):
+        return ''.join([chr(rand.randint(0,255)) for i in xrange(rand.randint(8,64))])
+    elif column_type in (column_types.TEXT,column_types.LARGE_TEXT,column_types.SUPER_LARGE_VALUE):
+        return 'value {} {}'.format(name,rand.randint(0,10 ** 6))
+    elif column_type == column_types.GUID:
+        return uuid.UUID(int=rand.getrandbits(128)).bytes_le
+
+    raise Exception('No generator for column type {}'.format(column_type))
+
+class Column(object):
+    '''A pyesedb column'''
+    def __init__(self,name,column_type):
+        self.name = name
+        self.type = column_type
+
+class Record(object):
+    '''A pyesedb record, its values are picked from the column pools'''
+    def __init__(self,table,index):
+        self.table = table
+        self.index = index
+
+    def get_value_data(self,column_index):
+        if column_index == self.table.sequential_column:
+            #AutoIncId and IdIndex count up#
+            return struct.pack('<i',self.index + 1)
+
+        #Same pool position for every column, IdBlob depends on IdType#
+        return self.table.pools[column_index][self.index % self.table.pool_size]
+
+    def get_column_name(self,column_index):
+        return self.table.columns[column_index].name
+
+    def get_column_type(self,column_index):
+        return self.table.columns[column_index].type
+
+    def get_number_of_values(self):
+        return len(self.table.columns)
+
+class Table(object):
+    '''A pyesedb table'''
+    def __init__(self,name,columns,record_count,id_count,rand):
+        self.name = name
+        self.columns = [Column(column_name,column_type) for column_name,column_type in columns]
+        self.record_count = record_count
+        self.pool_size = max(1,min(POOL_SIZE,record_count))
+        self.pools = [
+            GetValuePool(column.name,column.type,self.pool_size,id_count,rand) for column in self.columns
+        ]
+        self.sequential_column = None
+        for column_index,column in enumerate(self.columns):
+            if column.name in ('AutoIncId','IdIndex'):
+                self.sequential_column = column_index
+
+    def get_number_of_columns(self):
+        return len(self.columns)
+
+    def get_number_of_records(self):
+        return self.record_count
+
+    def get_record(self,index):
+        return Record(self,index)
+
+    @property
+    def records(self):
+        return (Record(self,index) for index in xrange(self.record_count))
+
+class file(object):
+    '''A pyesedb file, opened from a spec written by WriteSpec'''
+    def __init__(self):
+        self.tables = []
+
+    def open(self,filename):
+        with open(filename,'rb') as specfh:
+            spec = json.load(specfh)
+
+        rand = random.Random(spec['seed'])
+        self.tables = [
+            Table(
+                table['name'],
+                table['columns'],
+                table['records'],
+                spec['id_count'],
+                rand
+            ) for table in spec['tables']
+        ]
+
+    def get_number_of_tables(self):
+        return len(self.tables)
+
+    def get_table(self,index):
+        return self.tables[index]
+
+    def close(self):
+        pass
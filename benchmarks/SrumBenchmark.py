@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+
+# Benchmark the SrumMonkey conversion and reports on synthetic SRUM data
+#
+# Copyright (C) 2015, G-C Partners, LLC <dev@g-cpartners.com>
+# G-C Partners licenses this file to you under the Apache License, Version
+# 2.0 (the "License"); you may not use this file except in compliance with the
+# License.  You may obtain a copy of the License at:
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+import sys
+import os
+import argparse
+import multiprocessing
+import platform
+import shutil
+import sqlite3
+import tempfile
+import subprocess
+import json
+import logging
+import time
+import traceback
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,BENCHMARK_DIR)
+sys.path.insert(1,os.path.dirname(BENCHMARK_DIR))
+
+#SrumMonkey reads the synthetic tables through the fake pyesedb#
+import FakeEsedb
+sys.modules['pyesedb'] = FakeEsedb
+
+import SrumMonkey
+import SrumDb
+import SrumConverter
+import SrumTimestamps
+import SrumReports
+
+#Records of the usage tables per run#
+DEFAULT_ROWS = [10000]
+#Records of SruDbIdMapTable, the number of distinct apps and users#
+DEFAULT_IDS = 2000
+#Seconds a conversion only or report only run of an empty db may take#
+DEFAULT_STARTUP_BUDGET = 1.0
+#Modules whose loading is reported by the startup measurement, pyesedb#
+#is the fake and always loaded, SrumConverter is what loads it#
+STARTUP_MODULES = ['SrumConverter','SrumRegistry','SrumReports','Registry','numpy','pyarrow','xlsxwriter','yaml']
+
+#Runs SrumMonkey.Main in a fresh interpreter and prints what it loaded#
+STARTUP_SCRIPT = '''import sys
+import time
+import json
+import StringIO
+start = time.time()
+sys.path[:0] = {paths}
+import FakeEsedb
+sys.modules['pyesedb'] = FakeEsedb
+sys.argv = {argv}
+import SrumMonkey
+imported = time.time() - start
+stdout = sys.stdout
+sys.stdout = StringIO.StringIO()
+SrumMonkey.Main()
+sys.stdout = stdout
+print json.dumps({{
+    'import_seconds':imported,
+    'modules':[name for name in {modules} if name in sys.modules]
+}})
+'''
+
+#Templates run in the report stage, written to the run folder#
+XLSX_TEMPLATE = '''workbook_name: 'SrumBenchmark.xlsx'
+worksheet_name: 'BytesByApp'
+sql_query: |
+    SELECT
+    SrumIdMap.IdName AS AppName,
+    COUNT(*) AS Records,
+    SUM(NetworkUsageData.BytesSent) AS BytesSent,
+    SUM(NetworkUsageData.BytesRecvd) AS BytesRecvd
+    FROM
+    NetworkUsageData
+    INNER JOIN SrumIdMap ON
+    NetworkUsageData.AppId = SrumIdMap.IdIndex
+    GROUP BY SrumIdMap.IdName
+'''
+
+CSV_TEMPLATE = '''output_format: csv
+worksheet_name: 'NetworkUsage'
+xlsx_column_formats:
+    0:
+        column_type: datetime
+        strptime: '%Y-%m-%d %H:%M:%S'
+sql_query: |
+    SELECT
+    NetworkUsageData.TimeStamp,
+    SrumIdMap.IdValue AS AppPath,
+    NetworkUsageData.UserId,
+    NetworkUsageData.BytesSent,
+    NetworkUsageData.BytesRecvd
+    FROM
+    NetworkUsageData
+    INNER JOIN SrumIdMap ON
+    NetworkUsageData.AppId = SrumIdMap.IdIndex
+'''
+
+def GetOptions():
+    '''Get needed options for benchmarking. Arguments the benchmark does
+    not know are passed on to SrumMonkey, e.g. --workers 4'''
+
+    usage = """Benchmark SrumMonkey on synthetic SRUM tables"""
+
+    options = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=(usage)
+    )
+
+    options.add_argument(
+        '--rows',
+        dest='rows',
+        action="store",
+        type=int,
+        nargs='+',
+        default=DEFAULT_ROWS,
+        help='Records of every usage table, one run per value, e.g. 10000 1000000 10000000 [default: {}]'.format(DEFAULT_ROWS[0])
+    )
+
+    options.add_argument(
+        '--ids',
+        dest='ids',
+        action="store",
+        type=int,
+        default=DEFAULT_IDS,
+        help='Records of SruDbIdMapTable [default: {}]'.format(DEFAULT_IDS)
+    )
+
+    options.add_argument(
+        '--workdir',
+        dest='workdir',
+        action="store",
+        type=unicode,
+        default=None,
+        help='Folder for the synthetic data and output dbs, kept after the run [default: a temporary folder that is removed]'
+    )
+
+    options.add_argument(
+        '--output',
+        dest='output',
+        action="store",
+        type=unicode,
+        default='SrumBenchmark.json',
+        help='JSON file the results are written to [default: SrumBenchmark.json]'
+    )
+
+    options.add_argument(
+        '--no_reports',
+        dest='report_flag',
+        action="store_false",
+        default=True,
+        help='Skip the report stage'
+    )
+
+    options.add_argument(
+        '--startup_budget',
+        dest='startup_budget',
+        action="store",
+        type=float,
+        default=DEFAULT_STARTUP_BUDGET,
+        help='Seconds a conversion only and a report only run of an empty db may take, the benchmark fails above it [default: {}]'.format(DEFAULT_STARTUP_BUDGET)
+    )
+
+    return options
+
+def Main():
+    ###GET OPTIONS###
+    arguements = GetOptions()
+    options,srum_arguments = arguements.parse_known_args()
+
+    workdir = options.workdir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='SrumBenchmark')
+
+    runs = []
+    try:
+        startup = MeasureStartup(
+            workdir,
+            options.startup_budget
+        )
+        PrintStartup(startup)
+
+        for row_count in options.rows:
+            #A fresh process per run so peak_rss is the peak of that run.#
+            #Not a Pool, its daemonic workers can not start --workers#
+            result_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_RunBenchmarkTask,
+                args=(result_queue,options,srum_arguments,workdir,row_count)
+            )
+            process.start()
+            run,error = result_queue.get()
+            process.join()
+
+            if error is not None:
+                raise Exception('Benchmark of {} rows failed: {}'.format(row_count,error))
+
+            PrintRun(run)
+            runs.append(run)
+    finally:
+        if options.workdir is None:
+            shutil.rmtree(workdir,ignore_errors=True)
+
+    results = {
+        'python':sys.version.split()[0],
+        'sqlite':sqlite3.sqlite_version,
+        'platform':platform.platform(),
+        'cpus':multiprocessing.cpu_count(),
+        'arguments':srum_arguments,
+        'startup':startup,
+        'runs':runs
+    }
+
+    with open(options.output,'wb') as outfh:
+        json.dump(results,outfh,indent=2)
+
+    print 'Wrote {}'.format(options.output)
+
+    if not all([mode['within_budget'] for mode in startup]):
+        print 'Startup is over the budget of {:.2f}s'.format(options.startup_budget)
+        sys.exit(1)
+
+def MeasureStartup(workdir,budget):
+    '''Time a conversion only and then a report only run of an empty db,
+    each in a fresh interpreter, from its start to its exit
+
+    Args:
+        workdir: The benchmark folder
+        budget: The seconds a run may take
+    Returns:
+        startup: A list of dictionaries, one per mode'''
+    run_path = os.path.join(workdir,'startup')
+    if os.path.isdir(run_path):
+        shutil.rmtree(run_path)
+    #No templates, the report only run just loads the report modules#
+    template_path = os.path.join(run_path,'templates')
+    os.makedirs(template_path)
+
+    spec = os.path.join(run_path,'SrumBenchmark.json')
+    FakeEsedb.WriteSpec(
+        spec,
+        0,
+        0
+    )
+
+    modes = [
+        ('convert',['--srum_db',spec,'--outpath',run_path,'--no_reports']),
+        ('report',['--outpath',run_path,'--reports_only'])
+    ]
+
+    startup = []
+    for mode,arguments in modes:
+        script = STARTUP_SCRIPT.format(
+            paths=repr([BENCHMARK_DIR,os.path.dirname(BENCHMARK_DIR)]),
+            argv=repr(['SrumMonkey.py'] + arguments + ['--log_level','ERROR']),
+            modules=repr(STARTUP_MODULES)
+        )
+
+        start = time.time()
+        output = subprocess.check_output(
+            [sys.executable,'-c',script],
+            cwd=template_path
+        )
+        elapsed = time.time() - start
+
+        result = json.loads(output.strip().splitlines()[-1])
+        startup.append({
+            'mode':mode,
+            'seconds':elapsed,
+            'import_seconds':result['import_seconds'],
+            'modules':result['modules'],
+            'within_budget':elapsed <= budget
+        })
+
+    return startup
+
+def _RunBenchmarkTask(result_queue,*args):
+    '''Run RunBenchmark in a benchmark process and put its (run, error)
+    on result_queue'''
+    try:
+        result_queue.put((RunBenchmark(*args),None))
+    except:
+        result_queue.put((None,traceback.format_exc()))
+
+def RunBenchmark(options,srum_arguments,workdir,row_count):
+    '''Convert, index and report a synthetic SRUM db of row_count records
+    per usage table, timing every stage
+
+    Args:
+        options: The benchmark options
+        srum_arguments: Arguments for SrumMonkey
+        workdir: The benchmark folder
+        row_count: The records of every usage table
+    Returns:
+        run: A dictionary with the totals and stages of the run'''
+    run_path = os.path.join(workdir,'rows_{}'.format(row_count))
+    if os.path.isdir(run_path):
+        shutil.rmtree(run_path)
+    template_path = os.path.join(run_path,'templates')
+    os.makedirs(template_path)
+
+    spec = os.path.join(run_path,'SrumBenchmark.json')
+    FakeEsedb.WriteSpec(
+        spec,
+        row_count,
+        options.ids
+    )
+
+    WriteTemplates(template_path)
+
+    srum_options = SrumMonkey.GetOptions().parse_args(
+        ['--srum_db',spec,'--outpath',run_path] + srum_arguments
+    )
+    srum_options.output_db = os.path.join(run_path,'SRUM.db')
+    #The insert stage is timed by the --stats insert counters, decoding#
+    #overlaps inserting so it can not be told from the convert time#
+    if srum_options.stats_file is None:
+        srum_options.stats_file = 'SrumBenchmarkStats.json'
+    
+    logging.basicConfig(
+        level = getattr(logging,srum_options.log_level)
+    )
+
+    #Load numpy before the first stage is timed#
+    SrumTimestamps.GetNumpy()
+
+    stages = []
+
+    #decode: read and decode every table without writing it#
+    srumHandler = SrumConverter.SrumHandler(
+        srum_options
+    )
+    start = time.time()
+    decoded = 0
+    for table_index in xrange(srumHandler.esedb_file.get_number_of_tables()):
+        for batch in srumHandler.DecodeTableBatches(table_index):
+            decoded += len(batch)
+    stages.append(
+        GetStage('decode',start,decoded)
+    )
+
+    #convert: decode and insert#
+    srumHandler = SrumConverter.SrumHandler(
+        srum_options
+    )
+    stagedDbHandler = SrumMonkey.StageOutputDb(
+        srum_options,
+        srumHandler.EstimateOutputSize()
+    )
+    start = time.time()
+    srumHandler.ConvertDb()
+    stages.append(
+        GetStage('convert',start,srumHandler.record_count)
+    )
+    #insert: the time spent writing batches during the convert stage#
+    insert_seconds = sum([table['insert_seconds'] for table in srumHandler.stats.tables.values()])
+    inserted = sum([table['inserted'] for table in srumHandler.stats.tables.values()])
+    stages.append({
+        'stage':'insert',
+        'seconds':insert_seconds,
+        'records':inserted,
+        'records_per_sec':GetRate(
+            inserted,
+            insert_seconds
+        ),
+        'peak_rss':stages[1]['peak_rss']
+    })
+
+    #index: resolve the id map and build the indexes#
+    start = time.time()
+    idMapHandler = SrumDb.IdMapHandler(
+        srum_options
+    )
+    idMapHandler.BuildIdMap()
+    reportHandler = SrumReports.ReportHandler(
+        srum_options
+    )
+    indexHandler = SrumDb.IndexHandler(
+        srum_options
+    )
+    indexHandler.BuildIndexes(
+        reportHandler.GetTemplateIndexes(template_path)
+    )
+    stages.append(
+        GetStage('index',start,srumHandler.record_count)
+    )
+
+    #persist: write the db staged with --stage_db or --incremental to the run folder#
+    if stagedDbHandler is not None:
+        start = time.time()
+        stagedDbHandler.PersistDb()
+        stages.append(
+            GetStage('persist',start,srumHandler.record_count)
+        )
+
+    #report: run the benchmark templates#
+    if options.report_flag:
+        start = time.time()
+        results = reportHandler.RunReports(template_path)
+        for sqlfile,elapsed,report_rows,error in results:
+            if error is not None:
+                raise Exception('{} failed: {}'.format(sqlfile,error))
+        stages.append(
+            GetStage('report',start,sum([result[2] for result in results]))
+        )
+
+    SrumDb.DbConfig.CloseConnections()
+
+    return {
+        'rows':row_count,
+        'ids':options.ids,
+        'records':srumHandler.record_count,
+        'db_size':os.path.getsize(srum_options.output_db),
+        'seconds':sum([stage['seconds'] for stage in stages if stage['stage'] not in ('decode','insert')]),
+        'peak_rss':SrumDb.GetPeakMemory(),
+        'stages':stages
+    }
+
+def WriteTemplates(template_path):
+    '''Write the report templates of the report stage'''
+    for name,template in [('BytesByApp.yml',XLSX_TEMPLATE),('NetworkUsage.yml',CSV_TEMPLATE)]:
+        with open(os.path.join(template_path,name),'wb') as templatefh:
+            templatefh.write(template)
+
+def GetStage(name,start,records):
+    '''Return the timing of a stage that started at start'''
+    elapsed = time.time() - start
+    return {
+        'stage':name,
+        'seconds':elapsed,
+        'records':records,
+        'records_per_sec':GetRate(records,elapsed),
+        'peak_rss':SrumDb.GetPeakMemory()
+    }
+
+def GetRate(records,seconds):
+    '''Return records per second, or None if no time was measured'''
+    if seconds <= 0:
+        return None
+    return records / seconds
+
+def PrintStartup(startup):
+    '''Print the startup time of every mode'''
+    print 'Startup'
+    for mode in startup:
+        print '  {:<10} {:>10.2f}s {:>10} loaded {}'.format(
+            mode['mode'],
+            mode['seconds'],
+            'ok' if mode['within_budget'] else 'OVER',
+            ', '.join(mode['modules'])
+        )
+
+def PrintRun(run):
+    '''Print the stages of a run'''
+    print 'Benchmark {} rows ({} records, {}, peak {})'.format(
+        run['rows'],
+        run['records'],
+        SrumDb.FormatByteSize(run['db_size']),
+        SrumDb.FormatByteSize(run['peak_rss'])
+    )
+    for stage in run['stages']:
+        print '  {:<10} {:>10.2f}s {:>14} rows/s {:>10}'.format(
+            stage['stage'],
+            stage['seconds'],
+            'n/a' if stage['records_per_sec'] is None else '{:.0f}'.format(stage['records_per_sec']),
+            SrumDb.FormatByteSize(stage['peak_rss'])
+        )
+
+if __name__ == '__main__':
+    Main()
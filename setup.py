@@ -7,5 +7,6 @@ setup(name='SrumMonkey',
       description='a tool you can use to convert the Microsoft SRU edb database to a SQLite database',
       author='devgc',
       url='https://github.com/devgc',
-      scripts=['SrumMonkey.py', 'CustomSqlFunctions.py']
+      scripts=['SrumMonkey.py', 'CustomSqlFunctions.py', 'SrumDb.py', 'SrumTimestamps.py',
+               'SrumConverter.py', 'SrumRegistry.py', 'SrumReports.py', 'SrumParquet.py']
      )
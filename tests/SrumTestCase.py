@@ -0,0 +1,80 @@
+'''Shared setup of the tests. Conversions read synthetic SRUM tables from
+benchmarks/FakeEsedb, so the tests run without libesedb.'''
+import sys
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0,os.path.join(REPO_DIR,'benchmarks'))
+sys.path.insert(1,REPO_DIR)
+
+import FakeEsedb
+sys.modules['pyesedb'] = FakeEsedb
+
+import SrumMonkey
+from SrumDb import DbConfig
+
+class SrumTestCase(unittest.TestCase):
+    '''A test with a working folder and the spec of a synthetic SRUM db'''
+    #Records of the usage tables and of SruDbIdMapTable#
+    ROWS = 2000
+    IDS = 100
+    
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='SrumTest')
+        self.srum_db = self.WriteSpec('SRUDB.json',self.ROWS)
+        
+    def tearDown(self):
+        DbConfig.CloseConnections()
+        shutil.rmtree(self.workdir)
+        
+    def WriteSpec(self,name,row_count):
+        '''Write the spec of a synthetic SRUM db in the working folder'''
+        filename = os.path.join(self.workdir,name)
+        FakeEsedb.WriteSpec(filename,row_count,self.IDS)
+        return filename
+    
+    def GetOptions(self,name,*arguments):
+        '''Parse SrumMonkey options that convert self.srum_db into the
+        name folder of the working folder, without reports'''
+        return SrumMonkey.GetOptions().parse_args([
+            '--srum_db',self.srum_db,
+            '--outpath',os.path.join(self.workdir,name),
+            '--no_reports'
+        ] + list(arguments))
+    
+    def Convert(self,name,*arguments):
+        '''Convert self.srum_db like GetOptions
+        
+        Returns:
+            output_db: The converted db'''
+        options = self.GetOptions(name,*arguments)
+        SrumMonkey.ProcessHost(
+            options
+        )
+        
+        return options.output_db
+    
+def GetRows(db_name,table_name):
+    '''Get the rows of a table in insert order'''
+    dbh = sqlite3.connect(db_name)
+    try:
+        return dbh.execute(
+            'SELECT * FROM "{}" ORDER BY rowid'.format(table_name)
+        ).fetchall()
+    finally:
+        dbh.close()
+        
+def GetTableNames(db_name):
+    '''Get the table names of a db'''
+    dbh = sqlite3.connect(db_name)
+    try:
+        return sorted([row[0] for row in dbh.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        )])
+    finally:
+        dbh.close()
@@ -0,0 +1,111 @@
+'''Tests of the conversion of SRUM tables'''
+import unittest
+import time
+import os
+
+from SrumTestCase import SrumTestCase,GetRows,GetTableNames
+from SrumConverter import SrumHandler
+from SrumDb import DbConfig,ShardedBatchWriter,HIGH_WATER_TABLE
+
+class ShardedConversionTest(SrumTestCase):
+    '''Tables decoded in shards by --workers'''
+    WORKERS = 3
+    
+    def testShardedOutputMatchesSequential(self):
+        sequential_db = self.Convert('sequential','--pipeline_depth','0')
+        sharded_db = self.Convert('sharded','--workers',str(self.WORKERS),'--shard_size','150')
+        
+        table_names = GetTableNames(sequential_db)
+        self.assertEqual(table_names,GetTableNames(sharded_db))
+        for table_name in table_names:
+            if table_name == HIGH_WATER_TABLE:
+                continue
+            self.assertEqual(
+                GetRows(sequential_db,table_name),
+                GetRows(sharded_db,table_name),
+                table_name
+            )
+            
+    def testPendingShardsAreBounded(self):
+        pending_counts = []
+        add_shard_batch = ShardedBatchWriter.AddShardBatch
+        decode_table_batches = SrumHandler.DecodeTableBatches
+        
+        def AddShardBatch(batchWriter,shard_index,records):
+            add_shard_batch(batchWriter,shard_index,records)
+            pending_counts.append(len(batchWriter.pending))
+            
+        def DecodeTableBatches(srumHandler,table_index,start=0,stop=None,high_water=None):
+            #The first shard of every table finishes last#
+            if start == 0:
+                time.sleep(1)
+            return decode_table_batches(srumHandler,table_index,start,stop,high_water)
+        
+        #The workers are forked with the slow decoder#
+        ShardedBatchWriter.AddShardBatch = AddShardBatch
+        SrumHandler.DecodeTableBatches = DecodeTableBatches
+        try:
+            self.Convert('sharded','--workers',str(self.WORKERS),'--shard_size','50')
+        finally:
+            ShardedBatchWriter.AddShardBatch = add_shard_batch
+            SrumHandler.DecodeTableBatches = decode_table_batches
+            
+        self.assertTrue(pending_counts)
+        self.assertTrue(max(pending_counts) < self.WORKERS * SrumHandler.SHARDS_IN_FLIGHT_PER_WORKER)
+
+class IncrementalConversionTest(SrumTestCase):
+    '''--incremental runs that add to an earlier conversion'''
+    def testInterruptedRunKeepsEarlierRecords(self):
+        output_db = self.Convert('output')
+        tables = dict([
+            (table_name,GetRows(output_db,table_name)) for table_name in GetTableNames(output_db)
+        ])
+        
+        #More records, and a failure once they are converted#
+        self.srum_db = self.WriteSpec('SRUDB_later.json',self.ROWS * 2)
+        update_high_water_marks = SrumHandler._UpdateHighWaterMarks
+        
+        def UpdateHighWaterMarks(srumHandler):
+            raise KeyboardInterrupt()
+        
+        SrumHandler._UpdateHighWaterMarks = UpdateHighWaterMarks
+        try:
+            self.assertRaises(
+                KeyboardInterrupt,
+                self.Convert,
+                'output',
+                '--incremental'
+            )
+        finally:
+            SrumHandler._UpdateHighWaterMarks = update_high_water_marks
+        DbConfig.CloseConnections()
+        
+        self.assertEqual(os.listdir(os.path.dirname(output_db)),['SRUM.db'])
+        for table_name,rows in tables.items():
+            self.assertEqual(GetRows(output_db,table_name),rows,table_name)
+            
+        #The next run adds the records once#
+        self.Convert('output','--incremental')
+        rows = GetRows(output_db,'NetworkUsageData')
+        self.assertEqual(rows[:len(tables['NetworkUsageData'])],tables['NetworkUsageData'])
+        self.assertEqual(
+            sorted([row[0] for row in rows]),
+            range(1,self.ROWS * 2 + 1)
+        )
+        
+    def testTimestampFormatMustMatch(self):
+        output_db = self.Convert('output','--timestamp_format','filetime')
+        rows = GetRows(output_db,'NetworkUsageData')
+        
+        self.assertRaises(
+            Exception,
+            self.Convert,
+            'output',
+            '--incremental',
+            '--timestamp_format','epoch'
+        )
+        DbConfig.CloseConnections()
+        self.assertEqual(GetRows(output_db,'NetworkUsageData'),rows)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+'''Tests of the output db'''
+import unittest
+import os
+import sqlite3
+
+from SrumTestCase import SrumTestCase,GetRows,GetTableNames
+from SrumDb import DbConfig,DbHandler,IndexHandler,HIGH_WATER_TABLE,SETTINGS_TABLE
+
+class SettingTest(SrumTestCase):
+    '''Db wide settings'''
+    def setUp(self):
+        SrumTestCase.setUp(self)
+        self.db_name = os.path.join(self.workdir,'SRUM.db')
+    
+    def GetDbHandler(self):
+        return DbHandler(DbConfig(dbname=self.db_name))
+    
+    def testSettingsHaveTheirOwnTable(self):
+        dbHandler = self.GetDbHandler()
+        self.assertEqual(dbHandler.GetSetting('timestamp_format'),None)
+        
+        dbHandler.SetSetting('timestamp_format','epoch')
+        dbHandler.SetSetting('timestamp_format','filetime')
+        
+        self.assertEqual(dbHandler.GetSetting('timestamp_format'),'filetime')
+        self.assertEqual(GetTableNames(self.db_name),[SETTINGS_TABLE])
+    
+    def testSettingsOfOlderDbsAreRead(self):
+        dbh = sqlite3.connect(self.db_name)
+        dbh.execute(
+            "CREATE TABLE '{}' ('TableName' TEXT, 'ColumnName' TEXT, 'HighWaterMark' , 'LastUpdated' DATETIME, PRIMARY KEY (TableName, ColumnName))".format(
+                HIGH_WATER_TABLE
+            )
+        )
+        dbh.executemany(
+            "INSERT INTO '{}' VALUES (?,?,?,NULL)".format(HIGH_WATER_TABLE),
+            [('SrumMonkey','timestamp_format','epoch'),('NetworkUsageData','AutoIncId',10)]
+        )
+        dbh.commit()
+        dbh.close()
+        
+        dbHandler = self.GetDbHandler()
+        self.assertEqual(dbHandler.GetSetting('timestamp_format'),'epoch')
+        
+        #Setting it again leaves only high water marks in HIGH_WATER_TABLE#
+        dbHandler.SetSetting('timestamp_format','filetime')
+        self.assertEqual(dbHandler.GetSetting('timestamp_format'),'filetime')
+        self.assertEqual(
+            GetRows(self.db_name,HIGH_WATER_TABLE),
+            [('NetworkUsageData','AutoIncId',10,None)]
+        )
+
+class IndexTest(SrumTestCase):
+    '''The join key and template indexes'''
+    def GetIndexNames(self,db_name):
+        dbh = sqlite3.connect(db_name)
+        try:
+            return [row[0] for row in dbh.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            )]
+        finally:
+            dbh.close()
+            
+    def testServedColumnsAreNotIndexed(self):
+        output_db = self.Convert('output')
+        index_names = self.GetIndexNames(output_db)
+        
+        self.assertTrue('idx_NetworkUsageData_AppId' in index_names)
+        #IdIndex is the INTEGER PRIMARY KEY of SrumIdMap#
+        self.assertFalse('idx_SrumIdMap_IdIndex' in index_names)
+        
+        #An index leading with AppId serves AppId lookups too#
+        options = self.GetOptions('output')
+        options.output_db = output_db
+        dbHandler = DbHandler(DbConfig(dbname=output_db))
+        dbHandler.GetDbHandle().execute('DROP INDEX idx_NetworkUsageData_AppId')
+        dbHandler.CreateIndex('NetworkUsageData',['AppId','UserId'])
+        IndexHandler(options).BuildIndexes()
+        
+        index_names = self.GetIndexNames(output_db)
+        self.assertFalse('idx_NetworkUsageData_AppId' in index_names)
+        self.assertTrue('idx_NetworkUsageData_AppId_UserId' in index_names)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+'''Tests of fleet conversions'''
+import unittest
+import sys
+import os
+import sqlite3
+
+from SrumTestCase import SrumTestCase
+import SrumMonkey
+from SrumReports import ReportHandler
+
+MERGED_TEMPLATE = """output_format: csv
+output_name: 'Hosts.csv'
+sql_query: |
+    SELECT count(*) FROM NetworkUsageData
+merged_sql_query: |
+    SELECT
+    NetworkUsageData.host,
+    count(*),
+    count(SrumIdMap.IdValue),
+    sum(id_value(NetworkUsageData.AppId, NetworkUsageData.host) IS SrumIdMap.IdValue)
+    FROM NetworkUsageData
+    LEFT JOIN SrumIdMap ON
+    NetworkUsageData.host = SrumIdMap.host AND
+    NetworkUsageData.AppId = SrumIdMap.IdIndex
+    GROUP BY NetworkUsageData.host
+    ORDER BY NetworkUsageData.host
+"""
+
+SINGLE_HOST_TEMPLATE = """output_format: csv
+output_name: 'Single.csv'
+sql_query: |
+    SELECT count(*) FROM NetworkUsageData
+"""
+
+class FleetWorkerTest(SrumTestCase):
+    '''Hosts converted by fleet workers'''
+    def testSystemExitIsAHostFailure(self):
+        options = self.GetOptions('host')
+        ProcessHost = SrumMonkey.ProcessHost
+        SrumMonkey.ProcessHost = lambda options: sys.exit(1)
+        try:
+            host,seconds,record_count,host_db,error = SrumMonkey._ProcessHostTask(
+                ('host',options)
+            )
+        finally:
+            SrumMonkey.ProcessHost = ProcessHost
+            
+        self.assertEqual(host,'host')
+        self.assertEqual(record_count,0)
+        self.assertTrue('SystemExit' in error)
+        
+    def testParquetIncrementalIsAHostFailure(self):
+        options = self.GetOptions('host','--output_format','parquet','--incremental')
+        error = SrumMonkey._ProcessHostTask(('host',options))[4]
+        self.assertTrue('--incremental' in error)
+        
+    def testFailedHostsFailTheRun(self):
+        fleet = os.path.join(self.workdir,'fleet')
+        for host in ['good','bad']:
+            os.makedirs(os.path.join(fleet,host))
+        self.WriteSpec(os.path.join('fleet','good','SRUDB.dat'),100)
+        with open(os.path.join(fleet,'bad','SRUDB.dat'),'wb') as srumfh:
+            srumfh.write('not a SRUM db')
+            
+        argv = sys.argv
+        sys.argv = [
+            'SrumMonkey.py',
+            '--fleet',fleet,
+            '--outpath',os.path.join(self.workdir,'output'),
+            '--no_reports'
+        ]
+        try:
+            with self.assertRaises(SystemExit) as context:
+                SrumMonkey.Main()
+        finally:
+            sys.argv = argv
+            
+        self.assertEqual(context.exception.code,1)
+        self.assertTrue(os.path.isfile(os.path.join(self.workdir,'output','good','SRUM.db')))
+        
+    def testMergedParquetIsRefused(self):
+        options = self.GetOptions('host','--fleet',self.workdir,'--fleet_output','merged','--output_format','parquet')
+        self.assertRaises(Exception,SrumMonkey.FleetHandler,options)
+
+class MergedFleetTest(SrumTestCase):
+    '''Hosts merged into one db with --fleet_output merged'''
+    #Records of the usage tables of every host. The hosts share ids#
+    HOSTS = [('a',300),('b',500)]
+    
+    def setUp(self):
+        SrumTestCase.setUp(self)
+        self.fleet = os.path.join(self.workdir,'fleet')
+        for host,row_count in MergedFleetTest.HOSTS:
+            os.makedirs(os.path.join(self.fleet,host))
+            self.WriteSpec(os.path.join('fleet',host,'SRUDB.dat'),row_count)
+            
+        self.options = SrumMonkey.GetOptions().parse_args([
+            '--fleet',self.fleet,
+            '--outpath',os.path.join(self.workdir,'merged'),
+            '--fleet_output','merged',
+            '--no_reports'
+        ])
+        SrumMonkey.FleetHandler(self.options).RunFleet()
+        
+    def testIndexesLeadWithTheHost(self):
+        dbh = sqlite3.connect(self.options.output_db)
+        try:
+            index_names = [row[0] for row in dbh.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            )]
+        finally:
+            dbh.close()
+            
+        self.assertTrue('idx_SrumIdMap_host_IdIndex' in index_names)
+        self.assertTrue('idx_NetworkUsageData_host_AppId' in index_names)
+        self.assertFalse('idx_NetworkUsageData_AppId' in index_names)
+        
+    def testReportsJoinOnTheHost(self):
+        template_folder = os.path.join(self.workdir,'templates')
+        os.makedirs(template_folder)
+        for name,template in [('Hosts.yml',MERGED_TEMPLATE),('Single.yml',SINGLE_HOST_TEMPLATE)]:
+            with open(os.path.join(template_folder,name),'wb') as templatefh:
+                templatefh.write(template)
+                
+        results = ReportHandler(self.options).RunReports(template_folder)
+        
+        #Templates without a merged_sql_query are not run#
+        self.assertEqual(
+            [os.path.basename(result[0]) for result in results],
+            ['Hosts.yml']
+        )
+        self.assertFalse(os.path.isfile(os.path.join(self.options.outpath,'Single.csv')))
+        
+        with open(os.path.join(self.options.outpath,'Hosts.csv'),'rb') as reportfh:
+            lines = reportfh.read().splitlines()[1:]
+            
+        #Every record joins the ids of its own host only once#
+        expected = []
+        for host,row_count in MergedFleetTest.HOSTS:
+            dbh = sqlite3.connect(os.path.join(self.options.outpath,'hosts',host,'SRUM.db'))
+            try:
+                record_count,resolved_count = dbh.execute(
+                    '''SELECT count(*), count(SrumIdMap.IdValue) FROM NetworkUsageData
+                    LEFT JOIN SrumIdMap ON NetworkUsageData.AppId = SrumIdMap.IdIndex'''
+                ).fetchone()
+            finally:
+                dbh.close()
+                
+            self.assertEqual(record_count,row_count)
+            expected.append('{},{},{},{}'.format(host,record_count,resolved_count,record_count))
+            
+        self.assertEqual(lines,expected)
+
+if __name__ == '__main__':
+    unittest.main()
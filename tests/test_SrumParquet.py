@@ -0,0 +1,25 @@
+'''Tests of the Parquet output'''
+import unittest
+import os
+
+from SrumTestCase import SrumTestCase
+from SrumParquet import GetParquetPartName
+
+class PartNameTest(SrumTestCase):
+    '''Part files of the Parquet directory of a table'''
+    def testPartsOfOneSecondAreKept(self):
+        parquet_path = os.path.join(self.workdir,'parquet')
+        filenames = []
+        for clear_parts in [True,False,False]:
+            filename = GetParquetPartName(parquet_path,'Table',clear_parts=clear_parts)
+            self.assertFalse(os.path.exists(filename))
+            open(filename,'wb').close()
+            filenames.append(filename)
+            
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(parquet_path,'Table'))),
+            sorted([os.path.basename(part_name) for part_name in filenames])
+        )
+
+if __name__ == '__main__':
+    unittest.main()
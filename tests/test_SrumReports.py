@@ -0,0 +1,304 @@
+'''Tests of the report templates'''
+import unittest
+import os
+import datetime
+import sqlite3
+import re
+import time
+import threading
+import zipfile
+
+from SrumTestCase import SrumTestCase
+import SrumMonkey
+from SrumReports import ReportHandler
+from SrumDb import DbConfig,DbHandler
+from SrumReports import Reporter,StreamReporter,QueryCache,WorkbookReporter
+from CustomSqlFunctions import IdResolver
+
+EVENT_TEMPLATE = """output_format: csv
+worksheet_name: 'Events'
+xlsx_column_formats:
+    0:
+        column_type: datetime
+        strptime: '%Y-%m-%d %H:%M:%S'
+    1:
+        column_type: datetime
+        strptime: '%Y-%m-%d %H:%M:%S'
+sql_query: |
+    SELECT EventTimestamp, TimeStamp FROM SrumBenchmarkAllTypes ORDER BY rowid
+"""
+
+TEMPLATE = """workbook_name: 'Report.xlsx'
+worksheet_name: 'Times'
+output_format: {}
+xlsx_column_formats:
+    0:
+        column_type: datetime
+        strptime: '%Y-%m-%d %H:%M:%S'
+sql_query: |
+    SELECT TimeStamp, Name FROM Times ORDER BY rowid
+"""
+
+WORKBOOK_TEMPLATE = """workbook_name: 'Workbook.xlsx'
+worksheet_name: '{}'
+sql_query: |
+    SELECT Number FROM Numbers
+"""
+
+class WorksheetRecorder():
+    '''Stands in for a worksheet and keeps the rows written to it'''
+    def __init__(self):
+        self.rows = []
+        
+    def write_row(self,row_num,column_num,row):
+        self.rows.append(row)
+
+class DatetimeColumnTest(SrumTestCase):
+    '''Templates with datetime columns in xlsx_column_formats'''
+    TIMESTAMPS = [
+        datetime.datetime(2015,6,1,12,30,15),
+        datetime.datetime(2015,6,1,12,30,15,250000),
+        None
+    ]
+    
+    def setUp(self):
+        SrumTestCase.setUp(self)
+        self.options = SrumMonkey.GetOptions().parse_args([
+            '--outpath',self.workdir
+        ])
+        self.options.output_db = os.path.join(self.workdir,'SRUM.db')
+        
+        dbh = sqlite3.connect(self.options.output_db)
+        dbh.execute("CREATE TABLE Times ('TimeStamp' DATETIME, 'Name' TEXT)")
+        dbh.executemany(
+            'INSERT INTO Times VALUES (?,?)',
+            [(timestamp,'name') for timestamp in DatetimeColumnTest.TIMESTAMPS]
+        )
+        dbh.commit()
+        dbh.close()
+        
+    def WriteTemplate(self,output_format):
+        filename = os.path.join(self.workdir,'Times.yml')
+        with open(filename,'wb') as templatefh:
+            templatefh.write(TEMPLATE.format(output_format))
+            
+        return filename
+    
+    def GetDbHandler(self):
+        return DbHandler(DbConfig(dbname=self.options.output_db))
+    
+    def testDatetimesReachTheWorksheet(self):
+        reporter = Reporter(
+            self.options,
+            self.WriteTemplate('xlsx'),
+            self.GetDbHandler()
+        )
+        worksheet = WorksheetRecorder()
+        reporter._AddWorksheet = lambda *arguments: worksheet
+        reporter.BeginReport(None)
+        
+        column_names = None
+        records = []
+        for column_names,record in reporter.FetchRecords():
+            records.append(record)
+        reporter.WriteRecords(column_names,records)
+        
+        self.assertEqual(
+            [row[0] for row in worksheet.rows],
+            DatetimeColumnTest.TIMESTAMPS
+        )
+        for row in worksheet.rows[:2]:
+            self.assertTrue(isinstance(row[0],datetime.datetime))
+            
+    def testDatetimesReachTheStreamWriter(self):
+        reporter = StreamReporter(
+            self.options,
+            self.WriteTemplate('csv'),
+            self.GetDbHandler()
+        )
+        reporter.converters,column_formats = reporter._CompileColumnPipeline()
+        
+        rows = list(reporter._GetRows())
+        self.assertEqual(rows[0],['TimeStamp','Name'])
+        self.assertEqual(
+            [row[0] for row in rows[1:]],
+            DatetimeColumnTest.TIMESTAMPS
+        )
+
+class StoredTimestampFormatTest(SrumTestCase):
+    '''Reports on dbs converted with an integer --timestamp_format'''
+    def Report(self,name,*arguments):
+        '''Convert self.srum_db and run a csv report on it with the default
+        --timestamp_format
+        
+        Returns:
+            lines: The lines of the report'''
+        self.Convert(name,*arguments)
+        
+        template_folder = os.path.join(self.workdir,'templates')
+        if not os.path.isdir(template_folder):
+            os.makedirs(template_folder)
+            with open(os.path.join(template_folder,'Events.yml'),'wb') as templatefh:
+                templatefh.write(EVENT_TEMPLATE)
+                
+        options = self.GetOptions(name,'--reports_only')
+        options.output_db = os.path.join(options.outpath,'SRUM.db')
+        ReportHandler(options).RunReports(template_folder)
+        DbConfig.CloseConnections()
+        
+        with open(os.path.join(options.outpath,'Events.csv'),'rb') as reportfh:
+            return reportfh.readlines()
+    
+    def testReportsReadTheStoredFormat(self):
+        lines = self.Report('datetime')
+        self.assertTrue(len(lines) > 1)
+        for timestamp_format in ['epoch','filetime']:
+            self.assertEqual(
+                self.Report(timestamp_format,'--timestamp_format',timestamp_format),
+                lines,
+                timestamp_format
+            )
+
+class IdFunctionTest(SrumTestCase):
+    '''id_value() and id_name() in queries of the query cache'''
+    ID_QUERY = '''SELECT AppId, id_value(AppId), id_name(AppId)
+    FROM NetworkUsageData ORDER BY rowid'''
+    JOIN_QUERY = '''SELECT AppId, IdValue, IdName
+    FROM NetworkUsageData LEFT JOIN SrumIdMap ON AppId = IdIndex
+    ORDER BY NetworkUsageData.rowid'''
+    
+    def testSharedQueriesResolveIdsInTheOutputDb(self):
+        options = self.GetOptions('cache')
+        options.output_db = self.Convert('cache')
+        
+        queryCache = QueryCache(
+            options,
+            set([QueryCache.NormalizeQuery(IdFunctionTest.ID_QUERY)])
+        )
+        dbHandler = DbHandler(DbConfig(dbname=options.output_db))
+        rows = [
+            tuple(record) for column_names,record
+            in queryCache.FetchRecords(dbHandler,IdFunctionTest.ID_QUERY)
+        ]
+        
+        #Resolved through the output db, the cache db has no id map#
+        self.assertTrue([row for row in rows if row[1] is not None])
+        self.assertEqual(
+            rows,
+            dbHandler.GetDbHandle().execute(IdFunctionTest.JOIN_QUERY).fetchall()
+        )
+        
+    def testMissesAreRemembered(self):
+        db_name = os.path.join(self.workdir,'NoIdMap.db')
+        idResolver = IdResolver(db_name)
+        try:
+            self.assertEqual(idResolver.GetValue(1),None)
+            self.assertEqual(idResolver.cache.Get((1,None),idResolver),None)
+        finally:
+            idResolver.Close()
+            
+    def testMergedIdsAreResolvedPerHost(self):
+        db_name = os.path.join(self.workdir,'Merged.db')
+        dbh = sqlite3.connect(db_name)
+        dbh.execute("CREATE TABLE SrumIdMap ('host' TEXT, 'IdIndex' INTEGER, 'IdType' INTEGER, 'IdValue' TEXT, 'IdName' TEXT)")
+        dbh.executemany(
+            'INSERT INTO SrumIdMap VALUES (?,?,?,?,?)',
+            [('a',1,0,'a.exe','a.exe'),('b',1,0,'b.exe','b.exe')]
+        )
+        dbh.commit()
+        dbh.close()
+        
+        idResolver = IdResolver(db_name)
+        try:
+            self.assertEqual(idResolver.GetValue(1,'a'),'a.exe')
+            self.assertEqual(idResolver.GetName(1,'b'),'b.exe')
+            self.assertEqual(idResolver.GetValue(1,'c'),None)
+            #Without the host the id is ambiguous#
+            self.assertRaises(Exception,idResolver.GetValue,1)
+        finally:
+            idResolver.Close()
+
+class WorkbookTest(SrumTestCase):
+    '''Templates that share a workbook'''
+    ROWS = 20000
+    
+    def setUp(self):
+        SrumTestCase.setUp(self)
+        self.options = SrumMonkey.GetOptions().parse_args([
+            '--outpath',self.workdir
+        ])
+        self.options.output_db = os.path.join(self.workdir,'SRUM.db')
+        
+        dbh = sqlite3.connect(self.options.output_db)
+        dbh.execute("CREATE TABLE Numbers ('Number' INTEGER)")
+        dbh.executemany(
+            'INSERT INTO Numbers VALUES (?)',
+            [(number,) for number in xrange(WorkbookTest.ROWS)]
+        )
+        dbh.commit()
+        dbh.close()
+        
+        self.sql_files = []
+        for name in ['First','Second']:
+            filename = os.path.join(self.workdir,'{}.yml'.format(name))
+            with open(filename,'wb') as templatefh:
+                templatefh.write(WORKBOOK_TEMPLATE.format(name))
+            self.sql_files.append(filename)
+            
+    def WriteWorkbook(self,method_name,patch):
+        '''Write the workbook with a Reporter method patched
+        
+        Returns:
+            results: The results of WriteWorkbook'''
+        method = getattr(Reporter,method_name)
+        setattr(Reporter,method_name,patch(method))
+        try:
+            return WorkbookReporter(
+                self.options,
+                'Workbook.xlsx',
+                self.sql_files
+            ).WriteWorkbook()
+        finally:
+            setattr(Reporter,method_name,method)
+            
+    def GetWorksheetNames(self):
+        '''Get the worksheet names of the workbook in order'''
+        with zipfile.ZipFile(os.path.join(self.workdir,'Workbook.xlsx')) as workbook:
+            return re.findall(r'<sheet name="([^"]+)"',workbook.read('xl/workbook.xml'))
+        
+    def testWorksheetsAreInTemplateOrder(self):
+        def Patch(FetchRecords):
+            def SlowFetchRecords(reporter):
+                #The first template's query finishes last#
+                if reporter.sqlfilename == self.sql_files[0]:
+                    time.sleep(1)
+                return FetchRecords(reporter)
+            return SlowFetchRecords
+        
+        results = self.WriteWorkbook('FetchRecords',Patch)
+        
+        self.assertEqual([result[3] for result in results],[None,None])
+        self.assertEqual(self.GetWorksheetNames(),['First','Second'])
+        
+    def testWriterFailureStopsTheQueries(self):
+        def Patch(WriteRecords):
+            def FailingWriteRecords(reporter,column_names,records):
+                if reporter.sqlfilename == self.sql_files[0]:
+                    raise ValueError('write failed')
+                return WriteRecords(reporter,column_names,records)
+            return FailingWriteRecords
+        
+        thread_count = threading.active_count()
+        results = self.WriteWorkbook('WriteRecords',Patch)
+        
+        self.assertTrue('write failed' in results[0][3])
+        self.assertTrue(results[1][3].startswith('Not written'))
+        #The query threads are done and closed their handles#
+        self.assertEqual(threading.active_count(),thread_count)
+        self.assertEqual(
+            [key for key in DbConfig.CONNECTIONS if key[2] != threading.current_thread().ident],
+            []
+        )
+
+if __name__ == '__main__':
+    unittest.main()